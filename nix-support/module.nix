@@ -78,6 +78,16 @@ with lib.types; {
                 default = "";
             };
         };
+        mail = {
+            host = lib.mkOption {
+                type = str;
+                default = "localhost";
+            };
+            port = lib.mkOption {
+                type = int;
+                default = 25;
+            };
+        };
         workingDirectory = lib.mkOption {
             type = str;
             default = "/var/run/stregsystemet";
@@ -136,6 +146,10 @@ with lib.types; {
                         USER=${cfg.database.user}
                         PASSWORD=${cfg.database.password}
     
+                        [mail]
+                        HOST=${cfg.mail.host}
+                        PORT=${builtins.toString cfg.mail.port}
+    
                         [hostnames]
                         ${
                             let
@@ -168,6 +182,18 @@ with lib.types; {
                 wantedBy = ["default.target"];
                 after = ["stregsystemet-setup.service"];
             };
+            # Mails are queued in the database by the web server, and sent from here
+            stregsystemet-mail = {
+                enable = true;
+                serviceConfig = {
+                    WorkingDirectory = "${cfg.workingDirectory}";
+                    ExecStart = "${stregsystemet}/bin/stregsystemet sendqueuedmail --forever";
+                    Restart = "always";
+                    RestartSec = 10;
+                };
+                wantedBy = ["default.target"];
+                after = ["stregsystemet-setup.service"];
+            };
             stregsystemet-setup = {
                 enable = true;
                 serviceConfig = {
@@ -184,7 +210,7 @@ with lib.types; {
                     ''}/bin/setup.sh";
                 };
                 wantedBy = ["default.target"];
-                before = ["stregsystemet.service"];
+                before = ["stregsystemet.service" "stregsystemet-mail.service"];
             };
         };
     };
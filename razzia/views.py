@@ -7,6 +7,7 @@ from django.utils import timezone
 
 from razzia.models import Razzia, RazziaEntry
 from stregsystem.models import Member
+from stregsystem.utils import make_username_query
 
 
 # Create your views here.
@@ -28,7 +29,7 @@ def razzia_view_single(request, razzia_id, queryname, title=None):
         return render(request, template, locals())
 
     try:
-        member = Member.objects.get(username__iexact=queryname, active=True)
+        member = Member.objects.get(make_username_query(queryname), active=True)
     except Member.DoesNotExist:
         return render(request, template, locals())
 
@@ -6,7 +6,7 @@ from stregreport import views
 from stregreport.models import BreadRazzia
 from freezegun import freeze_time
 
-from stregsystem.models import Category
+from stregsystem.models import Category, LeaderboardYear, Member, Product
 
 
 class ParseIdStringTests(TestCase):
@@ -57,6 +57,23 @@ class CategoryRankReportTests(TestCase):
 
         self.assertEqual(stat_lists[0][0], catA.name)
 
+    def test_ranks_past_year(self):
+        self.client.login(username="tester", password="treotreo")
+        category = Category.objects.create(name="Category A")
+        product = Product.objects.create(name="product", price=100, active=True)
+        product.categories.add(category)
+        member = Member.objects.get(username="jokke")
+        with freeze_time(datetime.datetime(2020, 6, 1, 12)):
+            member.sale_set.create(product=product, price=product.price)
+
+        with freeze_time(datetime.datetime(2022, 6, 1, 12)):
+            response = self.client.get(reverse("report_categoryranks") + "2020", follow=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(entry.member, entry.count) for entry in response.context['stat_lists'][0][1]], [(member, 1)])
+        self.assertContains(response, "1.00")
+        self.assertTrue(LeaderboardYear.objects.get(year=2020).frozen)
+
 
 class SalesReportTests(TestCase):
     fixtures = ["initial_data"]
@@ -13,9 +13,10 @@ from django.shortcuts import redirect, render, get_object_or_404
 from django.urls import reverse
 from django.utils import dateparse, timezone
 from stregreport.forms import CategoryReportForm
-from stregsystem.models import Category, Member, Product, Sale
+from stregsystem.models import Category, LeaderboardEntry, Member, Product, Sale
 from stregreport.models import BreadRazzia, RazziaEntryOld
 from stregsystem.templatetags.stregsystem_extras import money
+from stregsystem.utils import fjule_party, make_username_query
 
 
 @permission_required("stregsystem.access_sales_reports")
@@ -53,8 +54,8 @@ def razzia(request, razzia_id, razzia_type=BreadRazzia.BREAD, title=None):
 def _sales_to_user_in_period(username, start_date, end_date, product_list, product_dict):
     result = (
         Product.objects.filter(
-            sale__member__username__iexact=username,
             id__in=product_list,
+            sale__member__in=Member.objects.filter(make_username_query(username)),
             sale__timestamp__gte=start_date,
             sale__timestamp__lte=end_date,
         )
@@ -81,7 +82,7 @@ def razzia_view_single(request, razzia_id, queryname, razzia_type=BreadRazzia.BR
         return render(request, templates[razzia_type], locals())
 
     try:
-        member = Member.objects.get(username__iexact=queryname, active=True)
+        member = Member.objects.get(make_username_query(queryname), active=True)
     except Member.DoesNotExist:
         return render(request, template, locals())
 
@@ -176,7 +177,7 @@ def razzia_view(request):
         return render(request, 'admin/stregsystem/razzia/error_wizarderror.html', {})
 
     try:
-        user = Member.objects.get(username__iexact=username, active=True)
+        user = Member.objects.get(make_username_query(username), active=True)
     except (Member.DoesNotExist, Member.MultipleObjectsReturned):
         return render(
             request,
@@ -306,11 +307,12 @@ def ranks_for_year(request, year):
     from_time = fjule_party(year - 1)
     to_time = fjule_party(year)
 
-    kr_stat_list = sale_money_rank(from_time, to_time)
+    LeaderboardEntry.prepare_year(year)
+    kr_stat_list = LeaderboardEntry.top(year, None)
 
     stat_lists = []
     for cat in Category.objects.all():
-        stat_lists.append((cat.name, sale_product_rank(get_product_ids_from_category(cat), from_time, to_time)))
+        stat_lists.append((cat.name, LeaderboardEntry.top(year, cat.id)))
 
     from_time_string = from_time.strftime(FORMAT)
     to_time_string = to_time.strftime(FORMAT)
@@ -323,32 +325,6 @@ def ranks_for_year(request, year):
     return render(request, 'admin/stregsystem/report/ranks.html', locals())
 
 
-# gives a list of member objects, with the additional field sale__count, with the number of sales which are in the parameter id
-def sale_product_rank(ids, from_time, to_time, rank_limit=10):
-    stat_list = (
-        Member.objects.filter(sale__timestamp__gt=from_time, sale__timestamp__lte=to_time, sale__product__in=ids)
-        .annotate(Count('sale'))
-        .order_by('-sale__count', 'username')[:rank_limit]
-    )
-    return stat_list
-
-
-# gives a list of member object, with the additional field sale__price__sum__formatted which is the number of money spent in the period given.
-def sale_money_rank(from_time, to_time, rank_limit=10):
-    stat_list = (
-        Member.objects.filter(active=True, sale__timestamp__gt=from_time, sale__timestamp__lte=to_time)
-        .annotate(Sum('sale__price'))
-        .order_by('-sale__price__sum', 'username')[:rank_limit]
-    )
-    for member in stat_list:
-        member.sale__price__sum__formatted = money(member.sale__price__sum)
-    return stat_list
-
-
-def get_product_ids_from_category(category):
-    return category.product_set.values_list('id', flat=True)
-
-
 # year of the last fjuleparty
 def last_fjule_party_year():
     current_date = timezone.now()
@@ -367,14 +343,6 @@ def next_fjule_party_year():
     return current_date.year + 1
 
 
-# date of fjuleparty (first friday of december) for the given year at
-# 10 o'clock
-def fjule_party(year):
-    first_december = timezone.datetime(year, 12, 1, 22, tzinfo=pytz.timezone("Europe/Copenhagen"))
-    days_to_add = (11 - first_december.weekday()) % 7
-    return first_december + datetime.timedelta(days=days_to_add)
-
-
 def parse_id_string(id_string):
     try:
         return list(map(int, id_string.split(' ')))
@@ -26,6 +26,7 @@ from stregsystem.templatetags.stregsystem_extras import money
 from stregsystem.utils import (
     make_active_productlist_query,
     make_inactive_productlist_query,
+    make_username_query,
 )
 
 
@@ -200,7 +201,7 @@ class ProductAdmin(BaseAdmin):
         return obj.bought
 
     get_bought.short_description = "Bought"
-    get_bought.admin_order_field = "bought"
+    get_bought.admin_order_field = "sold_count"
 
     def activated(self, product):
         return product.is_active()
@@ -248,10 +249,20 @@ class MemberForm(forms.ModelForm):
     def clean_username(self):
         username = self.cleaned_data["username"]
         if self.instance is None or self.instance.pk is None:
-            if Member.objects.filter(username__iexact=username).exists():
+            if Member.objects.filter(make_username_query(username)).exists():
                 raise forms.ValidationError("Brugernavnet er allerede taget")
         return username
 
+    def clean(self):
+        cleaned_data = super().clean()
+        username = cleaned_data.get("username")
+        # Two active members can't share a username, the database would refuse to save it
+        if username and cleaned_data.get("active"):
+            others = Member.objects.filter(make_username_query(username), active=True).exclude(pk=self.instance.pk)
+            if others.exists():
+                self.add_error("username", "Brugernavnet er allerede taget af et aktivt medlem")
+        return cleaned_data
+
 
 class MemberAdmin(BaseAdmin):
     form = MemberForm
@@ -289,7 +300,7 @@ class MemberAdmin(BaseAdmin):
 
     def save_model(self, request, obj, form, change):
         if 'username' in form.changed_data and change:
-            if Member.objects.filter(username__iexact=obj.username).exclude(pk=obj.pk).exists():
+            if Member.objects.filter(make_username_query(obj.username)).exclude(pk=obj.pk).exists():
                 messages.add_message(request, messages.WARNING, 'Det brugernavn var allerede optaget')
         super().save_model(request, obj, form, change)
 
@@ -1,14 +1,79 @@
 from django.apps import AppConfig
 
-from django.db.models.signals import post_save
-from stregsystem.signals import after_member_save, after_pending_signup_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from stregsystem.signals import (
+    after_catalog_change,
+    after_coffee_sale_delete,
+    after_coffee_sale_save,
+    after_intake_product_save,
+    after_intake_sale_delete,
+    after_intake_sale_save,
+    after_daily_sale_delete,
+    after_daily_sale_save,
+    after_leaderboard_sale_delete,
+    after_leaderboard_sale_save,
+    after_member_save,
+    after_member_totals_sale_delete,
+    after_member_totals_sale_save,
+    after_news_change,
+    after_pending_signup_save,
+    after_product_categories_change,
+    after_product_colors_change,
+    after_product_leaderboard_categories_change,
+    after_product_save,
+    after_sale_delete,
+    after_sale_save,
+)
 
 
 class StregConfig(AppConfig):
     name = 'stregsystem'
 
     def ready(self):
-        from stregsystem.models import Member, PendingSignup
+        from stregsystem.models import (
+            Category,
+            Member,
+            NamedProduct,
+            News,
+            PendingSignup,
+            Product,
+            ProductNote,
+            Room,
+            Sale,
+        )
 
         post_save.connect(after_member_save, sender=Member)
         post_save.connect(after_pending_signup_save, sender=PendingSignup)
+
+        for catalog_model in (Product, ProductNote, NamedProduct, Room, Category):
+            post_save.connect(after_catalog_change, sender=catalog_model)
+            post_delete.connect(after_catalog_change, sender=catalog_model)
+        m2m_changed.connect(after_catalog_change, sender=Product.rooms.through)
+        m2m_changed.connect(after_catalog_change, sender=Product.categories.through)
+        m2m_changed.connect(after_catalog_change, sender=ProductNote.products.through)
+
+        post_save.connect(after_product_save, sender=Product)
+        post_save.connect(after_sale_save, sender=Sale)
+        post_delete.connect(after_sale_delete, sender=Sale)
+
+        post_save.connect(after_coffee_sale_save, sender=Sale)
+        post_delete.connect(after_coffee_sale_delete, sender=Sale)
+        m2m_changed.connect(after_product_categories_change, sender=Product.categories.through)
+
+        post_save.connect(after_daily_sale_save, sender=Sale)
+        post_delete.connect(after_daily_sale_delete, sender=Sale)
+        m2m_changed.connect(after_product_colors_change, sender=Product.categories.through)
+
+        post_save.connect(after_member_totals_sale_save, sender=Sale)
+        post_delete.connect(after_member_totals_sale_delete, sender=Sale)
+
+        post_save.connect(after_leaderboard_sale_save, sender=Sale)
+        post_delete.connect(after_leaderboard_sale_delete, sender=Sale)
+        m2m_changed.connect(after_product_leaderboard_categories_change, sender=Product.categories.through)
+
+        post_save.connect(after_intake_sale_save, sender=Sale)
+        post_delete.connect(after_intake_sale_delete, sender=Sale)
+        post_save.connect(after_intake_product_save, sender=Product)
+
+        post_save.connect(after_news_change, sender=News)
+        post_delete.connect(after_news_change, sender=News)
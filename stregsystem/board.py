@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple
+
+from django.utils import timezone
+
+from stregsystem.booze import ballmer_peak
+from stregsystem.caffeine import CAFFEINE_TIME_INTERVAL, caffeine_mg_to_coffee_cups
+from stregsystem.models import IntakeState, Member, RecentActivity, Sale
+
+
+class BallmerPeaker(NamedTuple):
+    member_id: int
+    username: str
+    promille: float
+    # How long until they drop out of the peak
+    minutes: int
+    seconds: int
+
+
+class CaffeineLevel(NamedTuple):
+    member_id: int
+    username: str
+    caffeine: float
+    cups: int
+
+
+class RoomBoard(NamedTuple):
+    computed_at: datetime
+    ballmer_peakers: List[BallmerPeaker]
+    caffeine_levels: List[CaffeineLevel]
+
+
+# Kiosk screens poll the board, so each worker shows what it worked out for a few seconds
+BOARD_REFRESH_INTERVAL = timedelta(seconds=10)
+
+_room_boards: Dict[int, RoomBoard] = {}
+
+
+def get_room_board(room_id) -> RoomBoard:
+    room_id = int(room_id)
+    now = timezone.now()
+    board = _room_boards.get(room_id)
+    if board is None or not board.computed_at <= now < board.computed_at + BOARD_REFRESH_INTERVAL:
+        board = _room_boards[room_id] = compute_room_board(room_id, now)
+    return board
+
+
+def compute_room_board(room_id, now, top=10) -> RoomBoard:
+    """
+    Works out who is in the Ballmer peak and who has the most caffeine in their body, among the members who have
+    bought something in the room within the last day. Their intake states are fetched together, and decayed to now.
+    """
+    room_members = Sale.objects.filter(room_id=room_id, timestamp__gt=now - CAFFEINE_TIME_INTERVAL).values('member_id')
+    members = Member.objects.filter(id__in=room_members, active=True).values_list('id', 'username', 'gender')
+    usernames = {}
+    genders = {}
+    for member_id, username, gender in members:
+        usernames[member_id] = username
+        genders[member_id] = gender
+
+    ballmer_peakers = []
+    caffeine_levels = []
+    for member_id, state in IntakeState.current_many(genders, now).items():
+        username = usernames[member_id]
+        promille = state.alcohol_promille(now) + RecentActivity.DRUNKEN_BASTARDS.get(member_id, 0.0)
+        is_ballmer_peaking, minutes, seconds = ballmer_peak(promille)
+        if is_ballmer_peaking:
+            ballmer_peakers.append(BallmerPeaker(member_id, username, promille, minutes, seconds))
+
+        caffeine = state.caffeine_in_body(now)
+        if caffeine > 0:
+            caffeine_levels.append(CaffeineLevel(member_id, username, caffeine, caffeine_mg_to_coffee_cups(caffeine)))
+
+    ballmer_peakers.sort(key=lambda peaker: (-peaker.minutes * 60 - peaker.seconds, peaker.username))
+    caffeine_levels.sort(key=lambda level: (-level.caffeine, level.username))
+    return RoomBoard(now, ballmer_peakers, caffeine_levels[:top])
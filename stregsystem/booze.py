@@ -39,6 +39,17 @@ def alcohol_bac_degradation(time):
     return BAC_DEGRADATION_PR_HOUR * time_hours
 
 
+def alcohol_bac_decayed(bac, since, now):
+    """The BAC at now, given the BAC at since and no drinks in between."""
+    bac -= alcohol_bac_degradation(now - since)
+
+    # A negative BAC doesn't make sense
+    if bac < 0:
+        bac = 0
+
+    return bac
+
+
 def alcohol_bac_timeline(gender, weight, now, alcohol_timeline):
     # If we didn't drink anything, we can't have any alcohol
     if len(alcohol_timeline) == 0:
@@ -52,31 +63,17 @@ def alcohol_bac_timeline(gender, weight, now, alcohol_timeline):
         # First iteration has BAC 0, and a BAC of 0 can't degrade, so the first
         # iteration doesn't need degradation
         if last_time is not None:
-            time_diff = time - last_time
-            current -= alcohol_bac_degradation(time_diff)
+            current = alcohol_bac_decayed(current, last_time, time)
 
         last_time = time
 
-        # A negative BAC doesn't make sense
-        if current < 0:
-            current = 0
-
         current += alcohol_bac_increase(gender, weight, ml)
 
-        # last_time can never be None after the first iteration
-        assert last_time is not None
-
     # Since we return if the list is empty we must have some last time
     assert last_time is not None
 
     # We also need to remove the degradation from the last drink till now
-    time_diff = now - last_time
-    current -= alcohol_bac_degradation(time_diff)
-
-    if current < 0:
-        current = 0
-
-    return current
+    return alcohol_bac_decayed(current, last_time, now)
 
 
 # Ballmer peak: 1.337 +/- 0.05
@@ -21,6 +21,11 @@ def caffeine_mg_to_coffee_cups(mg: int) -> int:
     return int(mg / CAFFEINE_IN_COFFEE)
 
 
+def caffeine_decayed(mg: float, since: datetime, now: datetime) -> float:
+    """The caffeine mg in blood at now, given the mg at since and no intakes in between."""
+    return max(mg * ((1 - CAFFEINE_DEGRADATION_PR_HOUR) ** ((now - since) / timedelta(hours=1))), 0)
+
+
 # calculate current caffeine in body, takes list of intakes, applies caffeine degradation by using compound interest
 def current_caffeine_in_body_compound_interest(intakes: List[Intake]) -> float:
     """
@@ -42,11 +47,7 @@ def current_caffeine_in_body_compound_interest(intakes: List[Intake]) -> float:
     # do compound interest on list of intakes
     for intake in intakes:
         # first do degradation of current caffeine in blood using compound rule (kn = k0 * (1 + r)^n), maxing to 0
-        mg_blood = max(
-            mg_blood
-            * ((1 - CAFFEINE_DEGRADATION_PR_HOUR) ** ((intake.timestamp - last_intake_time) / timedelta(hours=1))),
-            0,
-        )
+        mg_blood = caffeine_decayed(mg_blood, last_intake_time, intake.timestamp)
         # swap current timestamp with last intake time to calculate degradation timespan in next iteration
         last_intake_time = intake.timestamp
 
@@ -0,0 +1,190 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+
+from stregsystem.models import CacheVersion, NamedProduct, Product, ProductNote
+from stregsystem.utils import make_active_productlist_query, make_room_specific_query
+
+CATALOG_VERSION = "catalog"
+
+
+class ProductNotePair(NamedTuple):
+    product: Product
+    note: List[ProductNote]
+
+
+class AliasIndex(NamedTuple):
+    """Every NamedProduct, looked up by name and by product."""
+
+    version: str
+    product_ids: Dict[str, int]
+    aliases: Dict[int, List[str]]
+
+
+class RoomCatalog(NamedTuple):
+    """A snapshot of everything a room shows on its product list."""
+
+    version: str
+    products: List[Product]
+    notes: Dict[int, List[ProductNote]]
+    aliases: Dict[int, List[str]]
+    expires_at: datetime
+
+    def product_note_pairs(self) -> List[ProductNotePair]:
+        return [ProductNotePair(product, self.notes.get(product.id, [])) for product in self.products]
+
+
+class CatalogResponse(NamedTuple):
+    """A product API response, serialized once and handed to every client polling it until the catalog changes."""
+
+    # What the body was serialized from, such as the catalog version
+    source: Hashable
+    body: bytes
+    etag: str
+
+
+# Snapshots are kept per worker, the shared CacheVersion tells us when ours are stale.
+_room_catalogs: Dict[int, RoomCatalog] = {}
+_alias_index: Optional[AliasIndex] = None
+_catalog_responses: Dict[Tuple[str, Optional[int]], CatalogResponse] = {}
+
+
+def get_room_catalog(room_id) -> RoomCatalog:
+    """
+    Returns the catalog snapshot of the room, rebuilding it if the catalog has changed since it was built,
+    or if a product or note might have changed visibility since then.
+    """
+    room_id = int(room_id)
+    version = CacheVersion.current(CATALOG_VERSION)
+    catalog = _room_catalogs.get(room_id)
+
+    # Keep the alias index in step with the snapshot, without looking up the version twice
+    alias_index = _get_alias_index(version)
+
+    if catalog is None or catalog.version != version or catalog.expires_at <= timezone.now():
+        catalog = _build_room_catalog(room_id, version, alias_index)
+        _room_catalogs[room_id] = catalog
+
+    return catalog
+
+
+def get_alias_index() -> AliasIndex:
+    """Returns the alias index, reloading it if any alias has changed since it was loaded."""
+    return _get_alias_index(CacheVersion.current(CATALOG_VERSION))
+
+
+def loaded_alias_index() -> AliasIndex:
+    """
+    Returns the alias index as last checked by this worker, without checking it again.
+    For template filters, which run once per product row after the view has fetched the catalog.
+    """
+    if _alias_index is None:
+        return get_alias_index()
+    return _alias_index
+
+
+def get_active_products_response(room_id) -> CatalogResponse:
+    """The active products of the room, by id with their name and price."""
+    room_id = int(room_id)
+    catalog = get_room_catalog(room_id)
+    return _get_catalog_response(
+        ('active_products', room_id),
+        (catalog.version, catalog.expires_at),
+        lambda: {product.id: {'name': product.name, 'price': product.price} for product in catalog.products},
+    )
+
+
+def get_named_products_response() -> CatalogResponse:
+    """Every product alias, with the id of its product."""
+    alias_index = get_alias_index()
+    return _get_catalog_response(('named_products', None), alias_index.version, lambda: alias_index.product_ids)
+
+
+def get_category_mappings_response() -> CatalogResponse:
+    """The categories of every product, active or not."""
+    return _get_catalog_response(
+        ('category_mappings', None),
+        CacheVersion.current(CATALOG_VERSION),
+        _category_mappings,
+        ensure_ascii=True,
+    )
+
+
+def invalidate_catalog():
+    CacheVersion.bump(CATALOG_VERSION)
+
+
+def _get_catalog_response(
+    key: Tuple[str, Optional[int]], source: Hashable, build: Callable[[], dict], ensure_ascii=False
+) -> CatalogResponse:
+    cached = _catalog_responses.get(key)
+    if cached is not None and cached.source == source:
+        return cached
+
+    body = json.dumps(build(), cls=DjangoJSONEncoder, ensure_ascii=ensure_ascii).encode('utf-8')
+    # The ETag is taken from the body rather than the version, so every worker hands out the same one, and clients
+    # keep their copy when the catalog changes in a way that doesn't show here, like a sale of a limited product.
+    # There is no Last-Modified, as a time to the second can't tell apart two changes within the same second.
+    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    response = _catalog_responses[key] = CatalogResponse(source, body, etag)
+    return response
+
+
+def _category_mappings() -> Dict[int, List[dict]]:
+    mappings = {product_id: [] for product_id in Product.objects.order_by('id').values_list('id', flat=True)}
+    links = Product.categories.through.objects.order_by('product_id', 'category_id').values_list(
+        'product_id', 'category_id', 'category__name'
+    )
+    for product_id, category_id, category_name in links:
+        mappings.setdefault(product_id, []).append({'category_id': category_id, 'category_name': category_name})
+    return mappings
+
+
+def _get_alias_index(version: str) -> AliasIndex:
+    global _alias_index
+    if _alias_index is None or _alias_index.version != version:
+        product_ids = {}
+        aliases = {}
+        for name, product_id in NamedProduct.objects.values_list('name', 'product_id').order_by('id'):
+            product_ids[name] = product_id
+            aliases.setdefault(product_id, []).append(name)
+        _alias_index = AliasIndex(version, product_ids, aliases)
+    return _alias_index
+
+
+def _build_room_catalog(room_id: int, version: str, alias_index: AliasIndex) -> RoomCatalog:
+    now = timezone.now()
+    products = list(make_active_productlist_query(Product.objects).filter(make_room_specific_query(room_id)))
+    product_ids = [product.id for product in products]
+
+    notes = {}
+    note_links = (
+        ProductNote.products.through.objects.filter(
+            Q(product_id__in=product_ids),
+            Q(productnote__active=True),
+            Q(productnote__start_date__isnull=True) | Q(productnote__start_date__lte=now),
+            Q(productnote__end_date__isnull=True) | Q(productnote__end_date__gte=now),
+        )
+        .select_related('productnote')
+        .order_by('productnote_id')
+    )
+    for link in note_links:
+        notes.setdefault(link.product_id, []).append(link.productnote)
+
+    aliases = {
+        product_id: alias_index.aliases[product_id] for product_id in product_ids if product_id in alias_index.aliases
+    }
+
+    # Start and end dates only have day precision, so rebuilding every hour catches those whatever the timezone.
+    # Deactivation dates are exact, so expire right when the first one passes.
+    expires_at = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    for product in products:
+        if product.deactivate_date is not None and product.deactivate_date < expires_at:
+            expires_at = product.deactivate_date
+
+    return RoomCatalog(version, products, notes, aliases, expires_at)
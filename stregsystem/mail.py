@@ -1,19 +1,34 @@
+import io
+import itertools
 import smtplib
 import logging
+import tempfile
+import zipfile
 
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
 from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
 from django.template.loader import render_to_string
 from django.utils.html import escape
 from django.utils import timezone
 from stregsystem.templatetags.stregsystem_extras import money
-from stregsystem.utils import rows_to_csv
+from stregsystem.utils import write_csv
 
 logger = logging.getLogger(__name__)
 
+MAIL_FROM = 'treo@fklub.dk'
+# A mail that can't be sent is tried again after 1, 2, 4, ... minutes, and given up after the last attempt
+MAIL_RETRY_DELAY = timezone.timedelta(minutes=1)
+MAIL_MAX_ATTEMPTS = 8
+# How long a worker may take to send the batch it has claimed, before another worker may claim it
+MAIL_LEASE = timezone.timedelta(minutes=10)
+# Sent mails are kept for a while in case someone asks about them, and mails given up on a while longer
+MAIL_KEEP_SENT = timezone.timedelta(days=7)
+MAIL_KEEP_FAILED = timezone.timedelta(days=30)
+
 
 def send_welcome_mail(member):
     send_template_mail(
@@ -33,95 +48,191 @@ def send_payment_mail(member, amount, mobilepay_comment):
     )
 
 
-data_sent = {}
+# Rows fetched from the database at a time, and how big the archive may get before it is spooled to disk
+USERDATA_CHUNK_SIZE = 2000
+USERDATA_SPOOL_SIZE = 1024 * 1024
 
 
 def send_userdata_mail(member):
-    from .models import Payment, Sale, MobilePayment
+    """Mails the member everything we know about them. See userdata_limiter for how often they may ask."""
+    with tempfile.SpooledTemporaryFile(max_size=USERDATA_SPOOL_SIZE) as archive:
+        write_userdata_archive(member, archive)
+        archive.seek(0)
+        send_template_mail(
+            member,
+            "send_csv.html",
+            {**vars(member), "fember": member.username},
+            f'{member.username} has requested their user data!',
+            {"userdata.zip": archive.read()},
+        )
+    member.save()
 
-    now = timezone.now()
-    td = now - timezone.timedelta(minutes=5)
-    if member.id in data_sent.keys() and data_sent[member.id] > td:
-        return False
-    data_sent[member.id] = now
 
-    sales: list[Sale] = member.sale_set.order_by("timestamp")
-    payments: list[Payment] = member.payment_set.order_by("timestamp")
-    mobilepayments: list[MobilePayment] = member.mobilepayment_set.order_by("timestamp")
-    mobilepay_payments: list[Payment] = [mobilepayment.payment for mobilepayment in mobilepayments]
+def write_userdata_archive(member, file):
+    """
+    Writes everything we know about the member to a zip archive of CSV files. The sales and payments are streamed
+    from the database a chunk at a time, so years of history never have to fit in memory at once.
+    """
+    from .models import MobilePayment
+
+    sales = (
+        member.sale_set.order_by("timestamp", "id")
+        .values_list("timestamp", "product__name", "price")
+        .iterator(chunk_size=USERDATA_CHUNK_SIZE)
+    )
+    is_mobilepay = Exists(MobilePayment.objects.filter(payment_id=OuterRef("id")))
+    payments = (
+        member.payment_set.order_by("timestamp", "id")
+        .values_list("timestamp", "amount", is_mobilepay)
+        .iterator(chunk_size=USERDATA_CHUNK_SIZE)
+    )
 
     if member.gender in [i for (i, _) in member.GENDER_CHOICES]:
         gender = [text for (i, text) in member.GENDER_CHOICES if member.gender == i][0]
     else:
         gender = member.gender
 
-    sales_csv = rows_to_csv(
-        [["Timestamp", "Name", "Price"]] + [[sale.timestamp, sale.product.name, sale.price] for sale in sales]
-    )
-    payments_csv = rows_to_csv(
-        [["Timestamp", "Amount", "Is Mobilepay"]]
-        + [[payment.timestamp, payment.amount, payment in mobilepay_payments] for payment in payments]
-    )
-    userdata_csv = rows_to_csv(
-        [
-            [
-                "Id",
-                "Name",
-                "First name",
-                "Last name",
-                "Email",
-                "Registration year",
-                "Active",
-                "Gender",
-                "Want spam",
-                "Balance",
-                "Undo count",
-            ],
+    with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        _write_archive_csv(archive, "sales.csv", itertools.chain([["Timestamp", "Name", "Price"]], sales))
+        _write_archive_csv(
+            archive, "payments.csv", itertools.chain([["Timestamp", "Amount", "Is Mobilepay"]], payments)
+        )
+        _write_archive_csv(
+            archive,
+            "userdata.csv",
             [
-                member.id,
-                member.username,
-                member.firstname,
-                member.lastname,
-                member.email,
-                member.year,
-                member.active,
-                gender,
-                member.want_spam,
-                member.balance,
-                member.undo_count,
+                [
+                    "Id",
+                    "Name",
+                    "First name",
+                    "Last name",
+                    "Email",
+                    "Registration year",
+                    "Active",
+                    "Gender",
+                    "Want spam",
+                    "Balance",
+                    "Undo count",
+                ],
+                [
+                    member.id,
+                    member.username,
+                    member.firstname,
+                    member.lastname,
+                    member.email,
+                    member.year,
+                    member.active,
+                    gender,
+                    member.want_spam,
+                    member.balance,
+                    member.undo_count,
+                ],
             ],
-        ]
-    )
+        )
 
-    send_template_mail(
-        member,
-        "send_csv.html",
-        {**vars(member), "fember": member.username},
-        f'{member.username} has requested their user data!',
-        {"sales.csv": sales_csv.encode(), "payments.csv": payments_csv.encode(), "userdata.csv": userdata_csv.encode()},
-    )
-    member.save()
-    return True
+
+def _write_archive_csv(archive, name, rows):
+    with archive.open(name, "w") as entry, io.TextIOWrapper(entry, encoding="utf-8", newline="") as text:
+        write_csv(text, rows)
 
 
 def send_template_mail(member, target_template: str, context: dict, subject: str, attachments: dict = {}):
     msg = MIMEMultipart()
-    msg['From'] = 'treo@fklub.dk'
+    msg['From'] = MAIL_FROM
     msg['To'] = member.email
     msg['Subject'] = subject
     html = render_to_string(f"mail/{target_template}", context)
     msg.attach(MIMEText(html, 'html'))
 
-    if hasattr(settings, 'TEST_MODE'):
-        return
-
     for name, attachment in attachments.items():
         attachment = MIMEApplication(attachment, Name=name)
         attachment['Content-Disposition'] = f'attachment; filename={name}'
         msg.attach(attachment)
 
-    try:
-        smtpObj = smtplib.SMTP('localhost', 25)
-        smtpObj.sendmail('treo@fklub.dk', member.email, msg.as_string())
-    except Exception as e:
-        logger.error(str(e))
+    queue_mail(member.email, subject, msg)
+
+
+def queue_mail(recipient, subject, msg):
+    """Puts the mail in the outbox, the sendqueuedmail command sends it once the current transaction commits."""
+    from .models import OutgoingMail
+
+    OutgoingMail.objects.create(recipient=recipient, subject=subject or "", message=msg.as_string())
+
+
+def purge_outbox() -> int:
+    """Deletes the mails that were sent or given up on long enough ago, attachments and all. Returns how many."""
+    from .models import OutgoingMail
+
+    now = timezone.now()
+    done = OutgoingMail.objects.filter(next_attempt_at__isnull=True)
+    deleted, _ = done.filter(
+        Q(sent_at__lt=now - MAIL_KEEP_SENT) | Q(sent_at__isnull=True, updated_at__lt=now - MAIL_KEEP_FAILED)
+    ).delete()
+    return deleted
+
+
+class MailWorker(object):
+    """
+    Sends the mails in the outbox over a single SMTP connection, which is kept open for as long as there are mails
+    to send. A mail that can't be sent is tried again later, waiting twice as long after each attempt.
+    """
+
+    def __init__(self, host=None, port=None, connect=smtplib.SMTP):
+        self.host = host if host is not None else settings.STREGSYSTEM_MAIL_HOST
+        self.port = port if port is not None else settings.STREGSYSTEM_MAIL_PORT
+        self.connect = connect
+        self.smtp = None
+
+    def send_due(self, batch_size=100) -> int:
+        """Sends up to batch_size of the mails that are due, and returns how many were taken off the outbox."""
+        batch = self._claim(batch_size)
+        for mail in batch:
+            try:
+                if self.smtp is None:
+                    self.smtp = self.connect(self.host, self.port)
+                self.smtp.sendmail(MAIL_FROM, mail.recipient, mail.message)
+            except (smtplib.SMTPException, OSError) as e:
+                if not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+                    # Anything but the server turning down this one mail means the connection is no good anymore
+                    self.close()
+                self._retry_later(mail, e)
+            else:
+                mail.next_attempt_at = None
+                mail.sent_at = timezone.now()
+                mail.attempts += 1
+                mail.save(update_fields=['next_attempt_at', 'sent_at', 'attempts', 'updated_at'])
+        return len(batch)
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    @staticmethod
+    def _claim(batch_size):
+        from .models import OutgoingMail
+
+        # Lease the batch, so another worker running at the same time leaves it alone
+        now = timezone.now()
+        lease_until = now + MAIL_LEASE
+        due = OutgoingMail.objects.filter(next_attempt_at__lte=now)
+        ids = list(due.order_by('next_attempt_at', 'id').values_list('id', flat=True)[:batch_size])
+        due.filter(id__in=ids).update(next_attempt_at=lease_until)
+        return list(OutgoingMail.objects.filter(id__in=ids, next_attempt_at=lease_until).order_by('id'))
+
+    @staticmethod
+    def _retry_later(mail, error):
+        mail.attempts += 1
+        mail.last_error = str(error)
+        if mail.attempts < MAIL_MAX_ATTEMPTS:
+            mail.next_attempt_at = timezone.now() + MAIL_RETRY_DELAY * 2 ** (mail.attempts - 1)
+            logger.warning(
+                "Could not send mail %d to %s, trying again at %s", mail.id, mail.recipient, mail.next_attempt_at
+            )
+        else:
+            mail.next_attempt_at = None
+            logger.error("Giving up on mail %d to %s: %s", mail.id, mail.recipient, error)
+        mail.save(update_fields=['attempts', 'last_error', 'next_attempt_at', 'updated_at'])
@@ -0,0 +1,71 @@
+import datetime
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.utils import timezone
+
+from stregsystem.models import Category, DailySales, Member
+from stregsystem.purchase_heatmap import get_heatmap_columns, prepare_heatmap_template_context
+
+
+def scan_sales(member, end_date, weeks_to_display):
+    """The day counts, sums and colour counts of the heatmap, found by going through every sale like it used to."""
+    days_to_display = (7 * weeks_to_display) - (6 - (end_date + datetime.timedelta(days=1)).weekday())
+    cutoff_date = end_date - datetime.timedelta(days=days_to_display - 1)
+    products_by_color = [
+        Category.objects.filter(name=category).values_list("product", flat=True)
+        for category in DailySales.COLOR_CATEGORIES
+    ]
+
+    products_by_day = defaultdict(list)
+    sales = member.sale_set.filter(timestamp__date__gte=cutoff_date, timestamp__date__lte=end_date).select_related(
+        'product'
+    )
+    for sale in sales:
+        products_by_day[timezone.localdate(sale.timestamp)].append(sale.product)
+
+    days = []
+    for n in range(days_to_display):
+        products = products_by_day.get(end_date - datetime.timedelta(days=n), [])
+        color_counts = tuple(sum(product.id in ids for product in products) for ids in products_by_color)
+        days.append((len(products), sum(product.price for product in products), color_counts))
+    return days
+
+
+class Command(BaseCommand):
+    help = 'Measure how long the purchase heatmap of a member takes, from the daily sales and by scanning the sales'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--member", help="Username of the member, defaults to the one with the most sales")
+        parser.add_argument("--weeks", type=int, nargs="+", default=[12, 26, 53], help="Heatmap windows to measure")
+        parser.add_argument("--repeat", type=int, default=20, help="Number of times to prepare each heatmap")
+
+    def handle(self, *args, **options):
+        if options["member"]:
+            member = Member.objects.filter(username=options["member"]).first()
+        else:
+            member = Member.objects.annotate(sales=Count('sale')).filter(sales__gt=0).order_by('-sales').first()
+        if member is None:
+            raise CommandError("No member to measure, make some sales first")
+
+        end_date = timezone.localdate()
+        for weeks in options["weeks"]:
+            columns = get_heatmap_columns(member, end_date, weeks)
+            if columns.counts != [count for count, money, color_counts in scan_sales(member, end_date, weeks)]:
+                self.stdout.write(self.style.WARNING(f"The daily sales of {member.username} are out of date"))
+
+            daily_sales = self.measure(lambda: prepare_heatmap_template_context(member, weeks, end_date), options)
+            scanning = self.measure(lambda: scan_sales(member, end_date, weeks), options)
+            self.stdout.write(
+                f"{weeks} weeks, {sum(columns.counts)} sales: daily sales {daily_sales * 1000:.1f} ms, "
+                f"scanning the sales {scanning * 1000:.1f} ms"
+            )
+
+    @staticmethod
+    def measure(prepare, options):
+        start = time.perf_counter()
+        for _ in range(options["repeat"]):
+            prepare()
+        return (time.perf_counter() - start) / options["repeat"]
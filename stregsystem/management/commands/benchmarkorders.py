@@ -0,0 +1,72 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+
+from stregsystem.models import Member, Order, Product, Room, StregForbudError
+from stregsystem.sale_writer import SaleWriter
+
+
+class Command(BaseCommand):
+    help = 'Measure how fast parallel buyers in different rooms get their orders through, with each way of committing'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--buyers", type=int, default=8, help="Number of parallel buyers, each in their own room")
+        parser.add_argument("--orders", type=int, default=50, help="Number of orders each buyer makes")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError("The benchmark creates members and sales, only run it against a development database")
+
+        buyers, orders = options["buyers"], options["orders"]
+        product = Product.objects.create(name="benchmark", price=100, active=True)
+        rooms = [Room.objects.create(name=f"benchmark {i}", description="benchmark") for i in range(buyers)]
+        # bulk_create, so the buyers aren't sent welcome mails
+        Member.objects.bulk_create(
+            [Member(username=f"benchmark{i}", balance=3 * orders * product.price) for i in range(buyers)]
+        )
+        members = list(Member.objects.filter(username__startswith="benchmark").order_by("id")[:buyers])
+
+        sale_writer = SaleWriter()
+        modes = [
+            ("select_for_update", lambda order: order.execute(conditional_debit=False)),
+            ("conditional UPDATE", lambda order: order.execute(conditional_debit=True)),
+            ("group commit", sale_writer.execute),
+        ]
+        try:
+            for label, execute in modes:
+                elapsed, failed = self.run_buyers(members, rooms, product, orders, execute)
+                total = buyers * orders
+                succeeded = total - failed
+                self.stdout.write(
+                    f"{label}: {succeeded}/{total} orders by {buyers} buyers went through in {elapsed:.2f}s "
+                    f"({succeeded / elapsed:.0f} orders/s)"
+                )
+        finally:
+            Member.objects.filter(id__in=[member.id for member in members]).delete()
+            Room.objects.filter(id__in=[room.id for room in rooms]).delete()
+            product.delete()
+
+    @staticmethod
+    def run_buyers(members, rooms, product, orders, execute):
+        failures = []
+
+        def buy(member, room):
+            try:
+                for _ in range(orders):
+                    try:
+                        execute(Order.from_products(member, room, [product]))
+                    except (StregForbudError, OperationalError) as e:
+                        failures.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=(member, room)) for member, room in zip(members, rooms)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, len(failures)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from stregsystem.models import WeeklyCoffeeCount
+
+
+class Command(BaseCommand):
+    help = 'Recount the coffee leaderboard of this week from the sales'
+
+    def handle(self, *args, **options):
+        WeeklyCoffeeCount.rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(f"Counted coffees of {WeeklyCoffeeCount.objects.count()} members this week")
+        )
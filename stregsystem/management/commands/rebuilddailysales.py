@@ -0,0 +1,16 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from stregsystem.models import DailySales
+
+
+class Command(BaseCommand):
+    help = 'Sum up the daily sales of every member from the sales, for the purchase heatmap'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=datetime.date.fromisoformat, help="Only redo the days from this date")
+
+    def handle(self, *args, **options):
+        DailySales.rebuild(since=options["since"])
+        self.stdout.write(self.style.SUCCESS(f"Summed up {DailySales.objects.count()} days of sales"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from stregsystem.models import LeaderboardEntry, LeaderboardYear
+from stregsystem.utils import fjule_year_of
+
+
+class Command(BaseCommand):
+    help = 'Sum up the leaderboards of fjule years from the sales, freezing the years that are over'
+
+    def add_arguments(self, parser):
+        parser.add_argument("years", type=int, nargs="*", help="Fjule years to rebuild, defaults to the ongoing year")
+
+    def handle(self, *args, **options):
+        for year in options["years"] or [fjule_year_of(timezone.now())]:
+            LeaderboardEntry.rebuild(year)
+            frozen = LeaderboardYear.objects.get(year=year).frozen
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Summed up {LeaderboardEntry.objects.filter(year=year).count()} leaderboard entries for {year}"
+                    + (", the year is frozen" if frozen else "")
+                )
+            )
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from stregsystem.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the sold counter of limited products from their sales'
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        products = Product.objects.filter(Q(start_date__isnull=False) | ~Q(sold_count=0))
+        for product in products:
+            product.recount_sold()
+        self.stdout.write(self.style.SUCCESS(f"Recounted {len(products)} products"))
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from stregsystem.mail import MailWorker, purge_outbox
+
+# How often a worker running forever clears out old mails
+PURGE_INTERVAL = timezone.timedelta(hours=1)
+
+
+class Command(BaseCommand):
+    help = 'Send the mails in the outbox over one SMTP connection, trying failed ones again later'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="Number of mails to claim at a time")
+        parser.add_argument("--forever", action="store_true", help="Keep waiting for new mails instead of stopping")
+        parser.add_argument("--interval", type=float, default=10, help="Seconds to wait when the outbox is empty")
+
+    def handle(self, *args, **options):
+        worker = MailWorker()
+        sent = 0
+        purged = purge_outbox()
+        purged_at = timezone.now()
+        try:
+            while True:
+                claimed = worker.send_due(options["batch_size"])
+                sent += claimed
+                if claimed:
+                    continue
+                # Don't keep the connection open while there is nothing to send
+                worker.close()
+                if not options["forever"]:
+                    break
+                if timezone.now() - purged_at >= PURGE_INTERVAL:
+                    purged += purge_outbox()
+                    purged_at = timezone.now()
+                time.sleep(options["interval"])
+        finally:
+            worker.close()
+        self.stdout.write(self.style.SUCCESS(f"Went through {sent} mails, cleared out {purged} old ones"))
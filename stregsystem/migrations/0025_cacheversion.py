@@ -0,0 +1,28 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0024_alter_productnote_products"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CacheVersion",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "name",
+                    models.CharField(max_length=32, primary_key=True, serialize=False),
+                ),
+                ("version", models.CharField(max_length=32)),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
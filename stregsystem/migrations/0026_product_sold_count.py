@@ -0,0 +1,28 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:16
+
+from django.db import migrations, models
+
+from stregsystem.utils import date_to_midnight
+
+
+def count_sold(apps, schema_editor):
+    Product = apps.get_model('stregsystem', 'Product')
+    for product in Product.objects.filter(start_date__isnull=False):
+        product.sold_count = product.sale_set.filter(timestamp__gt=date_to_midnight(product.start_date)).count()
+        product.save(update_fields=['sold_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0025_cacheversion"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="sold_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_sold, migrations.RunPython.noop),
+    ]
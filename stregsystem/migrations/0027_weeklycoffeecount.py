@@ -0,0 +1,72 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:21
+
+import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+from django.utils import timezone
+
+
+def count_coffees_this_week(apps, schema_editor):
+    Sale = apps.get_model("stregsystem", "Sale")
+    WeeklyCoffeeCount = apps.get_model("stregsystem", "WeeklyCoffeeCount")
+    now = timezone.now()
+    week_start = (now - datetime.timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    counts = (
+        Sale.objects.filter(timestamp__gte=week_start, timestamp__lte=now, product__categories=6)
+        .values("member_id")
+        .annotate(count=Count("id"))
+    )
+    WeeklyCoffeeCount.objects.bulk_create(
+        [WeeklyCoffeeCount(week_start=week_start, member_id=row["member_id"], count=row["count"]) for row in counts]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0026_product_sold_count"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WeeklyCoffeeCount",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("week_start", models.DateTimeField()),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "member",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.member",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name="weeklycoffeecount",
+            index=models.Index(
+                fields=["week_start", "-count"], name="stregsystem_week_st_8ed8c8_idx"
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="weeklycoffeecount",
+            unique_together={("week_start", "member")},
+        ),
+        migrations.RunPython(count_coffees_this_week, migrations.RunPython.noop),
+    ]
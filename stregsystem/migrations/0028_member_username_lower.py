@@ -0,0 +1,57 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:35
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Lower
+import django.db.models.functions.text
+
+
+def check_duplicate_usernames(apps, schema_editor):
+    """
+    Active members whose usernames only differ in case would break the constraint below. Which of them to keep is
+    not ours to guess, so stop and list them, for an admin to merge, rename or deactivate before migrating again.
+    """
+    Member = apps.get_model("stregsystem", "Member")
+    active = Member.objects.filter(active=True).annotate(username_lower=Lower("username"))
+    duplicates = (
+        active.order_by()
+        .values("username_lower")
+        .annotate(members=Count("id"))
+        .filter(members__gt=1)
+        .values_list("username_lower", flat=True)
+    )
+    conflicts = []
+    for username in list(duplicates):
+        members = active.filter(username_lower=username).order_by("id").values_list("id", "username")
+        conflicts.append(", ".join(f"{member_username} (id {member_id})" for member_id, member_username in members))
+    if conflicts:
+        raise RuntimeError(
+            "Active members have usernames that only differ in case. Merge, rename or deactivate them, "
+            "and migrate again:\n" + "\n".join(conflicts)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0027_weeklycoffeecount"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="member",
+            index=models.Index(
+                django.db.models.functions.text.Lower("username"),
+                name="member_username_lower_idx",
+            ),
+        ),
+        migrations.RunPython(check_duplicate_usernames, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="member",
+            constraint=models.UniqueConstraint(
+                django.db.models.functions.text.Lower("username"),
+                condition=models.Q(("active", True)),
+                name="unique_active_member_username_lower",
+            ),
+        ),
+    ]
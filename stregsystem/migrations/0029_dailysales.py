@@ -0,0 +1,88 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:40
+
+import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+COLOR_CATEGORIES = ("Øl", "Energidrik", "Sodavand")
+
+
+def sum_up_heatmap_weeks(apps, schema_editor):
+    # Only the weeks the heatmap shows, rebuilddailysales does the rest of the history
+    Sale = apps.get_model("stregsystem", "Sale")
+    DailySales = apps.get_model("stregsystem", "DailySales")
+    Product = apps.get_model("stregsystem", "Product")
+    since = timezone.localdate() - datetime.timedelta(weeks=12)
+
+    color_ids = [set() for _ in COLOR_CATEGORIES]
+    links = Product.categories.through.objects.filter(category__name__in=COLOR_CATEGORIES)
+    for product_id, category_name in links.values_list("product_id", "category__name"):
+        color_ids[COLOR_CATEGORIES.index(category_name)].add(product_id)
+
+    days = {}
+    grouped_sales = (
+        Sale.objects.filter(timestamp__date__gte=since)
+        .values_list("member_id", TruncDate("timestamp"), "product_id", "price")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    for member_id, date, product_id, price, count in grouped_sales:
+        day = days.get((member_id, date))
+        if day is None:
+            day = days[(member_id, date)] = DailySales(member_id=member_id, date=date, product_counts={})
+        day.count += count
+        day.money += price * count
+        day.beer_count += count if product_id in color_ids[0] else 0
+        day.energy_drink_count += count if product_id in color_ids[1] else 0
+        day.soda_count += count if product_id in color_ids[2] else 0
+        day.product_counts[str(product_id)] = day.product_counts.get(str(product_id), 0) + count
+    DailySales.objects.bulk_create(days.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0028_member_username_lower"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailySales",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("date", models.DateField()),
+                ("count", models.IntegerField(default=0)),
+                ("money", models.IntegerField(default=0)),
+                ("beer_count", models.IntegerField(default=0)),
+                ("energy_drink_count", models.IntegerField(default=0)),
+                ("soda_count", models.IntegerField(default=0)),
+                ("product_counts", models.JSONField(default=dict)),
+                (
+                    "member",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.member",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "unique_together": {("member", "date")},
+            },
+        ),
+        migrations.RunPython(sum_up_heatmap_weeks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0029_dailysales"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LeaderboardYear",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("year", models.IntegerField(unique=True)),
+                ("frozen", models.BooleanField(default=False)),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="LeaderboardEntry",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("year", models.IntegerField()),
+                ("count", models.IntegerField(default=0)),
+                ("money", models.IntegerField(default=0)),
+                (
+                    "category",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.category",
+                    ),
+                ),
+                (
+                    "member",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.member",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name="leaderboardentry",
+            index=models.Index(
+                fields=["year", "category", "-count"],
+                name="stregsystem_year_30386d_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="leaderboardentry",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("category", None)),
+                fields=("year", "member"),
+                name="unique_leaderboard_total_per_year",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="leaderboardentry",
+            unique_together={("year", "category", "member")},
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:50
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def sum_up_totals(apps, schema_editor):
+    Member = apps.get_model('stregsystem', 'Member')
+    Sale = apps.get_model('stregsystem', 'Sale')
+    sales = Sale.objects.filter(member=OuterRef('pk')).order_by().values('member')
+    Member.objects.update(
+        total_purchases=Coalesce(Subquery(sales.annotate(count=Count('id')).values('count')), 0),
+        total_amount=Coalesce(Subquery(sales.annotate(amount=Sum('price')).values('amount'), output_field=IntegerField()), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0030_leaderboard"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="member",
+            name="total_amount",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="member",
+            name="total_purchases",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name="sale",
+            index=models.Index(
+                fields=["member", "timestamp", "id"],
+                name="sale_member_timestamp_id_idx",
+            ),
+        ),
+        migrations.RunPython(sum_up_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0032_outgoing_mail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RateLimit",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "key",
+                    models.CharField(max_length=128, primary_key=True, serialize=False),
+                ),
+                ("count", models.IntegerField(default=1)),
+                ("window_ends", models.DateTimeField(db_index=True)),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
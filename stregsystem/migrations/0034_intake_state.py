@@ -0,0 +1,40 @@
+# Generated by Django 4.1.13 on 2026-10-18 05:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0033_rate_limit"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IntakeState",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "member",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="stregsystem.member",
+                    ),
+                ),
+                ("gender", models.CharField(max_length=1)),
+                ("bac", models.FloatField(default=0)),
+                ("bac_at", models.DateTimeField(blank=True, null=True)),
+                ("bac_since", models.DateTimeField(blank=True, null=True)),
+                ("caffeine", models.FloatField(default=0)),
+                ("caffeine_at", models.DateTimeField(blank=True, null=True)),
+                ("caffeine_since", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.13 on 2026-10-18 05:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0034_intake_state"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="sale",
+            index=models.Index(
+                fields=["room", "timestamp"], name="sale_room_timestamp_idx"
+            ),
+        ),
+    ]
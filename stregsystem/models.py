@@ -1,23 +1,29 @@
 import datetime
+import itertools
 import urllib.parse
+import uuid
 from abc import abstractmethod
 from collections import Counter
 from email.utils import parseaddr
 
+from django.conf import settings
 from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import RegexValidator
-from django.db import models, transaction
-from django.db.models import Count
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, Lower, TruncDate
 from django.utils import timezone
 
-from stregsystem.caffeine import Intake, CAFFEINE_TIME_INTERVAL, current_caffeine_in_body_compound_interest
+from stregsystem.caffeine import CAFFEINE_TIME_INTERVAL, caffeine_decayed
 from stregsystem.deprecated import deprecated
 from stregsystem.mail import send_payment_mail, send_welcome_mail
 from stregsystem.templatetags.stregsystem_extras import money
 from stregsystem.utils import (
     date_to_midnight,
+    fjule_party,
+    fjule_year_of,
     make_processed_mobilepayment_query,
     make_unprocessed_member_filled_mobilepayment_query,
     PaymentToolException,
@@ -55,6 +61,39 @@ class BaseModel(models.Model):
         abstract = True
 
 
+class CacheVersion(BaseModel):
+    """
+    A version token shared by every worker for one of the in-process caches.
+    Bumping it makes every worker rebuild that cache on its next request.
+    """
+
+    name = models.CharField(max_length=32, primary_key=True)
+    version = models.CharField(max_length=32)
+
+    def __str__(self):
+        return f"{self.name}: {self.version}"
+
+    @classmethod
+    def current(cls, name):
+        return cls.objects.filter(name=name).values_list('version', flat=True).first()
+
+    @classmethod
+    def bump(cls, name):
+        # A random token rather than a counter, so a rolled back bump can never be mistaken for a later one
+        cls.objects.update_or_create(name=name, defaults={'version': uuid.uuid4().hex})
+
+
+class RateLimit(BaseModel):
+    """How often an action has been done in the current window, shared by every worker. See stregsystem.ratelimit."""
+
+    key = models.CharField(max_length=128, primary_key=True)
+    count = models.IntegerField(default=1)
+    window_ends = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key}: {self.count} until {self.window_ends}"
+
+
 # So we have two "basic" operations to do with money
 # we can take money from a user and we can give them money
 # the class names here are written from the perspective of
@@ -118,6 +157,13 @@ class Order(object):
             order.items.add(item)
         return order
 
+    @classmethod
+    def from_product_counts(cls, member, room, product_counts):
+        order = cls(member, room)
+        for product, count in product_counts:
+            order.items.add(OrderItem(product=product, order=order, count=count))
+        return order
+
     # @HACK In reality calculating the total for old products is way harder and
     # more complicated than this. While it's not in the database this is
     # acceptable
@@ -125,21 +171,35 @@ class Order(object):
         return sum((x.price() for x in self.items))
 
     @transaction.atomic
-    def execute(self):
+    def execute(self, conditional_debit=None):
+        """
+        Executes the order and returns the new balance of the member.
+
+        With conditional_debit the balance is debited by a single conditional UPDATE, instead of locking the member
+        row and saving the whole member back. Defaults to the STREGSYSTEM_CONDITIONAL_DEBIT setting.
+        """
+        if conditional_debit is None:
+            conditional_debit = settings.STREGSYSTEM_CONDITIONAL_DEBIT
         transaction = PayTransaction(amount=self.total())
 
-        # Check if we have enough inventory to fulfill the order
+        # Reserve the inventory of limited products, the update only goes through if there is enough left
+        now = timezone.now()
         for item in self.items:
-            if (
-                item.product.start_date is not None
-                and (item.product.bought + item.count > item.product.quantity)
-                and item.product.quantity != 0
-            ):
+            if not item.product.counts_as_sold(now):
+                continue
+            reserved = Product.objects.filter(
+                Q(id=item.product.id), Q(quantity=0) | Q(sold_count__lte=F('quantity') - item.count)
+            ).update(sold_count=F('sold_count') + item.count)
+            if not reserved:
                 raise NoMoreInventoryError()
+            item.product.sold_count += item.count
 
-        # Take update lock on member row
-        self.member = Member.objects.select_for_update().get(id=self.member.id)
-        self.member.fulfill(transaction)
+        if conditional_debit:
+            self.member.debit(transaction)
+        else:
+            # Take update lock on member row
+            self.member = Member.objects.select_for_update().get(id=self.member.id)
+            self.member.fulfill(transaction)
 
         # Collect all the sales of the order
         sales = []
@@ -151,8 +211,38 @@ class Order(object):
         # Save all the sales
         Sale.objects.bulk_create(sales)
 
-        # We changed the user balance, so save that
-        self.member.save()
+        # bulk_create doesn't send post_save either, so keep the sums over the sales up to date here
+        links = product_category_links([item.product.id for item in self.items])
+        if sales:
+            Member.add_to_totals(self.member.id, len(sales), self.total())
+            self.member.total_purchases += len(sales)
+            self.member.total_amount += self.total()
+            bought = [(item.product.id, item.product.price, item.count) for item in self.items]
+            DailySales.add(self.member.id, sales[0].timestamp, bought, links)
+            IntakeState.add(
+                self.member,
+                [(sale.timestamp, sale.product.alcohol_content_ml, sale.product.caffeine_content_mg) for sale in sales],
+            )
+            LeaderboardEntry.add(self.member.id, sales[0].timestamp, bought, links)
+
+        coffee_ids = {
+            product_id for product_id, category_id, name in links if category_id == WeeklyCoffeeCount.COFFEE_CATEGORY_ID
+        }
+        WeeklyCoffeeCount.add(
+            self.member.id, timezone.now(), sum(item.count for item in self.items if item.product.id in coffee_ids)
+        )
+
+        # bulk_create doesn't send post_save, so tell the catalog ourselves if a limited product might be sold out now
+        if any(item.product.start_date is not None for item in self.items):
+            from stregsystem.catalog import invalidate_catalog
+
+            invalidate_catalog()
+
+        if not conditional_debit:
+            # We changed the user balance, so save that
+            self.member.save()
+
+        return self.member.balance
 
 
 class GetTransaction(MoneyTransaction):
@@ -193,8 +283,44 @@ class Member(BaseModel):  # id automatisk...
     undo_count = models.IntegerField(default=0)  # for 'undos' i alt
     notes = models.TextField(blank=True)
     signup_due_paid = models.BooleanField(default=True)
+    # Everything the member has bought, only changed by add_to_totals as sales are made and refunded
+    total_purchases = models.IntegerField(default=0, editable=False)
+    total_amount = models.IntegerField(default=0, editable=False)  # penge, oere...
 
     stregforbud_override = False
+    TOTAL_FIELDS = ('total_purchases', 'total_amount')
+
+    class Meta(BaseModel.Meta):
+        # Usernames are looked up case-insensitively, see make_username_query
+        indexes = [models.Index(Lower('username'), name='member_username_lower_idx')]
+        constraints = [
+            models.UniqueConstraint(
+                Lower('username'), condition=Q(active=True), name='unique_active_member_username_lower'
+            )
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and 'update_fields' not in kwargs and not kwargs.get('force_insert'):
+            # A member loaded before a sale was made would write back totals that are out of date
+            skipped = set(self.TOTAL_FIELDS) | self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.attname
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in skipped
+            ]
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def add_to_totals(member_id, count, amount):
+        Member.objects.filter(id=member_id).update(
+            total_purchases=F('total_purchases') + count, total_amount=F('total_amount') + amount
+        )
+
+    def recount_totals(self):
+        """Sums up the totals of the member from the sales again."""
+        totals = Sale.objects.filter(member_id=self.id).aggregate(count=Count('id'), amount=Coalesce(Sum('price'), 0))
+        Member.objects.filter(id=self.id).update(total_purchases=totals['count'], total_amount=totals['amount'])
+        self.total_purchases, self.total_amount = totals['count'], totals['amount']
 
     # I don't know if this is actually used anywhere - Jesper 17/09-2017
     @deprecated
@@ -258,6 +384,19 @@ class Member(BaseModel):  # id automatisk...
             raise StregForbudError
         self.balance += transaction.change()
 
+    def debit(self, transaction):
+        """
+        Fulfill the transaction with a single conditional UPDATE, without taking a lock or saving the member
+        """
+        change = transaction.change()
+        debited = Member.objects.filter(id=self.id, balance__gte=-change).update(
+            balance=F('balance') + change, updated_at=timezone.now()
+        )
+        if not debited:
+            raise StregForbudError
+        self.balance = Member.objects.values_list('balance', flat=True).get(id=self.id)
+        return self.balance
+
     def rollback(self, transaction):
         """
         Rollback transaction
@@ -288,68 +427,585 @@ class Member(BaseModel):  # id automatisk...
 
         return self.balance - buy < 0
 
+    def recent_activity(self, now=None) -> "RecentActivity":
+        return RecentActivity(self, now)
+
     # BAC in this method stands for "Blood alcohol content"
     def calculate_alcohol_promille(self):
-        from stregsystem.booze import alcohol_bac_timeline, Gender
-        from datetime import timedelta
+        return self.recent_activity().alcohol_promille()
 
-        now = timezone.now()
-        # Lets assume noone is drinking 12 hours straight
-        calculation_start = now - timedelta(hours=12)
-
-        alcohol_sales = self.sale_set.filter(
-            timestamp__gt=calculation_start, product__alcohol_content_ml__gt=0.0
-        ).order_by('timestamp')
-        alcohol_timeline = [(s.timestamp, s.product.alcohol_content_ml) for s in alcohol_sales]
-
-        gender = Gender.UNKNOWN
-        if self.gender == "M":
-            gender = Gender.MALE
-        elif self.gender == "F":
-            gender = Gender.FEMALE
-
-        bac = alcohol_bac_timeline(gender, 80, now, alcohol_timeline)
-
-        # Tihi:
-        drunken_bastards = {
-            2219: 42.0,  # mbogh
-            2124: -1.5,  # mchro
-            2113: 42.0,  # kyrke
-            2024: 31.5,  # jbr
-            2414: 5440,  # kkkas
+    def calculate_caffeine_in_body(self) -> float:
+        return self.recent_activity().caffeine_in_body()
+
+    def is_leading_coffee_addict(self):
+        return WeeklyCoffeeCount.leader_id() == self.id
+
+
+class RecentActivity(object):
+    """
+    What a member has been up to lately: their sales within the last minute, for the multibuy hint, and how much
+    alcohol and caffeine they have in their body.
+    """
+
+    # How far back the multibuy hint looks
+    SALES_INTERVAL = datetime.timedelta(seconds=60)
+
+    # Tihi:
+    DRUNKEN_BASTARDS = {
+        2219: 42.0,  # mbogh
+        2124: -1.5,  # mchro
+        2113: 42.0,  # kyrke
+        2024: 31.5,  # jbr
+        2414: 5440,  # kkkas
+    }
+
+    def __init__(self, member, now=None):
+        self.member = member
+        self.now = now or timezone.now()
+        self.sales = list(
+            member.sale_set.filter(timestamp__gt=self.now - self.SALES_INTERVAL)
+            .order_by('timestamp')
+            .values_list('timestamp', 'product_id', named=True)
+        )
+        self._intake = None
+
+    @property
+    def intake(self) -> "IntakeState":
+        if self._intake is None:
+            self._intake = IntakeState.current(self.member, self.now)
+        return self._intake
+
+    def alcohol_promille(self):
+        return self.intake.alcohol_promille(self.now) + self.DRUNKEN_BASTARDS.get(self.member.id, 0.0)
+
+    def caffeine_in_body(self) -> float:
+        return self.intake.caffeine_in_body(self.now)
+
+
+class IntakeState(BaseModel):
+    """
+    The alcohol and caffeine in the body of a member right after their latest drink, carried forward as they buy
+    more and decayed to the current time when read. This gives what replaying their sales of the last 12 hours
+    (alcohol) and 24 hours (caffeine) would, without fetching them.
+    The state is deleted when a sale is refunded or a product changes, and built again from the sales on the next
+    purchase. Only purchases store the state, under a row lock, so a read that replays the sales can never overwrite
+    a drink bought meanwhile.
+    """
+
+    # Lets assume noone is drinking 12 hours straight
+    BAC_TIME_INTERVAL = datetime.timedelta(hours=12)
+    # Everyone weighs 80 kg
+    WEIGHT = 80
+    STATE_FIELDS = ('gender', 'bac', 'bac_at', 'bac_since', 'caffeine', 'caffeine_at', 'caffeine_since')
+
+    member = models.OneToOneField(Member, on_delete=models.CASCADE, primary_key=True)
+    gender = models.CharField(max_length=1)  # the BAC depends on it
+    bac = models.FloatField(default=0)
+    bac_at = models.DateTimeField(null=True, blank=True)  # the latest alcoholic drink
+    bac_since = models.DateTimeField(null=True, blank=True)  # the first drink since the BAC was last 0
+    caffeine = models.FloatField(default=0)
+    caffeine_at = models.DateTimeField(null=True, blank=True)  # the latest intake of caffeine
+    caffeine_since = models.DateTimeField(null=True, blank=True)  # the first intake counted in caffeine
+
+    def __str__(self):
+        return f"{self.member_id}: {self.bac} BAC at {self.bac_at}, {self.caffeine} mg at {self.caffeine_at}"
+
+    @classmethod
+    def current(cls, member, now) -> "IntakeState":
+        state = cls.objects.filter(member_id=member.id).first()
+        if state is None or state.gender != member.gender or not state.covers(now):
+            state = cls.replayed(member, now, state)
+        return state
+
+    @classmethod
+    def current_many(cls, genders, now) -> dict[int, "IntakeState"]:
+        """
+        The states of many members at once, by member id, given the gender of each. The states that need building
+        again are built from a single fetch of their sales.
+        """
+        states = {
+            state.member_id: state
+            for state in cls.objects.filter(member_id__in=list(genders)).only("member_id", *cls.STATE_FIELDS)
+        }
+        stale = [
+            member_id
+            for member_id, gender in genders.items()
+            if member_id not in states or states[member_id].gender != gender or not states[member_id].covers(now)
+        ]
+        if not stale:
+            return states
+
+        drinks = (
+            Sale.objects.filter(member_id__in=stale, timestamp__gt=now - CAFFEINE_TIME_INTERVAL)
+            .order_by('member_id', 'timestamp', 'id')
+            .values_list('member_id', 'timestamp', 'product__alcohol_content_ml', 'product__caffeine_content_mg')
+        )
+        drinks_by_member = {
+            member_id: [drink[1:] for drink in member_drinks]
+            for member_id, member_drinks in itertools.groupby(drinks, key=lambda drink: drink[0])
         }
-        bac += drunken_bastards.get(self.id, 0.0)
+        for member_id in stale:
+            state = states.get(member_id)
+            if state is None:
+                state = states[member_id] = cls(member_id=member_id)
+            state.gender = genders[member_id]
+            state.replay(drinks_by_member.get(member_id, []), now)
+        return states
 
-        return bac
+    @classmethod
+    def add(cls, member, drinks):
+        """Carries the state of the member past the drinks, (timestamp, alcohol ml, caffeine mg) in the order bought."""
+        state = cls.objects.select_for_update().filter(member_id=member.id).first()
+        # Caffeine never decays to nothing, so the first drink that counts only moves on when the state is rebuilt.
+        # Rebuild once it has left the window, or reads would have to replay the sales until the next rebuild.
+        if (
+            state is None
+            or state.gender != member.gender
+            or any(state._is_before(timestamp) or not state.covers(timestamp) for timestamp, _, _ in drinks)
+        ):
+            cls.rebuild(member, timezone.now(), state)
+            return
+        for timestamp, alcohol_ml, caffeine_mg in drinks:
+            state._drink(timestamp, alcohol_ml, caffeine_mg)
+        state.save()
 
-    def calculate_caffeine_in_body(self) -> float:
-        # get list of last 24h caffeine intakes and calculate current body caffeine content
-        return current_caffeine_in_body_compound_interest(
-            [
-                Intake(x.timestamp, x.product.caffeine_content_mg)
-                for x in self.sale_set.filter(
-                    timestamp__gt=timezone.now() - CAFFEINE_TIME_INTERVAL, product__caffeine_content_mg__gt=0
-                ).order_by('timestamp')
-            ]
+    @classmethod
+    def rebuild(cls, member, now, state=None) -> "IntakeState":
+        """Replays the sales of the member into their state and stores it. Only for add, which holds the lock."""
+        state = cls.replayed(member, now, state)
+        state.save()
+        return state
+
+    @classmethod
+    def replayed(cls, member, now, state=None) -> "IntakeState":
+        """Replays the sales of the member that still count at now, into their existing state if given."""
+        if state is None:
+            state = cls(member_id=member.id)
+        state.gender = member.gender
+        state.replay(
+            Sale.objects.filter(member_id=member.id, timestamp__gt=now - CAFFEINE_TIME_INTERVAL)
+            .order_by('timestamp', 'id')
+            .values_list('timestamp', 'product__alcohol_content_ml', 'product__caffeine_content_mg'),
+            now,
         )
+        return state
 
-    def is_leading_coffee_addict(self):
-        coffee_category = [6]
+    @classmethod
+    def forget(cls, **member_filter):
+        cls.objects.filter(**member_filter).delete()
+
+    def replay(self, drinks, now):
+        """Starts the state over from the drinks, (timestamp, alcohol ml, caffeine mg) in the order bought."""
+        self.bac, self.bac_at, self.bac_since = 0, None, None
+        self.caffeine, self.caffeine_at, self.caffeine_since = 0, None, None
+        for timestamp, alcohol_ml, caffeine_mg in drinks:
+            if timestamp <= now - self.BAC_TIME_INTERVAL:
+                alcohol_ml = 0.0
+            self._drink(timestamp, alcohol_ml, caffeine_mg)
+
+    def covers(self, now):
+        """Whether every drink that counts at now is in the state, and no drink that doesn't."""
+        if self.bac_at is not None and self.bac_at > now - self.BAC_TIME_INTERVAL:
+            if self.bac_since <= now - self.BAC_TIME_INTERVAL:
+                return False
+        if self.caffeine_at is not None and self.caffeine_at > now - CAFFEINE_TIME_INTERVAL:
+            if self.caffeine_since <= now - CAFFEINE_TIME_INTERVAL:
+                return False
+        return True
+
+    def alcohol_promille(self, now):
+        from stregsystem.booze import alcohol_bac_decayed
+
+        if self.bac_at is None or self.bac_at <= now - self.BAC_TIME_INTERVAL:
+            return 0
+        return alcohol_bac_decayed(self.bac, self.bac_at, now)
+
+    def caffeine_in_body(self, now) -> float:
+        if self.caffeine_at is None or self.caffeine_at <= now - CAFFEINE_TIME_INTERVAL:
+            return 0
+        return caffeine_decayed(self.caffeine, self.caffeine_at, now)
+
+    def _is_before(self, timestamp):
+        return any(at is not None and timestamp < at for at in (self.bac_at, self.caffeine_at))
+
+    def _drink(self, timestamp, alcohol_ml, caffeine_mg):
+        from stregsystem.booze import alcohol_bac_decayed, alcohol_bac_increase, Gender
+
+        # Drinks that have left their time window by now don't count, however much is left of them
+        if (alcohol_ml or 0.0) > 0.0:
+            if self.bac_at is None or self.bac_at <= timestamp - self.BAC_TIME_INTERVAL:
+                bac = 0
+            else:
+                bac = alcohol_bac_decayed(self.bac, self.bac_at, timestamp)
+            if bac == 0:
+                # Whatever was drunk before has burned off, so nothing before this drink matters anymore
+                self.bac_since = timestamp
+            gender = {"M": Gender.MALE, "F": Gender.FEMALE}.get(self.gender, Gender.UNKNOWN)
+            self.bac = bac + alcohol_bac_increase(gender, self.WEIGHT, alcohol_ml)
+            self.bac_at = timestamp
+
+        if caffeine_mg > 0:
+            if self.caffeine_at is None or self.caffeine_at <= timestamp - CAFFEINE_TIME_INTERVAL:
+                self.caffeine = 0
+                self.caffeine_since = timestamp
+            else:
+                self.caffeine = caffeine_decayed(self.caffeine, self.caffeine_at, timestamp)
+            self.caffeine += caffeine_mg
+            self.caffeine_at = timestamp
+
+
+def product_category_links(product_ids=None):
+    """Returns a (product id, category id, category name) triple for each category of the products, or of all."""
+    links = Product.categories.through.objects.all()
+    if product_ids is not None:
+        links = links.filter(product_id__in=product_ids)
+    return list(links.values_list('product_id', 'category_id', 'category__name'))
+
+
+class WeeklyCoffeeCount(BaseModel):
+    """How many coffees a member has bought this week, kept up to date as coffee is sold and refunded."""
+
+    COFFEE_CATEGORY_ID = 6
 
+    week_start = models.DateTimeField()
+    member = models.ForeignKey(Member, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    class Meta(BaseModel.Meta):
+        unique_together = [["week_start", "member"]]
+        indexes = [models.Index(fields=["week_start", "-count"])]
+
+    @staticmethod
+    def week_start_of(timestamp):
+        monday = timestamp - datetime.timedelta(days=timestamp.weekday())
+        return monday.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def coffee_product_ids(cls, product_ids):
+        return set(
+            Product.categories.through.objects.filter(
+                product_id__in=product_ids, category_id=cls.COFFEE_CATEGORY_ID
+            ).values_list('product_id', flat=True)
+        )
+
+    @classmethod
+    def add(cls, member_id, timestamp, count):
+        """Adds count coffees bought at timestamp to the leaderboard, or takes them off again if count is negative."""
+        week_start = cls.week_start_of(timezone.now())
+        if count == 0 or cls.week_start_of(timestamp) != week_start:
+            return
+
+        with transaction.atomic():
+            updated = cls.objects.filter(week_start=week_start, member_id=member_id).update(count=F('count') + count)
+            if updated or count < 0:
+                return
+            # First coffee of the week for this member, so the leaderboards of earlier weeks can go
+            cls.objects.filter(week_start__lt=week_start).delete()
+            cls.objects.create(week_start=week_start, member_id=member_id, count=count)
+
+    @classmethod
+    def leader_id(cls):
+        return (
+            cls.objects.filter(week_start=cls.week_start_of(timezone.now()), count__gt=0)
+            .order_by('-count', 'member__username')
+            .values_list('member_id', flat=True)
+            .first()
+        )
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls):
+        """Recounts the leaderboard of this week from the sales."""
         now = timezone.now()
-        start_of_week = now - datetime.timedelta(days=now.weekday()) - datetime.timedelta(hours=now.hour)
-        user_with_most_coffees_bought = (
-            Member.objects.filter(
-                sale__timestamp__gt=start_of_week,
-                sale__timestamp__lte=now,
-                sale__product__categories__in=coffee_category,
+        week_start = cls.week_start_of(now)
+        counts = (
+            Sale.objects.filter(
+                timestamp__gte=week_start,
+                timestamp__lte=now,
+                product__categories=cls.COFFEE_CATEGORY_ID,
             )
-            .annotate(Count('sale'))
-            .order_by('-sale__count', 'username')
-            .first()
+            .values('member_id')
+            .annotate(count=Count('id'))
+        )
+        cls.objects.all().delete()
+        cls.objects.bulk_create(
+            [cls(week_start=week_start, member_id=row['member_id'], count=row['count']) for row in counts]
         )
 
-        return user_with_most_coffees_bought == self
+
+class DailySales(BaseModel):
+    """What a member bought on a day, kept up to date as sales are made and refunded. Backs the purchase heatmap."""
+
+    # The categories the heatmap colours red, green and blue
+    COLOR_CATEGORIES = ("Øl", "Energidrik", "Sodavand")
+
+    member = models.ForeignKey(Member, on_delete=models.CASCADE)
+    date = models.DateField()
+    count = models.IntegerField(default=0)
+    money = models.IntegerField(default=0)  # penge, oere...
+    beer_count = models.IntegerField(default=0)
+    energy_drink_count = models.IntegerField(default=0)
+    soda_count = models.IntegerField(default=0)
+    # Product id to count, so the menu can show what was bought on the day
+    product_counts = models.JSONField(default=dict)
+
+    class Meta(BaseModel.Meta):
+        unique_together = [["member", "date"]]
+
+    def color_counts(self):
+        return self.beer_count, self.energy_drink_count, self.soda_count
+
+    def product_ids(self):
+        """The id of every product bought on the day, once for each time it was bought."""
+        return self.expand_product_counts(self.product_counts)
+
+    @staticmethod
+    def expand_product_counts(product_counts):
+        return [int(product_id) for product_id, count in product_counts.items() for _ in range(count)]
+
+    @staticmethod
+    def day_of(timestamp):
+        return timezone.localdate(timestamp)
+
+    @classmethod
+    def color_product_ids(cls, links):
+        """Returns the ids of the products in each of the colour categories, from the links of product_category_links."""
+        color_ids = tuple(set() for _ in cls.COLOR_CATEGORIES)
+        for product_id, category_id, category_name in links:
+            if category_name in cls.COLOR_CATEGORIES:
+                color_ids[cls.COLOR_CATEGORIES.index(category_name)].add(product_id)
+        return color_ids
+
+    def _add_product(self, product_id, price, count, color_ids):
+        self.count += count
+        self.money += price * count
+        self.beer_count += count if product_id in color_ids[0] else 0
+        self.energy_drink_count += count if product_id in color_ids[1] else 0
+        self.soda_count += count if product_id in color_ids[2] else 0
+
+        product_count = self.product_counts.get(str(product_id), 0) + count
+        if product_count > 0:
+            self.product_counts[str(product_id)] = product_count
+        else:
+            self.product_counts.pop(str(product_id), None)
+
+    @classmethod
+    def add(cls, member_id, timestamp, items, links=None):
+        """
+        Adds the (product id, price, count) items bought at timestamp to the day of the member,
+        or takes them off again if count is negative.
+        """
+        if links is None:
+            links = product_category_links([product_id for product_id, price, count in items])
+        color_ids = cls.color_product_ids(links)
+        date = cls.day_of(timestamp)
+        try:
+            with transaction.atomic():
+                day = cls.objects.select_for_update().filter(member_id=member_id, date=date).first()
+                if day is None:
+                    day = cls(member_id=member_id, date=date, product_counts={})
+                for product_id, price, count in items:
+                    day._add_product(product_id, price, count, color_ids)
+                if day.count > 0:
+                    day.save()
+                elif day.pk is not None:
+                    day.delete()
+        except IntegrityError:
+            # Another sale made the first row of the day at the same time, so add to that one instead
+            cls.add(member_id, timestamp, items, links)
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, since=None):
+        """Sums up the days from the sales again, all of them or those from the date since."""
+        sales = Sale.objects.all()
+        days = cls.objects.all()
+        if since is not None:
+            sales = sales.filter(timestamp__date__gte=since)
+            days = days.filter(date__gte=since)
+
+        color_ids = cls.color_product_ids(product_category_links())
+        rows = {}
+        grouped_sales = (
+            sales.values_list('member_id', TruncDate('timestamp'), 'product_id', 'price')
+            .annotate(count=Count('id'))
+            .order_by()
+        )
+        for member_id, date, product_id, price, count in grouped_sales.iterator():
+            day = rows.get((member_id, date))
+            if day is None:
+                day = rows[(member_id, date)] = cls(member_id=member_id, date=date, product_counts={})
+            day._add_product(product_id, price, count, color_ids)
+
+        days.delete()
+        cls.objects.bulk_create(rows.values(), batch_size=500)
+
+    @classmethod
+    def recolor(cls, product_ids=None, since=None):
+        """
+        Counts the colours of the days again from their product counts, after products moved in or out of the colour
+        categories. Only the days with any of the products, or all days, from the date since.
+        """
+        days = cls.objects.only('id', 'product_counts')
+        if since is not None:
+            days = days.filter(date__gte=since)
+        if product_ids is not None:
+            days = days.filter(product_counts__has_any_keys=[str(product_id) for product_id in product_ids])
+        days = list(days)
+
+        bought_ids = {int(product_id) for day in days for product_id in day.product_counts}
+        color_ids = cls.color_product_ids(product_category_links(bought_ids))
+        for day in days:
+            counts = [
+                sum(count for product_id, count in day.product_counts.items() if int(product_id) in ids)
+                for ids in color_ids
+            ]
+            day.beer_count, day.energy_drink_count, day.soda_count = counts
+        cls.objects.bulk_update(days, ['beer_count', 'energy_drink_count', 'soda_count'], batch_size=500)
+
+
+class LeaderboardYear(BaseModel):
+    """A fjule year with a leaderboard. The leaderboard is rebuilt one last time after the fjuleparty and frozen."""
+
+    year = models.IntegerField(unique=True)
+    frozen = models.BooleanField(default=False)
+
+
+class LeaderboardEntry(BaseModel):
+    """
+    How many items of a category a member bought during a fjule year, and for how much.
+    The entries without a category count everything the member bought.
+    Only the ongoing year is kept up to date as sales are made and refunded.
+    """
+
+    year = models.IntegerField()
+    category = models.ForeignKey("Category", on_delete=models.CASCADE, null=True, blank=True)
+    member = models.ForeignKey(Member, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+    money = models.IntegerField(default=0)  # penge, oere...
+
+    class Meta(BaseModel.Meta):
+        unique_together = [["year", "category", "member"]]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["year", "member"], condition=Q(category=None), name="unique_leaderboard_total_per_year"
+            )
+        ]
+        indexes = [models.Index(fields=["year", "category", "-count"])]
+
+    @classmethod
+    def add(cls, member_id, timestamp, items, links=None):
+        """
+        Adds the (product id, price, count) items bought at timestamp to the ongoing year,
+        or takes them off again if count is negative.
+        """
+        year = fjule_year_of(timestamp)
+        if year != fjule_year_of(timezone.now()):
+            # Years that are over are rebuilt from the sales when they are frozen, and never change after that
+            return
+        if links is None:
+            links = product_category_links([product_id for product_id, price, count in items])
+
+        totals = {None: [0, 0]}
+        for product_id, price, count in items:
+            category_ids = [category_id for linked_id, category_id, name in links if linked_id == product_id]
+            for category_id in [None] + category_ids:
+                total = totals.setdefault(category_id, [0, 0])
+                total[0] += count
+                total[1] += price * count
+
+        try:
+            with transaction.atomic():
+                for category_id, (count, money_sum) in totals.items():
+                    updated = cls.objects.filter(year=year, category_id=category_id, member_id=member_id).update(
+                        count=F('count') + count, money=F('money') + money_sum
+                    )
+                    if not updated and count > 0:
+                        cls.objects.create(
+                            year=year, category_id=category_id, member_id=member_id, count=count, money=money_sum
+                        )
+        except IntegrityError:
+            # Another sale made the first entry at the same time, so add to that one instead
+            cls.add(member_id, timestamp, items, links)
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, year):
+        """Sums up the year from the sales again, and freezes it if its fjuleparty has passed."""
+        sales = Sale.objects.filter(timestamp__gt=fjule_party(year - 1), timestamp__lte=fjule_party(year))
+        totals = sales.values_list('member_id').annotate(Count('id'), Sum('price')).order_by()
+        category_totals = (
+            sales.filter(product__categories__isnull=False)
+            .values_list('product__categories', 'member_id')
+            .annotate(Count('id'), Sum('price'))
+            .order_by()
+        )
+
+        cls.objects.filter(year=year).delete()
+        cls.objects.bulk_create(
+            [
+                cls(year=year, member_id=member_id, count=count, money=money_sum)
+                for member_id, count, money_sum in totals.iterator()
+            ]
+            + [
+                cls(year=year, category_id=category_id, member_id=member_id, count=count, money=money_sum)
+                for category_id, member_id, count, money_sum in category_totals.iterator()
+            ],
+            batch_size=500,
+        )
+        LeaderboardYear.objects.update_or_create(year=year, defaults={'frozen': fjule_party(year) < timezone.now()})
+
+    @classmethod
+    @transaction.atomic
+    def recount_categories(cls, year, category_ids=None, product_ids=None):
+        """
+        Sums up the category entries of the year again for the members who bought any of the products, after they
+        moved in or out of the categories. None stands for every category, or every product.
+        """
+        sales = Sale.objects.filter(timestamp__gt=fjule_party(year - 1), timestamp__lte=fjule_party(year))
+        if product_ids is not None:
+            member_ids = list(sales.filter(product_id__in=product_ids).values_list('member_id', flat=True).distinct())
+            if not member_ids:
+                return
+            sales = sales.filter(member_id__in=member_ids)
+        entries = cls.objects.filter(year=year, category__isnull=False)
+        if category_ids is not None:
+            sales = sales.filter(product__categories__in=category_ids)
+            entries = entries.filter(category_id__in=category_ids)
+        else:
+            sales = sales.filter(product__categories__isnull=False)
+        if product_ids is not None:
+            entries = entries.filter(member_id__in=member_ids)
+
+        category_totals = (
+            sales.values_list('product__categories', 'member_id').annotate(Count('id'), Sum('price')).order_by()
+        )
+        entries.delete()
+        cls.objects.bulk_create(
+            [
+                cls(year=year, category_id=category_id, member_id=member_id, count=count, money=money_sum)
+                for category_id, member_id, count, money_sum in category_totals.iterator()
+            ],
+            batch_size=500,
+        )
+
+    @classmethod
+    def prepare_year(cls, year):
+        """
+        Makes sure the leaderboard of the year can be read. The first time a year is read it is summed up from the
+        sales, and the first time it is read after its fjuleparty it is summed up one last time and frozen.
+        """
+        leaderboard_year = LeaderboardYear.objects.filter(year=year).first()
+        if leaderboard_year is None or (not leaderboard_year.frozen and fjule_party(year) < timezone.now()):
+            cls.rebuild(year)
+
+    @classmethod
+    def top(cls, year, category_id, limit=10):
+        """The members who bought the most in the category, or spent the most if category_id is None."""
+        entries = cls.objects.filter(year=year, category_id=category_id, count__gt=0).select_related('member')
+        if category_id is None:
+            return entries.filter(member__active=True).order_by('-money', 'member__username')[:limit]
+        return entries.order_by('-count', 'member__username')[:limit]
 
 
 class Payment(BaseModel):  # id automatisk...
@@ -599,6 +1255,8 @@ class Product(BaseModel):  # id automatisk...
     rooms = models.ManyToManyField(Room, blank=True)
     alcohol_content_ml = models.FloatField(default=0.0, null=True)
     caffeine_content_mg = models.IntegerField(default=0)
+    # Sales since start_date, kept up to date by Order.execute and the Sale signals
+    sold_count = models.IntegerField(default=0, editable=False)
 
     @deprecated
     def __unicode__(self):
@@ -607,6 +1265,18 @@ class Product(BaseModel):  # id automatisk...
     def __str__(self):
         return active_str(self.active) + " " + self.name + " (" + money(self.price) + ")"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        product = super().from_db(db, field_names, values)
+        product._saved_stock = product._stock()
+        return product
+
+    def _stock(self):
+        deferred = self.get_deferred_fields()
+        if 'start_date' in deferred or 'quantity' in deferred:
+            return None
+        return self.start_date, self.quantity
+
     def save(self, *args, **kwargs):
         price_changed = True
         if self.id:
@@ -615,9 +1285,24 @@ class Product(BaseModel):  # id automatisk...
                 price_changed = oldprice != self.price
             except OldPrice.DoesNotExist:  # der findes varer hvor der ikke er nogen "tidligere priser"
                 pass
+        adding = self._state.adding
+        stock = self._stock()
+        stock_changed = stock is None or stock != getattr(self, '_saved_stock', None)
+        if not adding and not args and 'update_fields' not in kwargs and not kwargs.get('force_insert'):
+            # A product loaded before a sale was made would write back a counter that is out of date
+            skipped = {'sold_count'} | self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.attname
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in skipped
+            ]
         super(Product, self).save(*args, **kwargs)
+        self._saved_stock = stock
         if price_changed:
             OldPrice.objects.create(product=self, price=self.price)
+        # start_date decides which sales count. A new product has no sales yet.
+        if not adding and stock_changed:
+            self.recount_sold()
 
     @property
     def bought(self):
@@ -625,9 +1310,26 @@ class Product(BaseModel):  # id automatisk...
         # bought count - Jesper 27/09-2017
         if self.start_date is None:
             return 0
-        return self.sale_set.filter(timestamp__gt=date_to_midnight(self.start_date)).aggregate(bought=Count("id"))[
-            "bought"
-        ]
+        return self.sold_count
+
+    def counts_as_sold(self, timestamp):
+        return self.start_date is not None and timestamp > date_to_midnight(self.start_date)
+
+    def recount_sold(self):
+        """Rebuilds sold_count from the sales since start_date."""
+        if self.start_date is None:
+            Product.objects.filter(id=self.id).update(sold_count=0)
+            self.sold_count = 0
+            return
+        # Count in the UPDATE itself, so sales made meanwhile can't slip between counting and writing
+        sold = Subquery(
+            Sale.objects.filter(product=OuterRef('id'), timestamp__gt=date_to_midnight(self.start_date))
+            .values('product')
+            .annotate(c=Count('id'))
+            .values('c')
+        )
+        Product.objects.filter(id=self.id).update(sold_count=Coalesce(sold, 0))
+        self.sold_count = Product.objects.values_list('sold_count', flat=True).get(id=self.id)
 
     def is_active(self):
         expired = self.deactivate_date is not None and self.deactivate_date <= timezone.now()
@@ -702,6 +1404,12 @@ class Sale(BaseModel):
         index_together = [
             ["product", "timestamp"],
         ]
+        # For paging through the sales of a member, see stregsystem.pagination
+        indexes = [
+            models.Index(fields=["member", "timestamp", "id"], name="sale_member_timestamp_id_idx"),
+            # For finding who has been buying in a room lately, see stregsystem.board
+            models.Index(fields=["room", "timestamp"], name="sale_room_timestamp_idx"),
+        ]
 
         permissions = (("access_sales_reports", "Can access sales reports"),)
 
@@ -879,3 +1587,25 @@ class Theme(BaseModel):
 
     def __str__(self):
         return self.name
+
+
+class OutgoingMail(BaseModel):
+    """
+    A mail waiting to be sent by the sendqueuedmail command. It is written in the same transaction as whatever
+    caused it, so a rolled back payment or signup never sends its mail.
+    """
+
+    recipient = models.CharField(max_length=254)
+    subject = models.CharField(max_length=255, blank=True)
+    message = models.TextField()  # the whole MIME message, attachments and all
+    attempts = models.IntegerField(default=0)
+    # None once the mail is sent or given up on
+    next_attempt_at = models.DateTimeField(null=True, blank=True, default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta(BaseModel.Meta):
+        indexes = [models.Index(fields=["next_attempt_at"], name="outgoingmail_next_attempt_idx")]
+
+    def __str__(self):
+        return f"{self.recipient}: {self.subject}"
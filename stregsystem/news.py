@@ -0,0 +1,70 @@
+import random
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional
+
+from django.utils import timezone
+
+from stregsystem.models import CacheVersion, News
+
+NEWS_VERSION = "news"
+
+# How long a worker trusts its news before checking whether another worker has changed them
+NEWS_RECHECK_INTERVAL = timedelta(minutes=1)
+
+
+class ActiveNews(NamedTuple):
+    version: str
+    items: List[News]
+    expires_at: datetime
+    checked_at: datetime
+
+
+# Kept per worker, the shared CacheVersion tells us when another worker has changed the news.
+_active_news: Optional[ActiveNews] = None
+
+
+def get_random_news() -> Optional[News]:
+    items = get_active_news().items
+    return random.choice(items) if items else None
+
+
+def get_active_news() -> ActiveNews:
+    """
+    Returns the news that are published right now. They are loaded again when one of them is taken down or another
+    is published, and otherwise only checked against the shared version once in a while.
+    """
+    global _active_news
+    now = timezone.now()
+    news = _active_news
+
+    if news is not None and now < news.expires_at:
+        if now - news.checked_at < NEWS_RECHECK_INTERVAL:
+            return news
+        version = CacheVersion.current(NEWS_VERSION)
+        if version == news.version:
+            _active_news = news._replace(checked_at=now)
+            return _active_news
+    else:
+        version = CacheVersion.current(NEWS_VERSION)
+
+    _active_news = _load_active_news(version, now)
+    return _active_news
+
+
+def invalidate_news():
+    global _active_news
+    _active_news = None
+    CacheVersion.bump(NEWS_VERSION)
+
+
+def _load_active_news(version: str, now: datetime) -> ActiveNews:
+    items = []
+    # Reload at the next boundary even if nothing is published or taken down before then
+    expires_at = now + timedelta(days=1)
+    for news in News.objects.filter(stop_date__gte=now).order_by('id'):
+        if news.pub_date <= now:
+            items.append(news)
+            expires_at = min(expires_at, news.stop_date)
+        else:
+            expires_at = min(expires_at, news.pub_date)
+    return ActiveNews(version, items, expires_at, now)
@@ -0,0 +1,82 @@
+import datetime
+from typing import List, NamedTuple, Optional
+
+from django.db.models import Q
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(sale) -> str:
+    """A cursor pointing at the sale, as microseconds since the epoch and the id of the sale."""
+    return make_cursor(sale.timestamp, sale.id)
+
+
+def make_cursor(timestamp: datetime.datetime, sale_id: int) -> str:
+    return f"{(timestamp - EPOCH) // datetime.timedelta(microseconds=1)}_{sale_id}"
+
+
+def decode_cursor(cursor: str):
+    try:
+        microseconds, sale_id = cursor.split("_")
+        return EPOCH + datetime.timedelta(microseconds=int(microseconds)), int(sale_id)
+    except (ValueError, OverflowError):
+        raise InvalidCursor(cursor)
+
+
+class KeysetPage(NamedTuple):
+    items: List
+    # Cursors of the first and last item, to fetch the page before or after this one
+    newer_cursor: Optional[str]
+    older_cursor: Optional[str]
+
+    @property
+    def has_newer(self):
+        return self.newer_cursor is not None
+
+    @property
+    def has_older(self):
+        return self.older_cursor is not None
+
+
+def keyset_page(sales, size, older_than=None, newer_than=None) -> KeysetPage:
+    """
+    Returns a page of the sales, newest first, seeking past a cursor on (timestamp, id) instead of counting and
+    skipping the sales before the page. A deep page costs the same as the first one.
+    Raises InvalidCursor if a cursor can't be read.
+    """
+    items = list(seek(sales, older_than, newer_than)[: size + 1])
+    if newer_than is not None:
+        has_newer, has_older = len(items) > size, True
+        items = items[:size][::-1]
+    else:
+        has_newer, has_older = older_than is not None, len(items) > size
+        items = items[:size]
+
+    if not items:
+        return KeysetPage(items, None, None)
+    return KeysetPage(
+        items,
+        encode_cursor(items[0]) if has_newer else None,
+        encode_cursor(items[-1]) if has_older else None,
+    )
+
+
+def seek(sales, older_than=None, newer_than=None):
+    """
+    Orders the sales away from a cursor: the sales newer than `newer_than`, oldest first, or otherwise the sales older
+    than `older_than`, newest first. Without a cursor that is all of the sales, newest first.
+    Raises InvalidCursor if the cursor can't be read.
+    """
+    if newer_than is not None:
+        timestamp, sale_id = decode_cursor(newer_than)
+        return sales.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=sale_id)).order_by(
+            'timestamp', 'id'
+        )
+    if older_than is not None:
+        timestamp, sale_id = decode_cursor(older_than)
+        sales = sales.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=sale_id))
+    return sales.order_by('-timestamp', '-id')
@@ -13,6 +13,11 @@ class QuickBuyParseError(Exception):
 
 _item_matcher = re.compile(r'(?P<productId>\d+)(?::(?P<count>\d+))?$')
 
+# The most units a single buy string may ask for, checked before anything is done with the counts
+MAX_UNITS_PER_BUY = 1000
+# Product ids are 32 bit integers
+_MAX_ID_DIGITS = 10
+
 
 def get_token_indexes(string, start_index):
     start, end = (-1, -1)
@@ -44,24 +49,34 @@ def username(buy_string, start_index):
         raise QuickBuyError(buy_string[0:start_index], buy_string[start_index : len(buy_string)])
     username = buy_string[start:end]
 
-    # Parse items
-    product_lists = []
+    # Parse items, adding up the count of each product in the order they were first seen
+    product_counts = {}
+    units = 0
     while end != len(buy_string):
         prev_start, prev_end = start, end
         start, end = get_token_indexes(buy_string, end)
         if start == -1:
             raise QuickBuyError(buy_string[0:prev_end], buy_string[prev_end : len(buy_string)])
         try:
-            product_lists.append(item(buy_string[start:end]))
+            product_id, count = item(buy_string[start:end])
         except QuickBuyParseError:
             raise QuickBuyError(buy_string[0:start], buy_string[start : len(buy_string)])
+        units += count
+        if units > MAX_UNITS_PER_BUY:
+            raise QuickBuyError(buy_string[0:start], buy_string[start : len(buy_string)])
+        if count > 0:
+            product_counts[product_id] = product_counts.get(product_id, 0) + count
 
-    return username, [product for product_list in product_lists for product in product_list]
+    return username, list(product_counts.items())
 
 
 def item(token):
+    """Parses a single item into a (product id, count) pair."""
     match = _item_matcher.fullmatch(token)
-    if match:
-        return [int(match.group('productId'))] * (int(match.group('count') or 1))
-    else:
+    if not match:
+        raise QuickBuyParseError
+    product_id, count = match.group('productId'), match.group('count') or '1'
+    # Don't even turn absurdly long numbers into ints
+    if len(product_id) > _MAX_ID_DIGITS or len(count.lstrip('0')) > len(str(MAX_UNITS_PER_BUY)):
         raise QuickBuyParseError
+    return int(product_id), int(count)
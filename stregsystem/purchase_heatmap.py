@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta, date
-from typing import List, NamedTuple, Tuple
+from typing import Callable, List, NamedTuple, Tuple
 
-from stregsystem.models import Product, Member, Category
+from stregsystem.models import DailySales, Member
 from stregsystem.templatetags.stregsystem_extras import money
 
 
@@ -12,6 +12,25 @@ class HeatmapDay(NamedTuple):
     summary: List[str]
 
 
+class HeatmapColumns(NamedTuple):
+    """The sales of a member as one column per measure, each with an entry per day starting with the last day."""
+
+    dates: List[date]
+    counts: List[int]
+    money: List[int]
+    color_counts: List[Tuple[int, int, int]]
+    product_ids: List[List[int]]
+
+
+GREY = (235, 237, 240)
+
+
+def map_distinct(values: list, function: Callable) -> list:
+    """Applies function to every value, but only calls it once for each distinct value."""
+    results = {}
+    return [results[value] if value in results else results.setdefault(value, function(value)) for value in values]
+
+
 class HeatmapColorMode(object):
     def __init__(self, mode_name: str, mode_description: str):
         # The ID to look up a description for in purchase_heatmap template.
@@ -21,38 +40,35 @@ class HeatmapColorMode(object):
         self.mode_description = mode_description
         pass
 
-    def get_day_color(self, products: List[Product]) -> Tuple[int, int, int]:
-        """Returns the color of a particular day given the products bought on that day."""
+    def get_day_colors(self, columns: HeatmapColumns) -> List[Tuple[int, int, int]]:
+        """Returns the color of every day given the sales of the days."""
         pass
 
-    def get_day_summary(self, products: List[Product]) -> str:
-        """Returns a summary of the day, e.g. amount of money used, or product count."""
+    def get_day_summaries(self, columns: HeatmapColumns) -> List[str]:
+        """Returns a summary of every day, e.g. amount of money used, or product count."""
         pass
 
 
+def item_count_summary(count: int) -> str:
+    return f"{count} {'vare' if count == 1 else 'varer'} købt"
+
+
 class ColorCategorizedHeatmapColorMode(HeatmapColorMode):
-    products_by_color: Tuple[List[int], List[int], List[int]]
     max_items_day: int
 
-    def __init__(self, max_items_day: int, products_by_color: Tuple[List[int], List[int], List[int]]):
+    def __init__(self, max_items_day: int):
         self.max_items_day = max_items_day
-        self.products_by_color = products_by_color
         super().__init__(mode_name="ColorCategorized", mode_description="Med kategorier")
 
-    def get_day_color(self, products: List[Product]) -> Tuple[int, int, int]:
-        category_representation = [0, 0, 0]
-
-        for product in products:
-            for category_products_index in range(3):
-                if product.id in self.products_by_color[category_products_index]:
-                    category_representation[category_products_index] = (
-                        category_representation[category_products_index] + 1
-                    )
+    def get_day_colors(self, columns: HeatmapColumns) -> List[Tuple[int, int, int]]:
+        return map_distinct(columns.color_counts, self.get_color)
 
+    @staticmethod
+    def get_color(category_representation: Tuple[int, int, int]) -> Tuple[int, int, int]:
         total_category_sum = sum(category_representation)
 
         if total_category_sum == 0:
-            return 235, 237, 240  # Grey
+            return GREY
 
         red = 70 + (category_representation[0] / total_category_sum) * 185
         green = 70 + (category_representation[1] / total_category_sum) * 185
@@ -60,14 +76,8 @@ class ColorCategorizedHeatmapColorMode(HeatmapColorMode):
 
         return red, green, blue
 
-    def get_day_summary(self, products: List[Product]) -> str:
-        return f"{len(products)} {'vare' if len(products) == 1 else 'varer'} købt"
-
-    @staticmethod
-    def get_products_by_categories(category_name_color: Tuple[str, str, str]) -> Tuple[List[int], List[int], List[int]]:
-        return tuple(
-            Category.objects.filter(name=category).values_list("product", flat=True) for category in category_name_color
-        )
+    def get_day_summaries(self, columns: HeatmapColumns) -> List[str]:
+        return map_distinct(columns.counts, item_count_summary)
 
 
 class ItemCountHeatmapColorMode(HeatmapColorMode):
@@ -77,25 +87,19 @@ class ItemCountHeatmapColorMode(HeatmapColorMode):
         self.max_items_day = max_items_day
         super().__init__(mode_name="ItemCount", mode_description="Antal")
 
-    def get_day_color(self, products: List[Product]) -> Tuple[int, int, int]:
-        if len(products) == 0 or self.max_items_day == 0:
-            return 235, 237, 240  # Grey
-
-        lerp_value = len(products) / self.max_items_day
-
-        return lerp_color((144, 238, 144), (0, 100, 0), lerp_value)  # Lightgreen - Darkgreen
+    def get_day_colors(self, columns: HeatmapColumns) -> List[Tuple[int, int, int]]:
+        return map_distinct(columns.counts, self.get_color)
 
-    def get_day_summary(self, products: List[Product]) -> str:
-        return f"{len(products)} {'vare' if len(products) == 1 else 'varer'} købt"
+    def get_color(self, count: int) -> Tuple[int, int, int]:
+        if count == 0 or self.max_items_day == 0:
+            return GREY
 
-    @staticmethod
-    def get_max_product_count(day_list: List[Tuple[date, List[Product]]]) -> int:
-        max_day_items = 0
+        lerp_value = count / self.max_items_day
 
-        for day_date, product_list in day_list:
-            max_day_items = max(max_day_items, len(product_list))
+        return lerp_color((144, 238, 144), (0, 100, 0), lerp_value)  # Lightgreen - Darkgreen
 
-        return max_day_items
+    def get_day_summaries(self, columns: HeatmapColumns) -> List[str]:
+        return map_distinct(columns.counts, item_count_summary)
 
 
 class MoneySumHeatmapColorMode(HeatmapColorMode):
@@ -105,47 +109,36 @@ class MoneySumHeatmapColorMode(HeatmapColorMode):
         self.max_money_day_oere = max_money_day_oere
         super().__init__(mode_name="MoneySum", mode_description="Penge brugt")
 
-    def get_day_color(self, products: List[Product]) -> Tuple[int, int, int]:
-        if len(products) == 0 or self.max_money_day_oere == 0:
-            return 235, 237, 240  # Grey
+    def get_day_colors(self, columns: HeatmapColumns) -> List[Tuple[int, int, int]]:
+        return map_distinct(columns.money, self.get_color)
 
-        day_sum = sum(p.price for p in products)
-        lerp_value = day_sum / self.max_money_day_oere
+    def get_color(self, money_oere: int) -> Tuple[int, int, int]:
+        if money_oere == 0 or self.max_money_day_oere == 0:
+            return GREY
 
-        return lerp_color((255, 255, 200), (255, 255, 0), lerp_value)  # Lightyellow - Yellow
+        lerp_value = money_oere / self.max_money_day_oere
 
-    def get_day_summary(self, products: List[Product]) -> str:
-        return f"{money(sum(p.price for p in products))} 𝓕$ brugt"
-
-    @staticmethod
-    def get_products_money_sum(day_list: List[Tuple[date, List[Product]]]) -> int:
-        max_product_sum = 0
-
-        for day_date, product_list in day_list:
-            max_product_sum = max(max_product_sum, sum(product.price for product in product_list))
+        return lerp_color((255, 255, 200), (255, 255, 0), lerp_value)  # Lightyellow - Yellow
 
-        return max_product_sum
+    def get_day_summaries(self, columns: HeatmapColumns) -> List[str]:
+        return map_distinct(columns.money, lambda money_oere: f"{money(money_oere)} 𝓕$ brugt")
 
 
 def prepare_heatmap_template_context(member: Member, weeks_to_display: int, end_date: datetime.date) -> dict:
     """Prepares the context required to successfully load purchase_heatmap.html rendering template."""
-    __raw_heatmap_data = __get_heatmap_data_by_date(member, end_date, weeks_to_display)
-
-    __products_in_color_categories = ColorCategorizedHeatmapColorMode.get_products_by_categories(
-        ("Øl", "Energidrik", "Sodavand")
-    )
+    columns = get_heatmap_columns(member, end_date, weeks_to_display)
 
-    __max_items_bought = ItemCountHeatmapColorMode.get_max_product_count(__raw_heatmap_data)
+    __max_items_bought = max(columns.counts, default=0)
 
     # Default heatmap modes.
     heatmap_modes = [
         ItemCountHeatmapColorMode(__max_items_bought),
-        MoneySumHeatmapColorMode(MoneySumHeatmapColorMode.get_products_money_sum(__raw_heatmap_data)),
-        ColorCategorizedHeatmapColorMode(__max_items_bought, __products_in_color_categories),
+        MoneySumHeatmapColorMode(max(columns.money, default=0)),
+        ColorCategorizedHeatmapColorMode(__max_items_bought),
     ]
-    __reorganized_heatmap_data = __convert_purchase_data_to_heatmap_day(__raw_heatmap_data, heatmap_modes)
+    __heatmap_days = __convert_columns_to_heatmap_days(columns, heatmap_modes)
 
-    column_labels, rows = get_heatmap_graph_data(weeks_to_display, __reorganized_heatmap_data, end_date)
+    column_labels, rows = get_heatmap_graph_data(weeks_to_display, __heatmap_days, end_date)
 
     return {"column_labels": column_labels, "rows": rows, "heatmap_modes": heatmap_modes}
 
@@ -163,55 +156,45 @@ def get_heatmap_graph_data(
     return column_labels, rows
 
 
-def __convert_purchase_data_to_heatmap_day(
-    products_by_date: List[Tuple[date, List[Product]]], heatmap_modes: List[HeatmapColorMode]
+def __convert_columns_to_heatmap_days(
+    columns: HeatmapColumns, heatmap_modes: List[HeatmapColorMode]
 ) -> List[HeatmapDay]:
-    days = []
+    day_colors = zip(*(color_mode.get_day_colors(columns) for color_mode in heatmap_modes))
+    day_summaries = zip(*(color_mode.get_day_summaries(columns) for color_mode in heatmap_modes))
 
-    for day_index in range(len(products_by_date)):
-        day_date, product_list = products_by_date[day_index]
-        day_colors = [color_mode.get_day_color(product_list) for color_mode in heatmap_modes]
-        day_summaries = [color_mode.get_day_summary(product_list) for color_mode in heatmap_modes]
-
-        days.append(HeatmapDay(day_date, [product.id for product in product_list], day_colors, day_summaries))
-
-    return days
+    return [
+        HeatmapDay(day_date, product_ids, list(colors), list(summaries))
+        for day_date, product_ids, colors, summaries in zip(
+            columns.dates, columns.product_ids, day_colors, day_summaries
+        )
+    ]
 
 
-def __get_heatmap_data_by_date(
-    member: Member,
-    end_date: datetime.date,
-    weeks_to_display: int,
-) -> List[Tuple[date, List[Product]]]:
-    # add a day
-    end_date += timedelta(days=1)
+def get_heatmap_columns(member: Member, end_date: datetime.date, weeks_to_display: int) -> HeatmapColumns:
+    """
+    Reads the days of the heatmap from the daily sales, so a year costs a few hundred small rows
+    no matter how much the member has bought.
+    """
+    # The rows start on sunday, so the last column only goes up to end_date
+    days_to_display = (7 * weeks_to_display) - (6 - (end_date + timedelta(days=1)).weekday())
+    dates = [end_date - timedelta(days=n) for n in range(days_to_display)]
 
-    days_to_go_back = (7 * weeks_to_display) - (6 - end_date.weekday() - 1)
-    cutoff_date = end_date - timedelta(days=days_to_go_back)
+    counts = [0] * days_to_display
+    money_oere = [0] * days_to_display
+    color_counts = [(0, 0, 0)] * days_to_display
+    product_ids = [[] for _ in range(days_to_display)]
 
-    last_sale_list = list(
-        member.sale_set.filter(timestamp__gte=cutoff_date, timestamp__lte=end_date)
-        .select_related('product')
-        .order_by('-timestamp')
+    days = DailySales.objects.filter(member=member, date__gte=dates[-1], date__lte=end_date).values_list(
+        'date', 'count', 'money', 'beer_count', 'energy_drink_count', 'soda_count', 'product_counts'
     )
-
-    products_by_day = []
-    dates_by_day = []
-
-    sale_index = 0
-    for single_date in (end_date - timedelta(days=n) for n in range(days_to_go_back)):
-        products_by_day.append([])
-        dates_by_day.append(single_date)
-
-        while sale_index < len(last_sale_list) and last_sale_list[sale_index].timestamp.date() == single_date:
-            products_by_day[-1].append(last_sale_list[sale_index].product)
-            sale_index += 1
-
-    # remove added day
-    products_by_day.pop(0)
-    dates_by_day.pop(0)
-
-    return list(zip(dates_by_day, products_by_day))
+    for day_date, count, day_money, beer_count, energy_drink_count, soda_count, product_counts in days:
+        day_index = (end_date - day_date).days
+        counts[day_index] = count
+        money_oere[day_index] = day_money
+        color_counts[day_index] = (beer_count, energy_drink_count, soda_count)
+        product_ids[day_index] = DailySales.expand_product_counts(product_counts)
+
+    return HeatmapColumns(dates, counts, money_oere, color_counts, product_ids)
 
 
 def __organize_heatmap_data_by_weekdays(heatmap_data: list) -> list:
@@ -0,0 +1,74 @@
+from typing import Dict, NamedTuple
+
+from django.db import connection
+from django.db.models import Count, F, Window
+from django.db.models.functions import Rank
+
+from stregsystem.models import LeaderboardEntry, Sale
+
+
+class CategoryRank(NamedTuple):
+    # 0 when the member hasn't bought anything in the category
+    rank: int
+    participants: int
+    count: int
+
+
+def category_ranks(member_id, from_time, to_time) -> Dict[int, CategoryRank]:
+    """
+    Ranks the member in every category with sales between from_time and to_time, by number of items bought and then
+    by username. All categories are ranked with RANK() in the same query, instead of a ranking query per category.
+    """
+    ranked = (
+        Sale.objects.filter(timestamp__gt=from_time, timestamp__lte=to_time, product__categories__isnull=False)
+        .values(
+            category_id=F('product__categories'),
+            ranked_member_id=F('member_id'),
+            ranked_username=F('member__username'),
+        )
+        .annotate(
+            sale_count=Count('id'),
+            sale_rank=Window(
+                Rank(), partition_by=F('product__categories'), order_by=[Count('id').desc(), F('member__username')]
+            ),
+            participants=Window(Count('member_id'), partition_by=F('product__categories')),
+        )
+        .order_by()
+    )
+    return _member_ranks(ranked, member_id)
+
+
+def leaderboard_category_ranks(year, member_id) -> Dict[int, CategoryRank]:
+    """Like category_ranks for a whole fjule year, but ranked from the leaderboard of the year instead of the sales."""
+    LeaderboardEntry.prepare_year(year)
+    ranked = (
+        LeaderboardEntry.objects.filter(year=year, category__isnull=False, count__gt=0)
+        .values('category_id', ranked_member_id=F('member_id'), sale_count=F('count'))
+        .annotate(
+            sale_rank=Window(Rank(), partition_by=F('category'), order_by=[F('count').desc(), F('member__username')]),
+            participants=Window(Count('member_id'), partition_by=F('category')),
+        )
+        .order_by()
+    )
+    return _member_ranks(ranked, member_id)
+
+
+def _member_ranks(ranked, member_id) -> Dict[int, CategoryRank]:
+    sql, params = ranked.query.sql_with_params()
+
+    # Django can't filter on a window function yet, so pick out the member from the ranking in SQL
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT category_id, MAX(participants),
+                   MAX(CASE WHEN ranked_member_id = %s THEN sale_rank ELSE 0 END),
+                   MAX(CASE WHEN ranked_member_id = %s THEN sale_count ELSE 0 END)
+            FROM ({sql}) ranked
+            GROUP BY category_id
+            """,
+            (member_id, member_id, *params),
+        )
+        return {
+            category_id: CategoryRank(rank, participants, count)
+            for category_id, participants, rank, count in cursor.fetchall()
+        }
@@ -0,0 +1,53 @@
+import datetime
+from typing import Optional
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from stregsystem.models import RateLimit
+
+
+class RateLimiter(object):
+    """
+    Lets an action be done at most `limit` times per `period` for each subject, such as a member, counted in the
+    database so every worker sees the same count. Windows that have run out are deleted as new ones begin, so the
+    table only holds the subjects that have acted lately.
+    """
+
+    def __init__(self, action: str, limit: int, period: datetime.timedelta):
+        self.action = action
+        self.limit = limit
+        self.period = period
+
+    def hit(self, subject) -> Optional[datetime.datetime]:
+        """
+        Counts the action for the subject. Returns None if it may go ahead, or otherwise when it may be done again.
+        """
+        key = f"{self.action}:{subject}"
+        now = timezone.now()
+        limits = RateLimit.objects.filter(key=key)
+
+        if limits.filter(window_ends__gt=now, count__lt=self.limit).update(count=F('count') + 1):
+            return None
+        if limits.filter(window_ends__lte=now).update(count=1, window_ends=now + self.period):
+            return None
+        try:
+            with transaction.atomic():
+                RateLimit.objects.create(key=key, count=1, window_ends=now + self.period)
+        except IntegrityError:
+            # The window is full, unless it ran out since we looked
+            window_ends = limits.values_list('window_ends', flat=True).first()
+            return window_ends if window_ends is not None and window_ends > now else None
+
+        RateLimit.objects.filter(window_ends__lte=now).delete()
+        return None
+
+    def reset(self, subject):
+        RateLimit.objects.filter(key=f"{self.action}:{subject}").delete()
+
+
+# Exporting the history of a member is expensive, and mails it to them
+userdata_limiter = RateLimiter("userdata", limit=1, period=datetime.timedelta(minutes=5))
+# Drawing a QR code is cheap, but anyone can ask for as many as they like
+payment_qr_limiter = RateLimiter("payment_qr", limit=30, period=datetime.timedelta(minutes=1))
@@ -0,0 +1,91 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Optional
+
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+def commit_batch(orders) -> List[tuple]:
+    """
+    Executes the orders in a single transaction. Each order still runs in its own savepoint, so an order failing
+    with stregforbud or out of stock is rolled back without touching the others.
+    Returns a (new balance, exception) pair for each order.
+    """
+    results = []
+    with transaction.atomic():
+        for order in orders:
+            try:
+                results.append((order.execute(), None))
+            except Exception as e:
+                results.append((None, e))
+    return results
+
+
+class SaleWriter(object):
+    """
+    Commits the orders of concurrent requests together, so a burst of sales takes SQLite's write lock once per
+    batch instead of once per order. Orders queue up while the previous batch commits, so a lone order doesn't wait.
+    """
+
+    def __init__(self, max_batch=20, commit=commit_batch):
+        self.max_batch = max_batch
+        self.commit = commit
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def execute(self, order):
+        """Queues the order, and returns or raises whatever order.execute() did once its batch is committed."""
+        self._ensure_started()
+        future = Future()
+        self.queue.put((order, future))
+        return future.result()
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="sale-writer", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            results = self.commit([order for order, future in batch])
+        except Exception as e:
+            # The whole batch failed to commit, so every caller gets the error
+            logger.exception("Could not commit a batch of %d orders", len(batch))
+            connection.close()
+            for order, future in batch:
+                future.set_exception(e)
+            return
+
+        for (order, future), (result, error) in zip(batch, results):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_sale_writer: Optional[SaleWriter] = None
+_sale_writer_lock = threading.Lock()
+
+
+def get_sale_writer() -> SaleWriter:
+    global _sale_writer
+    with _sale_writer_lock:
+        if _sale_writer is None:
+            _sale_writer = SaleWriter()
+        return _sale_writer
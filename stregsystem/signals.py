@@ -1,6 +1,11 @@
+import datetime
+
 from django.db.models.signals import post_save
 from django.db.models import F
 from django.dispatch import receiver
+from django.utils import timezone
+
+from stregsystem.caffeine import CAFFEINE_TIME_INTERVAL
 
 
 def after_member_save(sender, instance, created, **kwargs):
@@ -22,3 +27,229 @@ def after_pending_signup_save(sender, instance, created, **kwargs):
 
     if instance.status == ApprovalModel.APPROVED and instance.member.signup_due_paid:
         instance.delete()
+
+
+def after_catalog_change(sender, **kwargs):
+    if kwargs.get('action', '').startswith('pre_'):
+        return
+
+    from stregsystem.catalog import invalidate_catalog
+
+    invalidate_catalog()
+
+
+def after_product_save(sender, instance, raw, **kwargs):
+    # Fixtures bypass Product.save, which normally keeps the sold counter right
+    if raw:
+        instance.recount_sold()
+
+
+def after_sale_save(sender, instance, created, raw, **kwargs):
+    product = instance.product
+    if not product.counts_as_sold(instance.timestamp):
+        return
+
+    if raw:
+        # A fixture may overwrite a sale we already counted, so count from scratch
+        product.recount_sold()
+    elif created:
+        from stregsystem.models import Product
+
+        Product.objects.filter(id=product.id).update(sold_count=F('sold_count') + 1)
+        product.sold_count += 1
+
+    # Selling a limited product can sell it out
+    from stregsystem.catalog import invalidate_catalog
+
+    invalidate_catalog()
+
+
+def after_sale_delete(sender, instance, **kwargs):
+    product = instance.product
+    if not product.counts_as_sold(instance.timestamp):
+        return
+
+    from stregsystem.models import Product
+
+    Product.objects.filter(id=product.id).update(sold_count=F('sold_count') - 1)
+    product.sold_count -= 1
+
+    # Refunding a limited product can bring it back in stock
+    from stregsystem.catalog import invalidate_catalog
+
+    invalidate_catalog()
+
+
+def after_coffee_sale_save(sender, instance, created, raw, **kwargs):
+    from stregsystem.models import WeeklyCoffeeCount
+
+    # Fixtures are counted by running rebuildcoffeeleaderboard after loading them
+    if raw:
+        return
+    if created and WeeklyCoffeeCount.coffee_product_ids([instance.product_id]):
+        WeeklyCoffeeCount.add(instance.member_id, instance.timestamp, 1)
+
+
+def after_coffee_sale_delete(sender, instance, **kwargs):
+    from stregsystem.models import WeeklyCoffeeCount
+
+    if WeeklyCoffeeCount.coffee_product_ids([instance.product_id]):
+        WeeklyCoffeeCount.add(instance.member_id, instance.timestamp, -1)
+
+
+def after_product_categories_change(sender, instance, action, reverse, pk_set, **kwargs):
+    # Sales of a product that just became coffee, or stopped being it, have to be recounted
+    if action.startswith('pre_'):
+        return
+
+    from stregsystem.models import Sale, WeeklyCoffeeCount
+
+    if reverse:
+        if instance.id != WeeklyCoffeeCount.COFFEE_CATEGORY_ID:
+            return
+        product_ids = pk_set
+    else:
+        # A cleared product may have been coffee, we can't tell any more
+        if pk_set is not None and WeeklyCoffeeCount.COFFEE_CATEGORY_ID not in pk_set:
+            return
+        product_ids = [instance.id]
+
+    # Only this week is counted, so nothing changes unless the products were sold since it began
+    week_start = WeeklyCoffeeCount.week_start_of(timezone.now())
+    if product_ids is None or Sale.objects.filter(product_id__in=product_ids, timestamp__gte=week_start).exists():
+        WeeklyCoffeeCount.rebuild()
+
+
+def after_daily_sale_save(sender, instance, created, raw, **kwargs):
+    from stregsystem.models import DailySales
+
+    # Fixtures are summed up by running rebuilddailysales after loading them
+    if raw:
+        return
+    if created:
+        DailySales.add(instance.member_id, instance.timestamp, [(instance.product_id, instance.price, 1)])
+
+
+def after_daily_sale_delete(sender, instance, **kwargs):
+    from stregsystem.models import DailySales
+
+    DailySales.add(instance.member_id, instance.timestamp, [(instance.product_id, instance.price, -1)])
+
+
+def after_product_colors_change(sender, instance, action, reverse, pk_set, **kwargs):
+    # The colour counts of the days the product was sold on are wrong if it moved in or out of a colour category
+    if action.startswith('pre_'):
+        return
+
+    from django.conf import settings
+    from stregsystem.models import Category, DailySales
+
+    if reverse:
+        # pk_set is None if the category was cleared, and then any of its products may have moved
+        category_names = [instance.name]
+        product_ids = pk_set
+    else:
+        # pk_set is None if the product was cleared, and then any category may have been a colour one
+        category_names = (
+            DailySales.COLOR_CATEGORIES
+            if pk_set is None
+            else Category.objects.filter(id__in=pk_set).values_list('name', flat=True)
+        )
+        product_ids = [instance.id]
+
+    if any(name in DailySales.COLOR_CATEGORIES for name in category_names):
+        # Only the heatmap uses the colours, so older days are left for rebuilddailysales
+        since = timezone.localdate() - datetime.timedelta(weeks=settings.STREGSYSTEM_HEATMAP_WEEKS)
+        DailySales.recolor(product_ids, since=since)
+
+
+def after_leaderboard_sale_save(sender, instance, created, raw, **kwargs):
+    from stregsystem.models import LeaderboardEntry
+
+    # Fixtures are summed up when the year is read, or by running rebuildleaderboard
+    if raw:
+        return
+    if created:
+        LeaderboardEntry.add(instance.member_id, instance.timestamp, [(instance.product_id, instance.price, 1)])
+
+
+def after_leaderboard_sale_delete(sender, instance, **kwargs):
+    from stregsystem.models import LeaderboardEntry
+
+    LeaderboardEntry.add(instance.member_id, instance.timestamp, [(instance.product_id, instance.price, -1)])
+
+
+def after_product_leaderboard_categories_change(sender, instance, action, reverse, pk_set, **kwargs):
+    # The category leaderboards of the ongoing year are wrong once a product moves between categories.
+    # Years that are over stay as they were when they were frozen.
+    if action.startswith('pre_'):
+        return
+
+    from stregsystem.models import LeaderboardEntry, LeaderboardYear
+    from stregsystem.utils import fjule_year_of
+
+    # pk_set is None when cleared, which leaves us not knowing the products or categories
+    if reverse:
+        category_ids, product_ids = [instance.id], pk_set
+    else:
+        category_ids, product_ids = pk_set, [instance.id]
+    if (category_ids is not None and not category_ids) or (product_ids is not None and not product_ids):
+        return
+
+    year = fjule_year_of(timezone.now())
+    if LeaderboardYear.objects.filter(year=year).exists():
+        LeaderboardEntry.recount_categories(year, category_ids, product_ids)
+
+
+def after_member_totals_sale_save(sender, instance, created, raw, **kwargs):
+    from stregsystem.models import Member
+
+    if raw:
+        # A fixture may overwrite a sale we already counted, so count from scratch
+        instance.member.recount_totals()
+    elif created:
+        Member.add_to_totals(instance.member_id, 1, instance.price)
+
+
+def after_member_totals_sale_delete(sender, instance, **kwargs):
+    from stregsystem.models import Member
+
+    Member.add_to_totals(instance.member_id, -1, -instance.price)
+
+
+def after_intake_sale_save(sender, instance, created, raw, **kwargs):
+    from stregsystem.models import IntakeState
+
+    if raw:
+        # A fixture may put sales anywhere on the timeline, so build the state again when it is read
+        IntakeState.forget(member_id=instance.member_id)
+    elif created:
+        product = instance.product
+        IntakeState.add(
+            instance.member, [(instance.timestamp, product.alcohol_content_ml, product.caffeine_content_mg)]
+        )
+
+
+def after_intake_sale_delete(sender, instance, **kwargs):
+    from stregsystem.models import IntakeState
+
+    # Built again from the remaining sales when read. Not right away, the member may be on their way out too.
+    IntakeState.forget(member_id=instance.member_id)
+
+
+def after_intake_product_save(sender, instance, created, raw, **kwargs):
+    if created:
+        return
+
+    from stregsystem.models import IntakeState
+
+    # The alcohol or caffeine of the product may have changed, for everyone who has it in their body
+    IntakeState.forget(
+        member__sale__product_id=instance.id, member__sale__timestamp__gt=timezone.now() - CAFFEINE_TIME_INTERVAL
+    )
+
+
+def after_news_change(sender, **kwargs):
+    from stregsystem.news import invalidate_news
+
+    invalidate_news()
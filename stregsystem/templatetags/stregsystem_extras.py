@@ -28,24 +28,15 @@ def multiply(value, arg):
 
 @register.filter
 def product_id_and_alias_string(product_id):
-    from stregsystem.models import NamedProduct
-    from random import choice
+    from stregsystem.catalog import loaded_alias_index
 
     # get aliases for id
-    aliases = NamedProduct.objects.filter(product__exact=product_id)
-
-    if aliases.exists():
-        res = str(product_id) + " / "
-        if aliases.count() > 1:
-            # pick random alias
-
-            alias: NamedProduct = choice(aliases)
-            return res + str(alias)
-        else:
-            # else we've got one alias
-            return res + str(aliases.first())
+    aliases = loaded_alias_index().aliases.get(product_id)
+
+    if aliases:
+        # pick random alias if there is more than one
+        return str(product_id) + " / " + choice(aliases)
     else:
-        #
         return str(product_id)
 
 
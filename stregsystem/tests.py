@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 import datetime
 import json
+import socketserver
+import threading
 from collections import Counter
 from copy import deepcopy
+from io import StringIO
+import io
+import zipfile
 from unittest import mock
 from unittest.mock import patch, MagicMock
 
@@ -13,19 +18,36 @@ from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from django.contrib.admin.sites import AdminSite
 from django.contrib.messages import get_messages
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
 from django.forms import model_to_dict
+from django.http import HttpRequest
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from freezegun import freeze_time
 from stregreport import views
 from stregsystem import admin
+from stregsystem import board as stregsystem_board
+from stregsystem import catalog as stregsystem_catalog
 from stregsystem import views as stregsystem_views
 from stregsystem.admin import CategoryAdmin, ProductAdmin, MemberForm, MemberAdmin
-from stregsystem.booze import ballmer_peak
-from stregsystem.caffeine import CAFFEINE_DEGRADATION_PR_HOUR, CAFFEINE_IN_COFFEE
+from stregsystem.board import BOARD_REFRESH_INTERVAL, RoomBoard, compute_room_board, get_room_board
+from stregsystem.booze import Gender, alcohol_bac_timeline, ballmer_peak
+from stregsystem.catalog import get_alias_index, get_room_catalog
+from stregsystem.caffeine import (
+    CAFFEINE_DEGRADATION_PR_HOUR,
+    CAFFEINE_IN_COFFEE,
+    CAFFEINE_TIME_INTERVAL,
+    Intake,
+    current_caffeine_in_body_compound_interest,
+)
 from stregsystem.models import (
     Category,
+    DailySales,
+    LeaderboardEntry,
+    LeaderboardYear,
     GetTransaction,
     Member,
     NoMoreInventoryError,
@@ -39,21 +61,50 @@ from stregsystem.models import (
     StregForbudError,
     active_str,
     price_display,
+    IntakeState,
     MobilePayment,
+    OutgoingMail,
     PendingSignup,
+    RateLimit,
     NamedProduct,
     ApprovalModel,
     ProductNote,
+    WeeklyCoffeeCount,
+    CacheVersion,
+    News,
+)
+from stregsystem.pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_page
+from stregsystem.news import NEWS_RECHECK_INTERVAL, NEWS_VERSION, get_active_news, get_random_news, invalidate_news
+from stregsystem.purchase_heatmap import (
+    ColorCategorizedHeatmapColorMode,
+    ItemCountHeatmapColorMode,
+    MoneySumHeatmapColorMode,
+    get_heatmap_columns,
+    prepare_heatmap_template_context,
 )
-from stregsystem.purchase_heatmap import prepare_heatmap_template_context
-from stregsystem.templatetags.stregsystem_extras import caffeine_emoji_render
+from stregsystem.ratelimit import RateLimiter, payment_qr_limiter
+from stregsystem.ranking import CategoryRank, category_ranks, leaderboard_category_ranks
+from stregsystem.sale_writer import SaleWriter, commit_batch
+from stregsystem.templatetags.stregsystem_extras import caffeine_emoji_render, money, product_id_and_alias_string
 from stregsystem.utils import (
+    fjule_party,
     make_active_productlist_query,
+    make_inactive_productlist_query,
+    make_username_query,
     mobile_payment_exact_match_member,
     strip_emoji,
     PaymentToolException,
 )
-from stregsystem.mail import data_sent
+from stregsystem.mail import (
+    MAIL_KEEP_FAILED,
+    MAIL_KEEP_SENT,
+    MAIL_MAX_ATTEMPTS,
+    MAIL_RETRY_DELAY,
+    MailWorker,
+    purge_outbox,
+    send_template_mail,
+    write_userdata_archive,
+)
 
 
 def assertCountEqual(case, *args, **kwargs):
@@ -264,6 +315,30 @@ class SaleViewTests(TestCase):
 
         fulfill.assert_called_once_with(PayTransaction(900))
 
+    @patch('stregsystem.views.get_sale_writer')
+    def test_menusale_group_commit(self, get_sale_writer):
+        # The writer thread can't see the test's transaction, so the order is executed right away instead
+        get_sale_writer.return_value.execute.side_effect = lambda order: order.execute()
+        before_member = Member.objects.get(id=1)
+
+        with self.settings(STREGSYSTEM_GROUP_COMMIT=True):
+            response = self.client.post(reverse('menu', args=(1, 1)), data={'product_id': 1})
+
+        self.assertTemplateUsed(response, "stregsystem/menu.html")
+        get_sale_writer.return_value.execute.assert_called_once()
+        self.assertEqual(response.context["member"].balance, before_member.balance - 900)
+        self.assertEqual(Member.objects.get(id=1).balance, before_member.balance - 900)
+
+    @patch('stregsystem.views.get_sale_writer')
+    def test_menusale_group_commit_stregforbud(self, get_sale_writer):
+        get_sale_writer.return_value.execute.side_effect = StregForbudError
+
+        with self.settings(STREGSYSTEM_GROUP_COMMIT=True):
+            response = self.client.post(reverse('menu', args=(1, 1)), data={'product_id': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "stregsystem/error_stregforbud.html")
+
     def test_quicksale_has_status_line(self):
         response = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1"})
 
@@ -400,6 +475,40 @@ class SaleViewTests(TestCase):
         self.assertEqual(before_product.bought, after_product.bought)
         self.assertEqual(before_member.balance, after_member.balance)
 
+    def test_quicksale_reports_first_invalid_product(self):
+        response = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1 98 4 99"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "stregsystem/error_productdoesntexist.html")
+        self.assertEqual(response.context["failedProduct"], 98)
+
+    def test_bought_products_resolved_in_one_query(self):
+        get_bought_product_counts = getattr(stregsystem_views, "__get_bought_product_counts")
+        room = Room.objects.get(id=1)
+
+        with self.assertNumQueries(1):
+            msg, status, result = get_bought_product_counts([(1, 3), (2, 2)], timezone.now(), room)
+
+        self.assertEqual(status, 200)
+        self.assertEqual([(1, 3), (2, 2)], [(product.id, count) for product, count in result])
+
+    def test_quicksale_large_multibuy(self):
+        Member.objects.filter(username="jokke").update(balance=1000000)
+        response = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1:50 1:25"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "stregsystem/index_sale.html")
+        self.assertEqual(response.context["products"], [(Product.objects.get(id=1).name, 75)])
+        self.assertEqual(Sale.objects.filter(member__username="jokke", product_id=1).count(), 75)
+
+    def test_quicksale_over_cap_rejected(self):
+        response = self.client.post(
+            reverse('quickbuy', args=(1,)), {"quickbuy": f"jokke 1:{parser.MAX_UNITS_PER_BUY} 1"}
+        )
+
+        self.assertTemplateUsed(response, "stregsystem/error_invalidquickbuy.html")
+        self.assertFalse(Sale.objects.filter(member__username="jokke", product_id=1).exists())
+
     def test_multibuy_hint_not_applicable(self):
         member = Member.objects.get(username="jokke")
         give_multibuy_hint, sale_hints = stregsystem_views._multibuy_hint(timezone.now(), member)
@@ -435,6 +544,59 @@ class SaleViewTests(TestCase):
         self.assertTrue(give_multibuy_hint)
         self.assertEqual(sale_hints, "{} {}:{}".format("<span class=\"username\">jokke</span>", coke.id, 2))
 
+    def test_post_sale_values_from_recent_activity(self):
+        set_local_values = getattr(stregsystem_views, "__set_local_values")
+        member = Member.objects.create(username="jon", gender="M", balance=10000)
+        room = Room.objects.get(id=1)
+        coke, flan = Product.objects.get(id=1), Product.objects.get(id=2)
+        products = [coke, coke, flan]
+        order = Order.from_products(member, room, products)
+        order.execute()
+
+        # One fetch of the recent sales, one of the intake state, and one for the coffee addict check
+        with self.assertNumQueries(3):
+            values = set_local_values(member, room, order, timezone.now())
+
+        member.refresh_from_db()
+        self.assertAlmostEqual(values[0], member.calculate_alcohol_promille())
+        self.assertAlmostEqual(values[4], member.calculate_caffeine_in_body())
+        self.assertEqual(values[-1], money(member.balance))
+
+
+class MemberGateTests(TestCase):
+    def setUp(self):
+        self.load_member_gate = getattr(stregsystem_views, "__load_member_gate")
+        self.room = Room.objects.create(name="room", description="room")
+        self.member = Member.objects.create(username="jon", signup_due_paid=True)
+
+    def test_one_query_remembered_per_request(self):
+        request = HttpRequest()
+
+        with self.assertNumQueries(1):
+            gate = self.load_member_gate(request, self.room.id, pk=self.member.id, active=True)
+        with self.assertNumQueries(0):
+            self.load_member_gate(request, self.room.id, pk=self.member.id, active=True)
+
+        self.assertEqual(gate.member, self.member)
+        self.assertEqual((gate.room.id, gate.room.name), (self.room.id, "room"))
+        self.assertEqual(gate.room.created_at, self.room.created_at)
+        self.assertFalse(gate.room._state.adding)
+        self.assertTrue(gate.signup_approved)
+
+    def test_signup_approval(self):
+        signup = PendingSignup.objects.create(member=self.member, due=0)
+        self.assertFalse(self.load_member_gate(HttpRequest(), pk=self.member.id).signup_approved)
+
+        signup.status = ApprovalModel.APPROVED
+        signup.save()
+        self.assertTrue(self.load_member_gate(HttpRequest(), pk=self.member.id).signup_approved)
+
+    def test_missing_room_or_member(self):
+        with self.assertRaises(Room.DoesNotExist):
+            self.load_member_gate(HttpRequest(), self.room.id + 1, pk=self.member.id)
+        with self.assertRaises(Member.DoesNotExist):
+            self.load_member_gate(HttpRequest(), self.room.id, pk=self.member.id, active=False)
+
 
 class UserInfoViewTests(TestCase):
     def setUp(self):
@@ -486,6 +648,45 @@ class UserInfoViewTests(TestCase):
 
         self.assertEqual(response.context["last_payment"], self.payments[-1])
 
+    def test_totals(self):
+        response = self.client.post(
+            reverse('userinfo', args=(self.room.id, self.jokke.id)),
+        )
+
+        self.assertEqual(response.context["member"].total_purchases, 3)
+        self.assertEqual(response.context["member"].total_amount, 300)
+        self.assertEqual(response.context["num_pages"], 1)
+        self.assertEqual(response.context["page_number"], 1)
+
+    def test_pages(self):
+        with freeze_time(timezone.datetime(2000, 1, 2)) as frozen_time:
+            for i in range(20):
+                self.sales.append(Sale.objects.create(member=self.jokke, product=self.flan, price=200))
+                frozen_time.tick()
+        url = reverse('userinfo', args=(self.room.id, self.jokke.id))
+
+        first = self.client.post(url).context
+        self.assertSequenceEqual(first["last_sale_list"], self.sales[:-11:-1])
+        self.assertEqual(first["num_pages"], 3)
+        self.assertFalse(first["last_sale_page"].has_newer)
+
+        second = self.client.post(url + f'?older={first["last_sale_page"].older_cursor}&side=2').context
+        self.assertSequenceEqual(second["last_sale_list"], self.sales[-11:-21:-1])
+        self.assertEqual(second["page_number"], 2)
+
+        last = self.client.post(url + f'?older={second["last_sale_page"].older_cursor}&side=3').context
+        self.assertSequenceEqual(last["last_sale_list"], self.sales[2::-1])
+        self.assertFalse(last["last_sale_page"].has_older)
+
+        back = self.client.post(url + f'?newer={last["last_sale_page"].newer_cursor}&side=2').context
+        self.assertSequenceEqual(back["last_sale_list"], second["last_sale_list"])
+
+    def test_invalid_cursor_shows_first_page(self):
+        response = self.client.post(reverse('userinfo', args=(self.room.id, self.jokke.id)) + '?older=nonsense&side=7')
+
+        self.assertSequenceEqual(response.context["last_sale_list"], self.sales[::-1])
+        self.assertEqual(response.context["page_number"], 1)
+
     # @INCOMPLETE: Strictly speaking there are two more variables here. Are
     # they actually necessary, since we don't allow people to go negative
     # anymore anyway? - Jesper 18/09-2017
@@ -544,6 +745,212 @@ class PurchaseHeatmapTests(TestCase):
 
         self.sales.clear()
 
+    def test_year_window(self):
+        with freeze_time(timezone.datetime(2000, 12, 30, 12)):
+            Sale.objects.create(member=self.jokke, product=self.coke, price=100)
+        with freeze_time(timezone.datetime(2000, 1, 2, 12)):
+            Sale.objects.create(member=self.jokke, product=self.flan, price=200)
+
+        with freeze_time(timezone.datetime(2000, 12, 30, 13)):
+            columns = get_heatmap_columns(self.jokke, datetime.date.today(), 52)
+            heatmap_context = prepare_heatmap_template_context(self.jokke, 52, datetime.date.today())
+
+        self.assertEqual(len(columns.dates), 364)
+        self.assertEqual(columns.dates[-1], datetime.date(2000, 1, 2))
+        self.assertEqual((columns.counts[0], columns.money[0]), (1, 100))
+        self.assertEqual((columns.counts[-1], columns.money[-1], columns.product_ids[-1]), (1, 200, [self.flan.id]))
+        self.assertEqual(len(heatmap_context['column_labels']), 52)
+
+    def test_day_colors(self):
+        beer = Category.objects.create(name="Øl")
+        self.coke.categories.add(Category.objects.create(name="Sodavand"))
+        self.flan.categories.add(beer)
+        with freeze_time(timezone.datetime(2000, 1, 1, 12)):
+            Sale.objects.create(member=self.jokke, product=self.coke, price=100)
+            Sale.objects.create(member=self.jokke, product=self.flan, price=200)
+            columns = get_heatmap_columns(self.jokke, datetime.date.today(), 1)
+
+        self.assertEqual(ItemCountHeatmapColorMode(2).get_day_colors(columns)[0], (0, 100, 0))
+        self.assertEqual(MoneySumHeatmapColorMode(600).get_day_colors(columns)[0], (255, 255, 100))
+        self.assertEqual(ColorCategorizedHeatmapColorMode(2).get_day_colors(columns)[0], (162.5, 70, 162.5))
+        self.assertEqual(ItemCountHeatmapColorMode(2).get_day_colors(columns)[1], (235, 237, 240))
+        self.assertEqual(
+            MoneySumHeatmapColorMode(600).get_day_summaries(columns)[:2], ["3.00 𝓕$ brugt", "0.00 𝓕$ brugt"]
+        )
+
+
+class CategoryRankTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="room", description="room")
+        self.beer_category = Category.objects.create(name="Øl")
+        self.soda_category = Category.objects.create(name="Sodavand")
+        self.beer = Product.objects.create(name="Øl", price=900, active=True)
+        self.beer.categories.add(self.beer_category)
+        self.cola = Product.objects.create(name="Cola", price=1000, active=True)
+        self.cola.categories.add(self.soda_category)
+        self.members = {
+            username: Member.objects.create(username=username, balance=100000) for username in ("bo", "ida", "al")
+        }
+        self.from_time = timezone.now() - datetime.timedelta(days=1)
+
+    def buy(self, username, product, count):
+        for _ in range(count):
+            self.members[username].sale_set.create(product=product, price=product.price)
+
+    def test_ranks_by_count_then_username(self):
+        self.buy("bo", self.beer, 2)
+        self.buy("ida", self.beer, 3)
+        self.buy("al", self.beer, 2)
+        self.buy("ida", self.cola, 1)
+        to_time = timezone.now() + datetime.timedelta(days=1)
+
+        with self.assertNumQueries(1):
+            ranks = category_ranks(self.members["bo"].id, self.from_time, to_time)
+
+        self.assertEqual(ranks[self.beer_category.id], CategoryRank(3, 3, 2))
+        self.assertEqual(ranks[self.soda_category.id], CategoryRank(0, 1, 0))
+        self.assertEqual(category_ranks(self.members["al"].id, self.from_time, to_time)[self.beer_category.id].rank, 2)
+
+    def test_only_counts_period(self):
+        self.buy("bo", self.beer, 1)
+        to_time = timezone.now() + datetime.timedelta(days=1)
+        later_sale = self.members["ida"].sale_set.create(product=self.beer, price=900)
+        Sale.objects.filter(id=later_sale.id).update(timestamp=to_time + datetime.timedelta(days=1))
+
+        self.assertEqual(
+            category_ranks(self.members["bo"].id, self.from_time, to_time),
+            {self.beer_category.id: CategoryRank(1, 1, 1)},
+        )
+
+    def test_rank_page(self):
+        self.buy("bo", self.beer, 2)
+        self.buy("ida", self.beer, 3)
+
+        response = self.client.get(reverse('userrank', args=(self.room.id, self.members["bo"].id)))
+
+        self.assertEqual(response.context['rankings'][self.beer_category][0], (2, 2))
+        self.assertEqual(response.context['rankings'][self.beer_category][2], 2)
+        self.assertEqual(response.context['rankings'][self.soda_category], ((0, 0), 0, 0))
+
+
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="room", description="room")
+        self.beer_category = Category.objects.create(name="Øl")
+        self.beer = Product.objects.create(name="Øl", price=900, active=True)
+        self.beer.categories.add(self.beer_category)
+        self.ida = Member.objects.create(username="ida", balance=100000)
+        self.bo = Member.objects.create(username="bo", balance=100000)
+
+    def entry(self, year, member, category=None):
+        return LeaderboardEntry.objects.get(year=year, member=member, category=category)
+
+    @freeze_time(timezone.datetime(2021, 6, 1, 12))
+    def test_order_adds_to_ongoing_year(self):
+        LeaderboardEntry.prepare_year(2021)
+        Order.from_products(self.ida, self.room, [self.beer, self.beer]).execute()
+
+        self.assertEqual(self.entry(2021, self.ida, self.beer_category).count, 2)
+        self.assertEqual((self.entry(2021, self.ida).count, self.entry(2021, self.ida).money), (2, 1800))
+
+    @freeze_time(timezone.datetime(2021, 6, 1, 12))
+    def test_refund_takes_off_ongoing_year(self):
+        sales = [self.ida.sale_set.create(product=self.beer, price=self.beer.price) for _ in range(2)]
+
+        sales[0].delete()
+
+        self.assertEqual(self.entry(2021, self.ida, self.beer_category).count, 1)
+
+    def test_sales_after_fjuleparty_count_for_next_year(self):
+        with freeze_time(fjule_party(2021) + datetime.timedelta(minutes=1)):
+            self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+
+            self.assertEqual(self.entry(2022, self.ida).count, 1)
+            self.assertFalse(LeaderboardEntry.objects.filter(year=2021).exists())
+
+    def test_year_is_frozen_after_fjuleparty(self):
+        with freeze_time(timezone.datetime(2021, 6, 1, 12)):
+            old_sale = self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+            self.bo.sale_set.create(product=self.beer, price=self.beer.price)
+            LeaderboardEntry.prepare_year(2021)
+
+        with freeze_time(timezone.datetime(2022, 6, 1, 12)):
+            LeaderboardEntry.prepare_year(2021)
+            self.assertTrue(LeaderboardYear.objects.get(year=2021).frozen)
+
+            old_sale.delete()
+            with self.assertNumQueries(1):
+                LeaderboardEntry.prepare_year(2021)
+
+            self.assertEqual(self.entry(2021, self.ida).count, 1)
+            self.assertEqual([entry.member for entry in LeaderboardEntry.top(2021, None)], [self.bo, self.ida])
+
+    def test_first_read_sums_up_year(self):
+        with freeze_time(timezone.datetime(2020, 6, 1, 12)):
+            self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+        LeaderboardEntry.objects.all().delete()
+
+        with freeze_time(timezone.datetime(2022, 6, 1, 12)):
+            top = LeaderboardEntry.top(2020, self.beer_category.id)
+            self.assertEqual(list(top), [])
+            LeaderboardEntry.prepare_year(2020)
+            top = LeaderboardEntry.top(2020, self.beer_category.id)
+
+        self.assertEqual([(entry.member, entry.count) for entry in top], [(self.ida, 1)])
+
+    @freeze_time(timezone.datetime(2021, 6, 1, 12))
+    def test_ranks_match_ranking_sales(self):
+        for member, count in ((self.ida, 2), (self.bo, 2)):
+            for _ in range(count):
+                member.sale_set.create(product=self.beer, price=self.beer.price)
+
+        for member in (self.ida, self.bo):
+            self.assertEqual(
+                leaderboard_category_ranks(2021, member.id),
+                category_ranks(member.id, fjule_party(2020), timezone.now()),
+            )
+
+    @freeze_time(timezone.datetime(2021, 6, 1, 12))
+    def test_categorising_rebuilds_ongoing_year(self):
+        soda_category = Category.objects.create(name="Sodavand")
+        LeaderboardEntry.prepare_year(2021)
+        self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+
+        self.beer.categories.add(soda_category)
+
+        self.assertEqual(self.entry(2021, self.ida, soda_category).count, 1)
+
+    @freeze_time(timezone.datetime(2021, 6, 1, 12))
+    def test_categorising_recounts_only_affected_entries(self):
+        soda_category = Category.objects.create(name="Sodavand")
+        cola = Product.objects.create(name="Cola", price=500, active=True)
+        self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+        self.bo.sale_set.create(product=cola, price=cola.price)
+        LeaderboardEntry.prepare_year(2021)
+        LeaderboardEntry.objects.filter(member=self.ida, category=self.beer_category).update(count=42)
+
+        cola.categories.add(soda_category)
+        soda_category.product_set.add(self.beer)
+
+        self.assertEqual(self.entry(2021, self.bo, soda_category).count, 1)
+        self.assertEqual(self.entry(2021, self.ida, soda_category).count, 1)
+        # Beer didn't change, so its entries are left as they were
+        self.assertEqual(self.entry(2021, self.ida, self.beer_category).count, 42)
+
+        cola.categories.remove(soda_category)
+
+        self.assertFalse(LeaderboardEntry.objects.filter(member=self.bo, category=soda_category).exists())
+
+    def test_rebuild_command(self):
+        with freeze_time(timezone.datetime(2020, 6, 1, 12)):
+            self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+
+        with freeze_time(timezone.datetime(2021, 6, 1, 12)):
+            call_command("rebuildleaderboard", "2020", stdout=StringIO())
+
+        self.assertEqual(self.entry(2020, self.ida, self.beer_category).count, 1)
+        self.assertTrue(LeaderboardYear.objects.get(year=2020).frozen)
+
 
 class TransactionTests(TestCase):
     def test_pay_transaction_change_neg(self):
@@ -627,6 +1034,7 @@ class OrderTest(TestCase):
         self.product.sale_set.create(price=100, member=self.member)
         self.product.start_date = datetime.date(year=2017, month=1, day=1)
         self.product.quantity = 1
+        self.product.save()
         order = Order(self.member, self.room)
 
         item = OrderItem(self.product, order, 1)
@@ -642,6 +1050,7 @@ class OrderTest(TestCase):
         self.product.sale_set.create(price=100, member=self.member)
         self.product.start_date = datetime.date(year=2017, month=1, day=1)
         self.product.quantity = 2
+        self.product.save()
         order = Order(self.member, self.room)
 
         item = OrderItem(self.product, order, 2)
@@ -652,6 +1061,32 @@ class OrderTest(TestCase):
 
         fulfill.was_not_called()
 
+    def test_order_execute_conditional_debit(self):
+        self.member.balance = 0  # stale, the debit must use the balance in the database
+        order = Order(self.member, self.room)
+        order.items.add(OrderItem(self.product, order, 2))
+
+        # savepoint, debit, read back the balance, sales, categories, daily sales (savepoint, lock, insert, release),
+        # intake state (lock, the day's sales, update, insert), leaderboard (savepoint, update, insert, release),
+        # totals, release
+        with self.assertNumQueries(19):
+            new_balance = order.execute(conditional_debit=True)
+
+        self.assertEqual(new_balance, 80)
+        self.assertEqual(self.member.balance, 80)
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, 80)
+        self.assertEqual(Sale.objects.filter(member=self.member).count(), 2)
+
+    def test_order_execute_conditional_debit_no_money(self):
+        order = Order(self.member, self.room)
+        order.items.add(OrderItem(self.product, order, 11))
+
+        with self.assertRaises(StregForbudError):
+            order.execute(conditional_debit=True)
+
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, 100)
+        self.assertFalse(Sale.objects.filter(member=self.member).exists())
+
     @patch('stregsystem.models.Member.can_fulfill')
     def test_order_execute_no_money(self, can_fulfill):
         can_fulfill.return_value = False
@@ -668,6 +1103,50 @@ class OrderTest(TestCase):
         self.assertEqual(balance_before, balance_after)
 
 
+class SaleWriterTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="room")
+        self.product = Product.objects.create(name="øl", price=10, active=True)
+        self.rich = Member.objects.create(username="rich", balance=100)
+        self.poor = Member.objects.create(username="poor", balance=5)
+
+    def test_commit_batch_keeps_orders_apart(self):
+        orders = [Order.from_products(member, self.room, [self.product]) for member in (self.rich, self.poor)]
+
+        results = commit_batch(orders)
+
+        self.assertEqual(results[0], (90, None))
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], StregForbudError)
+        self.assertEqual(Sale.objects.filter(member=self.rich).count(), 1)
+        self.assertFalse(Sale.objects.filter(member=self.poor).exists())
+
+    def test_writer_returns_each_caller_its_result(self):
+        batches = []
+
+        def commit(orders):
+            batches.append(orders)
+            return [(None, StregForbudError()) if order == "poor" else (order, None) for order in orders]
+
+        writer = SaleWriter(max_batch=4, commit=commit)
+        results = {}
+
+        def buy(name):
+            try:
+                results[name] = writer.execute(name)
+            except StregForbudError:
+                results[name] = "stregforbud"
+
+        threads = [threading.Thread(target=buy, args=(name,)) for name in ["poor"] + [f"rich{i}" for i in range(9)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {"poor": "stregforbud", **{f"rich{i}": f"rich{i}" for i in range(9)}})
+        self.assertTrue(all(len(batch) <= 4 for batch in batches))
+
+
 class PaymentTests(TestCase):
     def setUp(self):
         self.member = Member.objects.create(username="jon", balance=100)
@@ -747,6 +1226,10 @@ class ProductTests(TestCase):
 
         self.assertNotIn(future_product, list(make_active_productlist_query(Product.objects)))
 
+    def test_productlist_queries_do_not_touch_sales(self):
+        for query in (make_active_productlist_query, make_inactive_productlist_query):
+            self.assertNotIn(Sale._meta.db_table, str(query(Product.objects).query))
+
     def test_is_active_active_expired(self):
         product = Product.objects.create(
             active=True, price=100, deactivate_date=(timezone.now() - datetime.timedelta(hours=1))
@@ -802,6 +1285,87 @@ class ProductTests(TestCase):
         self.assertFalse(product.is_active())
 
 
+class SoldCountTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def setUp(self):
+        self.member = Member.objects.create(username="jon", balance=10000)
+        self.room = Room.objects.get(id=1)
+        self.ticket = Product.objects.create(
+            name="ticket", price=100, active=True, quantity=3, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+
+    def sold_count(self, product):
+        return Product.objects.get(id=product.id).sold_count
+
+    def test_counted_from_fixture(self):
+        self.assertEqual(self.sold_count(Product.objects.get(id=2)), 1)
+        self.assertEqual(self.sold_count(Product.objects.get(id=3)), 3)
+
+    def test_order_reserves_without_counting_sales(self):
+        order = Order.from_products(self.member, self.room, [self.ticket, self.ticket])
+
+        with CaptureQueriesContext(connection) as queries:
+            order.execute()
+
+        self.assertEqual(self.sold_count(self.ticket), 2)
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries.captured_queries))
+
+    def test_failed_reservation_keeps_count(self):
+        self.ticket.sale_set.create(price=100, member=self.member)
+        order = Order.from_products(self.member, self.room, [self.ticket] * 3)
+
+        with self.assertRaises(NoMoreInventoryError):
+            order.execute()
+
+        self.assertEqual(self.sold_count(self.ticket), 1)
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, 10000)
+
+    def test_refund_releases(self):
+        sales = [self.ticket.sale_set.create(price=100, member=self.member) for _ in range(3)]
+
+        sales[0].delete()
+        Sale.objects.filter(id=sales[1].id).delete()
+
+        self.assertEqual(self.sold_count(self.ticket), 1)
+
+    def test_unlimited_not_counted(self):
+        product = Product.objects.create(name="beer", price=100, active=True)
+        product.sale_set.create(price=100, member=self.member)
+
+        self.assertEqual(self.sold_count(product), 0)
+
+    def test_start_date_change_recounts(self):
+        with freeze_time(datetime.datetime(year=2018, month=1, day=1, hour=12)):
+            self.ticket.sale_set.create(price=100, member=self.member)
+        self.ticket.sale_set.create(price=100, member=self.member)
+
+        self.ticket.start_date = datetime.date(year=2019, month=1, day=1)
+        self.ticket.save()
+
+        self.assertEqual(self.sold_count(self.ticket), 1)
+
+    def test_plain_save_keeps_count_without_counting(self):
+        stale = Product.objects.get(id=self.ticket.id)
+        self.ticket.sale_set.create(price=100, member=self.member)
+
+        stale.name = "billet"
+        with CaptureQueriesContext(connection) as queries:
+            stale.save()
+
+        self.assertEqual(self.sold_count(self.ticket), 1)
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries.captured_queries))
+
+    def test_recountsold_rebuilds(self):
+        self.ticket.sale_set.create(price=100, member=self.member)
+        Product.objects.filter(id=self.ticket.id).update(sold_count=42)
+
+        call_command("recountsold", stdout=StringIO())
+
+        self.assertEqual(self.sold_count(self.ticket), 1)
+        self.assertEqual(self.sold_count(Product.objects.get(id=3)), 3)
+
+
 class ProductNoteTest(TestCase):
     fixtures = ["initial_data"]
 
@@ -899,6 +1463,232 @@ class ProductNoteTest(TestCase):
         self.assertNotContains(response, "INACTIVE-NOTE")
 
 
+class RoomCatalogTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def test_snapshot_is_reused(self):
+        first = get_room_catalog(1)
+
+        # Only the version lookup is needed while nothing has changed
+        with self.assertNumQueries(1):
+            second = get_room_catalog(1)
+
+        self.assertIs(first, second)
+
+    def test_snapshot_excludes_sold_out_and_other_rooms(self):
+        product_ids = [product.id for product in get_room_catalog(1).products]
+
+        self.assertIn(1, product_ids)
+        self.assertIn(2, product_ids)
+        self.assertNotIn(3, product_ids)
+        self.assertNotIn(4, product_ids)
+
+    def test_product_save_invalidates(self):
+        get_room_catalog(1)
+        product = Product.objects.get(id=1)
+        product.name = "Ny Limfjordsporter"
+        product.save()
+
+        self.assertEqual("Ny Limfjordsporter", get_room_catalog(1).products[0].name)
+
+    def test_note_and_alias_invalidates(self):
+        get_room_catalog(1)
+        product = Product.objects.get(id=1)
+        note = ProductNote.objects.create(
+            text="NEW-NOTE", start_date=datetime.date.today(), end_date=datetime.date.today()
+        )
+        note.products.add(product)
+        NamedProduct.objects.create(name="lim", product=product)
+
+        catalog = get_room_catalog(1)
+
+        self.assertEqual(["NEW-NOTE"], [n.text for n in catalog.notes[product.id]])
+        self.assertEqual(["lim"], catalog.aliases[product.id])
+
+    def test_sold_out_invalidates(self):
+        flan = Product.objects.get(id=2)
+        self.assertIn(flan, get_room_catalog(1).products)
+
+        # Flan has sold one of three, so this sells out the rest
+        Order.from_products(Member.objects.get(username="jokke"), Room.objects.get(id=1), [flan, flan]).execute()
+
+        self.assertNotIn(flan, get_room_catalog(1).products)
+
+    def test_deactivation_expires_snapshot(self):
+        with freeze_time(timezone.datetime(2020, 1, 1, 12, 0, tzinfo=pytz.UTC)) as frozen_time:
+            product = Product.objects.get(id=1)
+            product.deactivate_date = timezone.now() + datetime.timedelta(minutes=5)
+            product.save()
+            self.assertIn(product, get_room_catalog(1).products)
+
+            frozen_time.tick(datetime.timedelta(minutes=10))
+
+            self.assertNotIn(product, get_room_catalog(1).products)
+
+
+class AliasIndexTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def setUp(self):
+        NamedProduct.objects.create(name="lim", product_id=1)
+        NamedProduct.objects.create(name="flan", product_id=2)
+
+    def test_pre_process_replaces_aliases(self):
+        self.assertEqual("jokke 1 2:3 99", stregsystem_views._pre_process("jokke lim flan:3 99"))
+
+    def test_pre_process_needs_only_version_lookup(self):
+        stregsystem_views._pre_process("jokke lim")
+
+        with self.assertNumQueries(1):
+            stregsystem_views._pre_process("jokke lim flan:2 flan lim")
+
+    def test_alias_change_is_seen(self):
+        stregsystem_views._pre_process("jokke lim")
+        NamedProduct.objects.filter(name="lim").get().delete()
+
+        self.assertEqual("jokke lim", stregsystem_views._pre_process("jokke lim"))
+
+    def test_filter_renders_alias_without_queries(self):
+        get_alias_index()
+
+        with self.assertNumQueries(0):
+            self.assertEqual("1 / lim", product_id_and_alias_string(1))
+            self.assertEqual("3", product_id_and_alias_string(3))
+
+
+class CatalogResponseTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def setUp(self):
+        stregsystem_catalog._catalog_responses.clear()
+
+    def test_active_products_not_modified(self):
+        response = self.client.get(reverse('api_active_products'), {'room_id': 1})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'name': "Limfjordsporter", 'price': 900}, response.json()['1'])
+
+        # Only the room and the catalog version are looked up
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                reverse('api_active_products'), {'room_id': 1}, HTTP_IF_NONE_MATCH=response['ETag']
+            )
+
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.content)
+
+    def test_active_products_change(self):
+        etag = self.client.get(reverse('api_active_products'), {'room_id': 1})['ETag']
+        product = Product.objects.get(id=1)
+        product.price = 1000
+        product.save()
+
+        response = self.client.get(reverse('api_active_products'), {'room_id': 1}, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1000, response.json()['1']['price'])
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_unseen_change_keeps_etag(self):
+        first = self.client.get(reverse('api_active_products'), {'room_id': 1})
+        NamedProduct.objects.create(name="lim", product_id=1)
+
+        response = self.client.get(reverse('api_active_products'), {'room_id': 1}, HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(304, response.status_code)
+
+    def test_named_products_not_modified(self):
+        NamedProduct.objects.create(name="lim", product_id=1)
+        response = self.client.get(reverse('api_named_products'))
+        self.assertEqual({'lim': 1}, response.json())
+        # Only the ETag tells changes apart, a time to the second can't
+        self.assertNotIn('Last-Modified', response)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('api_named_products'), HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(304, response.status_code)
+
+    def test_category_mappings(self):
+        category = Category.objects.create(name="Øl")
+
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('api_product_mappings'))
+        self.assertEqual([], response.json()['1'])
+
+        Product.objects.get(id=1).categories.add(category)
+        response = self.client.get(reverse('api_product_mappings'))
+
+        self.assertEqual([{'category_id': category.id, 'category_name': "Øl"}], response.json()['1'])
+        self.assertEqual([], response.json()['4'])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(response.content, self.client.get(reverse('api_product_mappings')).content)
+
+
+class ActiveNewsTests(TestCase):
+    def setUp(self):
+        invalidate_news()
+        self.now = timezone.now()
+        self.news = News.objects.create(
+            title="Fest",
+            text="",
+            pub_date=self.now - datetime.timedelta(days=1),
+            stop_date=self.now + datetime.timedelta(days=1),
+        )
+
+    def test_cached_news_costs_no_query(self):
+        get_random_news()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_random_news(), self.news)
+
+    def test_only_published_news(self):
+        News.objects.create(
+            title="Gammel",
+            text="",
+            pub_date=self.now - datetime.timedelta(days=2),
+            stop_date=self.now - datetime.timedelta(days=1),
+        )
+        News.objects.create(
+            title="Ny",
+            text="",
+            pub_date=self.now + datetime.timedelta(days=1),
+            stop_date=self.now + datetime.timedelta(days=2),
+        )
+
+        self.assertEqual(get_active_news().items, [self.news])
+
+    def test_saving_news_invalidates(self):
+        get_random_news()
+
+        self.news.stop_date = self.now - datetime.timedelta(hours=1)
+        self.news.save()
+
+        self.assertIsNone(get_random_news())
+
+    def test_published_at_boundary(self):
+        later = News.objects.create(
+            title="Senere",
+            text="",
+            pub_date=self.now + datetime.timedelta(hours=1),
+            stop_date=self.now + datetime.timedelta(days=1),
+        )
+        get_random_news()
+
+        with freeze_time(self.now + datetime.timedelta(hours=1, seconds=1)):
+            self.assertEqual(get_active_news().items, [self.news, later])
+
+    def test_change_by_other_worker_seen_after_recheck(self):
+        get_random_news()
+        # Another worker changes the news, which only touches the shared version
+        News.objects.filter(id=self.news.id).update(stop_date=self.now - datetime.timedelta(hours=1))
+        CacheVersion.bump(NEWS_VERSION)
+
+        self.assertEqual(get_random_news(), self.news)
+        with freeze_time(self.now + NEWS_RECHECK_INTERVAL + datetime.timedelta(seconds=1)):
+            self.assertIsNone(get_random_news())
+
+
 class SaleTests(TestCase):
     def setUp(self):
         self.member = Member.objects.create(username="jon", balance=100)
@@ -936,6 +1726,77 @@ class SaleTests(TestCase):
 
         self.assertIsNone(sale.id)
 
+    def test_sale_updates_member_totals(self):
+        stale = Member.objects.get(id=self.member.id)
+        Sale.objects.create(member=self.member, product=self.product, price=100)
+        sale = Sale.objects.create(member=self.member, product=self.product, price=250)
+        sale.delete()
+
+        # Saving a member loaded before the sales must not write back its old totals
+        stale.notes = "stale"
+        stale.save()
+
+        member = Member.objects.get(id=self.member.id)
+        self.assertEqual(member.total_purchases, 1)
+        self.assertEqual(member.total_amount, 100)
+        self.assertEqual(member.notes, "stale")
+
+    def test_order_updates_member_totals(self):
+        room = Room.objects.create(name="test")
+        order = Order(self.member, room)
+        order.items.add(OrderItem(self.product, order, 3))
+        order.execute()
+
+        member = Member.objects.get(id=self.member.id)
+        self.assertEqual(member.total_purchases, 3)
+        self.assertEqual(member.total_amount, 3)
+        self.assertEqual((order.member.total_purchases, order.member.total_amount), (3, 3))
+
+
+class KeysetPageTests(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create(username="jon")
+        self.product = Product.objects.create(name="beer", price=100, active=True)
+        with freeze_time(timezone.datetime(2000, 1, 1)) as frozen_time:
+            # Pairs of sales at the same time, so the id has to break the ties
+            self.sales = []
+            for i in range(5):
+                self.sales += [Sale.objects.create(member=self.member, product=self.product, price=100) for _ in "ab"]
+                frozen_time.tick()
+        self.newest_first = self.sales[::-1]
+
+    def test_cursor_roundtrip(self):
+        sale = self.sales[3]
+        self.assertEqual(decode_cursor(encode_cursor(sale)), (sale.timestamp, sale.id))
+
+    def test_invalid_cursor(self):
+        for cursor in ["", "1", "a_b", "1_2_3", "99999999999999999999999_1"]:
+            with self.assertRaises(InvalidCursor):
+                keyset_page(Sale.objects.all(), 3, older_than=cursor)
+
+    def test_walk_older_and_back(self):
+        pages = [keyset_page(Sale.objects.all(), 3)]
+        while pages[-1].has_older:
+            pages.append(keyset_page(Sale.objects.all(), 3, older_than=pages[-1].older_cursor))
+
+        self.assertEqual([sale for page in pages for sale in page.items], self.newest_first)
+        self.assertFalse(pages[0].has_newer)
+        self.assertTrue(pages[-1].has_newer)
+
+        back = keyset_page(Sale.objects.all(), 3, newer_than=pages[-1].newer_cursor)
+        self.assertEqual(back.items, pages[-2].items)
+        first = keyset_page(Sale.objects.all(), 3, newer_than=pages[1].newer_cursor)
+        self.assertEqual(first.items, pages[0].items)
+        self.assertFalse(first.has_newer)
+
+    def test_deep_page_costs_one_query(self):
+        page = keyset_page(Sale.objects.all(), 3, older_than=encode_cursor(self.sales[2]))
+
+        with self.assertNumQueries(1):
+            keyset_page(Sale.objects.all(), 3, older_than=encode_cursor(self.sales[2]))
+        self.assertEqual(page.items, self.newest_first[-2:])
+        self.assertFalse(page.has_older)
+
 
 class MemberTests(TestCase):
     def test_fulfill_pay_transaction(self):
@@ -1052,14 +1913,59 @@ class MemberTests(TestCase):
             self.assertAlmostEqual(1.15, user.calculate_alcohol_promille(), places=2)
 
     def test_send_userdata(self):
-        user = Member.objects.create()
+        user = Member.objects.create(email="jokke@example.com")
         room = Room.objects.create()
+        url = reverse('send_userdata', args=(room.id, user.id))
+
+        with freeze_time(timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)) as frozen_time:
+            first = self.client.get(url)
+            frozen_time.tick(datetime.timedelta(minutes=1, seconds=30))
+            second = self.client.get(url)
+            frozen_time.tick(datetime.timedelta(minutes=4))
+            third = self.client.get(url)
+
+        self.assertTrue(first.context["mail_sent"])
+        self.assertFalse(second.context["mail_sent"])
+        self.assertEqual(second.context["minutes"], 4)
+        self.assertTrue(third.context["mail_sent"])
+        self.assertEqual(
+            OutgoingMail.objects.filter(recipient="jokke@example.com", subject__contains="user data").count(), 2
+        )
 
-        t = timezone.datetime.fromtimestamp(0)
+    def test_userdata_archive(self):
+        user = Member.objects.create(username="jokke", gender="M")
+        coke = Product.objects.create(name="coke", price=100, active=True)
+        with freeze_time(timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)):
+            for _ in range(3):
+                user.sale_set.create(product=coke, price=100)
+            payment = Payment.objects.create(member=user, amount=500)
+            Payment.objects.create(member=user, amount=200)
+            MobilePayment.objects.create(
+                member=user, amount=500, payment=payment, timestamp=timezone.now(), transaction_id="abc"
+            )
 
-        stregsystem_views.send_userdata(None, room.id, user.id)
+        archive_file = io.BytesIO()
+        # The sales and the payments, however many of them there are
+        with self.assertNumQueries(2):
+            write_userdata_archive(user, archive_file)
 
-        self.assertNotEqual(data_sent[user.id], t)
+        with zipfile.ZipFile(archive_file) as archive:
+            self.assertEqual(archive.namelist(), ["sales.csv", "payments.csv", "userdata.csv"])
+            sales = archive.read("sales.csv").decode().splitlines()
+            payments = archive.read("payments.csv").decode().splitlines()
+            userdata = archive.read("userdata.csv").decode().splitlines()
+
+        self.assertEqual(sales, ["Timestamp,Name,Price"] + ["2000-01-01 00:00:00+00:00,coke,100"] * 3)
+        self.assertEqual(
+            payments,
+            [
+                "Timestamp,Amount,Is Mobilepay",
+                "2000-01-01 00:00:00+00:00,500,True",
+                "2000-01-01 00:00:00+00:00,200,False",
+            ],
+        )
+        self.assertEqual(userdata[1].split(",")[1], "jokke")
+        self.assertEqual(userdata[1].split(",")[7], "Male")
 
 
 class BallmerPeakTests(TestCase):
@@ -1098,6 +2004,41 @@ class BallmerPeakTests(TestCase):
         self.assertFalse(is_balmer_peaking)
 
 
+class UsernameLookupTests(TestCase):
+    def setUp(self):
+        self.jeff = Member.objects.create(username="Jeff", firstname="jeff", lastname="jefferson", gender="M")
+
+    def test_matches_any_case(self):
+        self.assertEqual(self.jeff, Member.objects.get(make_username_query("jEFF"), active=True))
+
+    def test_matches_related_field(self):
+        room = Room.objects.create(name="room", description="room")
+        product = Product.objects.create(name="beer", price=100, active=True)
+        Sale.objects.create(member=self.jeff, product=product, room=room, price=100)
+        self.assertEqual(
+            product, Product.objects.filter(make_username_query("jeff", field="sale__member__username")).get()
+        )
+
+    def test_active_lookup_uses_index(self):
+        plan = Member.objects.filter(make_username_query("jeff"), active=True).explain()
+        self.assertIn("USING INDEX unique_active_member_username_lower", plan)
+        self.assertNotIn("SCAN", plan)
+
+    def test_lookup_uses_index(self):
+        plan = Member.objects.filter(make_username_query("jeff")).explain()
+        self.assertIn("USING INDEX member_username_lower_idx", plan)
+        self.assertNotIn("SCAN", plan)
+
+    def test_active_usernames_are_unique(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Member.objects.create(username="JEFF", firstname="jeff", lastname="jefferson", gender="M")
+
+    def test_inactive_members_can_share_username(self):
+        Member.objects.create(username="jeff", active=False)
+        Member.objects.create(username="JEFF", active=False)
+        self.assertEqual(3, Member.objects.filter(make_username_query("jeff")).count())
+
+
 class MemberModelFormTests(TestCase):
     def setUp(self):
         jeff = Member.objects.create(username="jeff", firstname="jeff", lastname="jefferson", gender="M")
@@ -1129,6 +2070,9 @@ class MemberAdminTests(TestCase):
 
     def test_creates_warning_for_duplicate_usernames(self):
         self.client.login(username="superuser", password="very_secure")
+        # Only inactive members may share a username with someone else
+        self.jeff.active = False
+        self.jeff.save()
         self.jeff2.username = "jeff"
         response = self.client.post(
             reverse('admin:stregsystem_member_change', kwargs={'object_id': 2}), model_to_dict(self.jeff2), follow=False
@@ -1141,6 +2085,17 @@ class MemberAdminTests(TestCase):
         self.assertEqual(str(messages[0]), "Det brugernavn var allerede optaget")
         self.assertEqual("jeff", Member.objects.filter(pk=2).get().username)
 
+    def test_refuses_duplicate_username_of_active_member(self):
+        self.client.login(username="superuser", password="very_secure")
+        self.jeff2.username = "JEFF"
+        response = self.client.post(
+            reverse('admin:stregsystem_member_change', kwargs={'object_id': 2}), model_to_dict(self.jeff2), follow=False
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Brugernavnet er allerede taget af et aktivt medlem")
+        self.assertEqual("jeffrey", Member.objects.filter(pk=2).get().username)
+
     def test_no_warning_unique_usernames(self):
         self.client.login(username="superuser", password="very_secure")
         self.jeff2.username = "mr_jefferson"
@@ -1324,44 +2279,54 @@ class QuickbuyParserTests(TestCase):
         self.assertEqual(len(products), 0)
 
     def test_single_buy(self):
-        product_ids = [42]
         buy_string = self.test_username + ' 42'
 
         username, products = parser.parse(buy_string)
 
         self.assertEqual(username, self.test_username)
-        self.assertEqual(len(products), 1)
-        assertCountEqual(self, product_ids, products)
+        self.assertEqual(products, [(42, 1)])
 
     def test_multi_buy(self):
-        product_ids = [42, 1337]
         buy_string = self.test_username + " 42 1337"
 
         username, products = parser.parse(buy_string)
 
         self.assertEqual(username, self.test_username)
-        self.assertEqual(len(products), len(product_ids))
-        assertCountEqual(self, product_ids, products)
+        self.assertEqual(products, [(42, 1), (1337, 1)])
 
     def test_multi_buy_repeated(self):
-        product_ids = [42, 42]
-        buy_string = self.test_username + " 42 42"
+        buy_string = self.test_username + " 42 1337 42"
 
         username, products = parser.parse(buy_string)
 
         self.assertEqual(username, self.test_username)
-        self.assertEqual(len(products), len(product_ids))
-        assertCountEqual(self, product_ids, products)
+        self.assertEqual(products, [(42, 2), (1337, 1)])
 
     def test_multi_buy_quantifier(self):
-        product_ids = [42, 42, 1337, 1337, 1337]
         buy_string = self.test_username + " 42:2 1337:3"
 
         username, products = parser.parse(buy_string)
 
         self.assertEqual(username, self.test_username)
-        self.assertEqual(len(products), len(product_ids))
-        assertCountEqual(self, product_ids, products)
+        self.assertEqual(products, [(42, 2), (1337, 3)])
+
+    def test_units_up_to_cap(self):
+        buy_string = self.test_username + f" 42:{parser.MAX_UNITS_PER_BUY - 1} 1337"
+
+        username, products = parser.parse(buy_string)
+
+        self.assertEqual(products, [(42, parser.MAX_UNITS_PER_BUY - 1), (1337, 1)])
+
+    def test_units_over_cap(self):
+        buy_string = self.test_username + f" 42:{parser.MAX_UNITS_PER_BUY} 1337"
+        with self.assertRaises(parser.QuickBuyError) as cm:
+            parser.parse(buy_string)
+        self.assertEqual(cm.exception.failed_part, "1337")
+
+    def test_huge_quantifier(self):
+        buy_string = self.test_username + ' 42:' + '9' * 5000
+        with self.assertRaises(parser.QuickBuyError):
+            parser.parse(buy_string)
 
     def test_zero_quantifier(self):
         buy_string = self.test_username + " 42:0"
@@ -1859,6 +2824,224 @@ class AutoPaymentTests(TestCase):
         mock_mail_method.assert_called_once()
 
 
+class IntakeStateTests(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create(username="jokke", gender="F", balance=100000)
+        self.beer = Product.objects.create(name="øl", price=10, alcohol_content_ml=30.0, active=True)
+        self.coffee = Product.objects.create(name="kaffe", price=5, caffeine_content_mg=CAFFEINE_IN_COFFEE, active=True)
+        self.start = timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)
+
+    def replayed(self, now):
+        """What replaying the sales gives, as the menu used to work it out."""
+        gender = {"M": Gender.MALE, "F": Gender.FEMALE}.get(self.member.gender, Gender.UNKNOWN)
+        sales = list(self.member.sale_set.filter(timestamp__gt=now - CAFFEINE_TIME_INTERVAL).order_by('timestamp'))
+        bac = alcohol_bac_timeline(
+            gender,
+            80,
+            now,
+            [
+                (sale.timestamp, sale.product.alcohol_content_ml)
+                for sale in sales
+                if sale.timestamp > now - datetime.timedelta(hours=12) and sale.product.alcohol_content_ml > 0
+            ],
+        )
+        with freeze_time(now):
+            caffeine = current_caffeine_in_body_compound_interest(
+                [
+                    Intake(sale.timestamp, sale.product.caffeine_content_mg)
+                    for sale in sales
+                    if sale.product.caffeine_content_mg > 0
+                ]
+            )
+        return bac, caffeine
+
+    def assertMatchesReplay(self, now):
+        activity = self.member.recent_activity(now)
+        bac, caffeine = self.replayed(now)
+        self.assertAlmostEqual(activity.alcohol_promille(), bac, places=9)
+        self.assertAlmostEqual(activity.caffeine_in_body(), caffeine, places=9)
+
+    def test_matches_replay(self):
+        # A beer every 20 minutes for 15 hours keeps the BAC up past the 12 hour window, and coffee now and then
+        with freeze_time(self.start) as frozen_time:
+            for i in range(45):
+                self.member.sale_set.create(product=self.beer, price=self.beer.price)
+                if i % 9 == 0:
+                    self.member.sale_set.create(product=self.coffee, price=self.coffee.price)
+                self.assertMatchesReplay(timezone.now())
+                frozen_time.tick(datetime.timedelta(minutes=20))
+
+            for hours in (1, 5, 11, 12, 13, 23, 24, 25, 40):
+                self.assertMatchesReplay(self.start + datetime.timedelta(hours=15 + hours))
+
+            frozen_time.tick(datetime.timedelta(days=2))
+            self.member.sale_set.create(product=self.coffee, price=self.coffee.price)
+            self.assertMatchesReplay(timezone.now())
+
+    def test_order_carries_state_forward(self):
+        room = Room.objects.create(name="test")
+        with freeze_time(self.start) as frozen_time:
+            Order.from_products(self.member, room, [self.beer, self.coffee]).execute()
+            frozen_time.tick(datetime.timedelta(minutes=30))
+
+            order = Order.from_products(self.member, room, [self.beer, self.beer])
+            # Lock and update the state, instead of replaying the day
+            with CaptureQueriesContext(connection) as queries:
+                order.execute()
+            intake_queries = [query for query in queries if "intakestate" in query["sql"]]
+            self.assertEqual(len(intake_queries), 2)
+            self.assertFalse(any("stregsystem_sale" in query["sql"] for query in intake_queries))
+
+            self.assertMatchesReplay(timezone.now() + datetime.timedelta(minutes=10))
+
+    def test_refund_rebuilds(self):
+        with freeze_time(self.start) as frozen_time:
+            sale = self.member.sale_set.create(product=self.beer, price=self.beer.price)
+            self.member.sale_set.create(product=self.coffee, price=self.coffee.price)
+            frozen_time.tick(datetime.timedelta(minutes=5))
+
+            sale.delete()
+
+            self.assertFalse(IntakeState.objects.filter(member=self.member).exists())
+            self.assertEqual(self.member.calculate_alcohol_promille(), 0)
+            self.assertMatchesReplay(timezone.now())
+
+    def test_product_change_rebuilds(self):
+        with freeze_time(self.start):
+            self.member.sale_set.create(product=self.beer, price=self.beer.price)
+            self.beer.alcohol_content_ml = 15.0
+            self.beer.save()
+
+            self.assertFalse(IntakeState.objects.filter(member=self.member).exists())
+            self.assertMatchesReplay(timezone.now())
+
+    def test_read_does_not_store_state(self):
+        with freeze_time(self.start):
+            self.member.sale_set.create(product=self.beer, price=self.beer.price)
+            IntakeState.forget(member_id=self.member.id)
+
+            state = IntakeState.current(self.member, timezone.now())
+
+        self.assertGreater(state.bac, 0)
+        # Only a purchase, which holds the lock, may store the state
+        self.assertFalse(IntakeState.objects.filter(member=self.member).exists())
+
+    def test_daily_coffee_stays_covered(self):
+        with freeze_time(self.start) as frozen_time:
+            for i in range(12):
+                self.member.sale_set.create(product=self.coffee, price=self.coffee.price)
+                frozen_time.tick(datetime.timedelta(hours=4))
+
+                # Halfway to the next coffee the stored state still covers everything that counts
+                with self.assertNumQueries(1):
+                    IntakeState.current(self.member, timezone.now())
+                self.assertMatchesReplay(timezone.now())
+                frozen_time.tick(datetime.timedelta(hours=4))
+
+    def test_gender_change_rebuilds(self):
+        with freeze_time(self.start):
+            self.member.sale_set.create(product=self.beer, price=self.beer.price)
+            female = self.member.calculate_alcohol_promille()
+            self.member.gender = "M"
+            self.member.save()
+
+            self.assertLess(self.member.calculate_alcohol_promille(), female)
+            self.assertMatchesReplay(timezone.now())
+
+
+class RoomBoardTests(TestCase):
+    def setUp(self):
+        # Room ids are used again between tests, so don't let a board from another test through
+        stregsystem_board._room_boards.clear()
+        self.room = Room.objects.create(name="test", description="test")
+        self.other_room = Room.objects.create(name="other", description="other")
+        # Just about the middle of the Ballmer peak for a man
+        self.strong = Product.objects.create(name="snaps", price=10, alcohol_content_ml=94.9, active=True)
+        self.coffee = Product.objects.create(name="kaffe", price=5, caffeine_content_mg=CAFFEINE_IN_COFFEE, active=True)
+        self.milk = Product.objects.create(name="mælk", price=5, active=True)
+        self.now = timezone.datetime(2000, 1, 1, 12, tzinfo=pytz.UTC)
+
+    def buy(self, member, product, room, hours_ago=0.0):
+        with freeze_time(self.now - datetime.timedelta(hours=hours_ago)):
+            member.sale_set.create(product=product, room=room, price=product.price)
+
+    def test_board(self):
+        peaker = Member.objects.create(username="peaker", gender="M")
+        addict = Member.objects.create(username="addict", gender="F")
+        elsewhere = Member.objects.create(username="elsewhere", gender="M")
+        self.buy(peaker, self.strong, self.room)
+        self.buy(peaker, self.coffee, self.other_room, hours_ago=3)
+        for hours_ago in (0, 2, 30):
+            self.buy(addict, self.coffee, self.room, hours_ago)
+        self.buy(elsewhere, self.strong, self.other_room)
+
+        # The members, and their intake states, however many members there are
+        compute_room_board(self.room.id, self.now)
+        with self.assertNumQueries(2):
+            board = compute_room_board(self.room.id, self.now)
+
+        self.assertEqual([p.username for p in board.ballmer_peakers], ["peaker"])
+        with freeze_time(self.now):
+            self.assertAlmostEqual(board.ballmer_peakers[0].promille, peaker.calculate_alcohol_promille(), places=9)
+            self.assertEqual(
+                [(level.username, level.caffeine) for level in board.caffeine_levels],
+                [("addict", addict.calculate_caffeine_in_body()), ("peaker", peaker.calculate_caffeine_in_body())],
+            )
+        self.assertEqual(board.caffeine_levels[0].cups, 1)
+
+    def test_inactive_and_sober_members_are_left_out(self):
+        inactive = Member.objects.create(username="inactive", gender="M", active=False)
+        sober = Member.objects.create(username="sober", gender="M")
+        self.buy(inactive, self.strong, self.room)
+        self.buy(sober, self.milk, self.room)
+        self.buy(sober, self.strong, self.room, hours_ago=13)
+
+        self.assertEqual(compute_room_board(self.room.id, self.now), RoomBoard(self.now, [], []))
+
+    def test_missing_states_are_built_together(self):
+        members = [Member.objects.create(username=f"member{i}", gender="M") for i in range(5)]
+        for member in members:
+            self.buy(member, self.strong, self.room, hours_ago=0.1)
+            self.buy(member, self.coffee, self.room)
+        expected = compute_room_board(self.room.id, self.now)
+        IntakeState.objects.all().delete()
+
+        # The members, their states and their sales. Only purchases store states.
+        with self.assertNumQueries(3):
+            board = compute_room_board(self.room.id, self.now)
+
+        self.assertEqual(board, expected)
+        self.assertEqual(IntakeState.objects.count(), 0)
+
+    def test_cached_for_a_while(self):
+        member = Member.objects.create(username="peaker", gender="M")
+        self.buy(member, self.coffee, self.room)
+
+        with freeze_time(self.now) as frozen_time:
+            board = get_room_board(self.room.id)
+            frozen_time.tick(BOARD_REFRESH_INTERVAL / 2)
+            with self.assertNumQueries(0):
+                self.assertIs(get_room_board(self.room.id), board)
+            frozen_time.tick(BOARD_REFRESH_INTERVAL / 2)
+            self.assertEqual(get_room_board(self.room.id).computed_at, timezone.now())
+
+    def test_api(self):
+        member = Member.objects.create(username="peaker", gender="M")
+        self.buy(member, self.strong, self.room, hours_ago=0.1)
+        self.buy(member, self.coffee, self.room)
+
+        with freeze_time(self.now):
+            response = self.client.get(reverse('api_room_board'), {'room_id': self.room.id})
+            page = self.client.get(reverse('room_board', args=(self.room.id,)))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['username'] for p in response.json()['ballmer_peak']], ["peaker"])
+        self.assertEqual(response.json()['caffeine'][0]['cups'], 1)
+        self.assertContains(page, "peaker")
+        self.assertEqual(self.client.get(reverse('api_room_board'), {'room_id': 1000}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_room_board')).status_code, 400)
+
+
 class CaffeineCalculatorTest(TestCase):
     def test_default_caffeine_is_zero(self):
         product = Product.objects.create(name="some product", price=420.0, active=True)
@@ -1903,7 +3086,7 @@ class CaffeineCalculatorTest(TestCase):
     def test_caffeine_degradation_for_1_to_10_hours(self):
         for hours in range(1, 10):
             with freeze_time() as frozen_datetime:
-                user = Member.objects.create(username="test", gender='M', balance=100)
+                user = Member.objects.create(username=f"test{hours}", gender='M', balance=100)
                 coffee = Product.objects.create(
                     name="Kaffe☕☕☕", price=1, caffeine_content_mg=CAFFEINE_IN_COFFEE, active=True
                 )
@@ -2041,6 +3224,205 @@ class CaffeineCalculatorTest(TestCase):
             self.assertFalse(average_developer.is_leading_coffee_addict())
 
 
+class WeeklyCoffeeCountTests(TestCase):
+    def setUp(self):
+        self.ida = Member.objects.create(username="ida", gender="F", balance=10000)
+        self.bo = Member.objects.create(username="bo", gender="M", balance=10000)
+        self.room = Room.objects.create(name="room", description="room")
+        coffee_category = Category.objects.create(name="Caffeine☕☕☕", pk=WeeklyCoffeeCount.COFFEE_CATEGORY_ID)
+        self.coffee = Product.objects.create(name="Kaffe☕☕☕", price=1, caffeine_content_mg=70, active=True)
+        self.coffee.categories.add(coffee_category)
+
+    def test_order_counts_coffee(self):
+        Order.from_products(self.ida, self.room, [self.coffee, self.coffee]).execute()
+
+        self.assertEqual(WeeklyCoffeeCount.objects.get(member=self.ida).count, 2)
+
+    def test_leader_is_one_lookup(self):
+        self.ida.sale_set.create(product=self.coffee, price=self.coffee.price)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.ida.is_leading_coffee_addict())
+
+    def test_tie_goes_to_first_username(self):
+        self.ida.sale_set.create(product=self.coffee, price=self.coffee.price)
+        self.bo.sale_set.create(product=self.coffee, price=self.coffee.price)
+
+        self.assertTrue(self.bo.is_leading_coffee_addict())
+
+    def test_refund_takes_coffee_off(self):
+        self.ida.sale_set.create(product=self.coffee, price=self.coffee.price)
+        sales = [self.bo.sale_set.create(product=self.coffee, price=self.coffee.price) for _ in range(2)]
+
+        Sale.objects.filter(id__in=[sale.id for sale in sales]).delete()
+
+        self.assertTrue(self.ida.is_leading_coffee_addict())
+        self.assertFalse(self.bo.is_leading_coffee_addict())
+
+    def test_new_week_starts_over(self):
+        with freeze_time(timezone.datetime(year=2021, day=5, month=12, hour=8)):
+            self.bo.sale_set.create(product=self.coffee, price=self.coffee.price)
+            self.bo.sale_set.create(product=self.coffee, price=self.coffee.price)
+
+        with freeze_time(timezone.datetime(year=2021, day=6, month=12, hour=8)):
+            self.assertFalse(self.bo.is_leading_coffee_addict())
+            self.ida.sale_set.create(product=self.coffee, price=self.coffee.price)
+
+            self.assertTrue(self.ida.is_leading_coffee_addict())
+            self.assertEqual(WeeklyCoffeeCount.objects.count(), 1)
+
+    def test_categorising_as_coffee_recounts(self):
+        tea = Product.objects.create(name="Te", price=1, active=True)
+        self.bo.sale_set.create(product=tea, price=tea.price)
+
+        tea.categories.add(WeeklyCoffeeCount.COFFEE_CATEGORY_ID)
+
+        self.assertTrue(self.bo.is_leading_coffee_addict())
+
+    def test_other_categories_leave_count_alone(self):
+        tea = Product.objects.create(name="Te", price=1, active=True)
+        self.bo.sale_set.create(product=tea, price=tea.price)
+        category = Category.objects.create(name="Te")
+
+        with CaptureQueriesContext(connection) as queries:
+            tea.categories.add(category)
+            category.product_set.add(self.coffee)
+
+        self.assertFalse(any("stregsystem_sale" in query["sql"] for query in queries.captured_queries))
+
+    def test_unsold_coffee_leaves_count_alone(self):
+        with freeze_time(timezone.datetime(year=2021, day=5, month=12, hour=8)):
+            tea = Product.objects.create(name="Te", price=1, active=True)
+            self.bo.sale_set.create(product=tea, price=tea.price)
+
+        with CaptureQueriesContext(connection) as queries:
+            tea.categories.add(WeeklyCoffeeCount.COFFEE_CATEGORY_ID)
+
+        self.assertFalse(any("stregsystem_weeklycoffeecount" in query["sql"] for query in queries.captured_queries))
+
+    def test_rebuild_command(self):
+        self.ida.sale_set.create(product=self.coffee, price=self.coffee.price)
+        WeeklyCoffeeCount.objects.filter(member=self.ida).update(count=0)
+        WeeklyCoffeeCount.objects.create(
+            week_start=WeeklyCoffeeCount.week_start_of(timezone.now()), member=self.bo, count=42
+        )
+
+        call_command("rebuildcoffeeleaderboard", stdout=StringIO())
+
+        self.assertTrue(self.ida.is_leading_coffee_addict())
+
+
+class DailySalesTests(TestCase):
+    def setUp(self):
+        self.ida = Member.objects.create(username="ida", gender="F", balance=10000)
+        self.room = Room.objects.create(name="room", description="room")
+        self.beer = Product.objects.create(name="Øl", price=900, active=True)
+        self.beer.categories.add(Category.objects.create(name="Øl"))
+        self.cola = Product.objects.create(name="Cola", price=1000, active=True)
+        self.cola.categories.add(Category.objects.create(name="Sodavand"))
+
+    def test_order_sums_up_day(self):
+        Order.from_products(self.ida, self.room, [self.beer, self.beer, self.cola]).execute()
+
+        day = DailySales.objects.get(member=self.ida, date=timezone.localdate())
+        self.assertEqual(day.count, 3)
+        self.assertEqual(day.money, 2800)
+        self.assertEqual(day.color_counts(), (2, 0, 1))
+        self.assertEqual(Counter(day.product_ids()), {self.beer.id: 2, self.cola.id: 1})
+
+    def test_refund_takes_sale_off(self):
+        beer_sale = self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+        self.ida.sale_set.create(product=self.cola, price=self.cola.price)
+
+        beer_sale.delete()
+
+        day = DailySales.objects.get(member=self.ida)
+        self.assertEqual((day.count, day.money, day.color_counts()), (1, 1000, (0, 0, 1)))
+        self.assertEqual(day.product_ids(), [self.cola.id])
+
+    def test_refunding_whole_day_removes_it(self):
+        self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+
+        Sale.objects.filter(member=self.ida).delete()
+
+        self.assertFalse(DailySales.objects.exists())
+
+    def test_days_follow_local_time(self):
+        # Half past midnight in Copenhagen is still the day before in UTC
+        with freeze_time(timezone.datetime(2021, 12, 5, 23, 30, tzinfo=datetime.timezone.utc)):
+            self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+
+        self.assertEqual(DailySales.objects.get(member=self.ida).date, datetime.date(2021, 12, 6))
+
+    def test_categorising_recounts_colors(self):
+        self.ida.sale_set.create(product=self.cola, price=self.cola.price)
+
+        self.cola.categories.add(Category.objects.create(name="Energidrik"))
+
+        self.assertEqual(DailySales.objects.get(member=self.ida).color_counts(), (0, 1, 1))
+
+    def test_categorising_recounts_only_days_with_product(self):
+        bob = Member.objects.create(username="bob", gender="M", balance=10000)
+        with freeze_time(timezone.datetime(2021, 12, 5, 12)):
+            self.ida.sale_set.create(product=self.cola, price=self.cola.price)
+        self.ida.sale_set.create(product=self.cola, price=self.cola.price)
+        bob.sale_set.create(product=self.beer, price=self.beer.price)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.cola.categories.add(Category.objects.create(name="Energidrik"))
+
+        self.assertFalse([query for query in queries if 'stregsystem_sale' in query['sql']])
+
+        self.assertEqual(DailySales.objects.get(member=self.ida, date=timezone.localdate()).color_counts(), (0, 1, 1))
+        self.assertEqual(DailySales.objects.get(member=bob).color_counts(), (1, 0, 0))
+        # Older than the heatmap, so left for rebuilddailysales
+        self.assertEqual(
+            DailySales.objects.get(member=self.ida, date=datetime.date(2021, 12, 5)).color_counts(), (0, 0, 1)
+        )
+
+    def test_clearing_categories_recounts_colors(self):
+        self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+        self.ida.sale_set.create(product=self.cola, price=self.cola.price)
+
+        self.beer.categories.clear()
+
+        self.assertEqual(DailySales.objects.get(member=self.ida).color_counts(), (0, 0, 1))
+
+    def test_rebuild_command(self):
+        with freeze_time(timezone.datetime(2021, 12, 5, 12)):
+            self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+        self.ida.sale_set.create(product=self.cola, price=self.cola.price)
+        expected = list(DailySales.objects.order_by('date').values_list('date', 'count', 'money', 'product_counts'))
+        DailySales.objects.update(count=0, money=0)
+
+        call_command("rebuilddailysales", stdout=StringIO())
+
+        actual = list(DailySales.objects.order_by('date').values_list('date', 'count', 'money', 'product_counts'))
+        self.assertEqual(actual, expected)
+
+    def test_rebuild_since(self):
+        with freeze_time(timezone.datetime(2021, 12, 5, 12)):
+            self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+        self.ida.sale_set.create(product=self.cola, price=self.cola.price)
+        DailySales.objects.update(count=42)
+
+        DailySales.rebuild(since=datetime.date(2021, 12, 6))
+
+        self.assertEqual(DailySales.objects.get(date=datetime.date(2021, 12, 5)).count, 42)
+        self.assertEqual(DailySales.objects.get(date=timezone.localdate()).count, 1)
+
+    def test_heatmap_reads_one_row_per_day(self):
+        for _ in range(30):
+            self.ida.sale_set.create(product=self.beer, price=self.beer.price)
+
+        with self.assertNumQueries(1):
+            context = prepare_heatmap_template_context(self.ida, 12, timezone.localdate())
+            days = [day for weekday_label, weekdays in context['rows'] for day in weekdays]
+
+        self.assertLessEqual(len(days), 84)
+        self.assertEqual(sum(len(day.products) for day in days), 30)
+
+
 class SignupTest(TestCase):
     def setUp(self):
         self.autopayment_user = User.objects.create_superuser('autopayment', 'foo@bar.com', 'hunter2')
@@ -2315,6 +3697,287 @@ class MailTests(TestCase):
         mock_mail_method.assert_called_once()
 
 
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Just enough of an SMTP server on localhost to take mails from smtplib, turning down the refused addresses."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, refused=()):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.refused = set(refused)
+        self.connections = 0
+        self.messages = []
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 localhost")
+        recipient = None
+        while line := self.rfile.readline().decode().strip():
+            command = line.split(" ", 1)[0].upper()
+            if command == "RCPT":
+                recipient = line.split(":", 1)[1].strip("<> ")
+                self.reply("550 no such user" if recipient in self.server.refused else "250 OK")
+            elif command == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                while (data_line := self.rfile.readline().decode()) not in (".\r\n", ""):
+                    data.append(data_line)
+                self.server.messages.append((recipient, "".join(data)))
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class MailQueueTests(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create(username="jeff", email="jeff@example.com")
+        OutgoingMail.objects.all().delete()
+
+    def queue(self, recipient):
+        member = Member(username="jeff", email=recipient)
+        send_template_mail(member, "welcome.html", {'formatted_balance': "0.00"}, "Velkommen")
+
+    def test_mail_is_queued_with_the_transaction(self):
+        self.queue("jeff@example.com")
+        try:
+            with transaction.atomic():
+                self.queue("rolled@example.com")
+                raise IntegrityError()
+        except IntegrityError:
+            pass
+
+        self.assertEqual(list(OutgoingMail.objects.values_list('recipient', flat=True)), ["jeff@example.com"])
+
+    def test_send_batch_over_one_connection(self):
+        for i in range(5):
+            self.queue(f"member{i}@example.com")
+
+        with FakeSMTPServer() as server:
+            worker = MailWorker("127.0.0.1", server.port)
+            self.assertEqual(worker.send_due(batch_size=3), 3)
+            self.assertEqual(worker.send_due(batch_size=3), 2)
+            self.assertEqual(worker.send_due(batch_size=3), 0)
+            worker.close()
+
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(
+            [recipient for recipient, message in server.messages], [f"member{i}@example.com" for i in range(5)]
+        )
+        self.assertIn("Subject: Velkommen", server.messages[0][1])
+        self.assertFalse(OutgoingMail.objects.filter(sent_at__isnull=True).exists())
+        self.assertFalse(OutgoingMail.objects.filter(next_attempt_at__isnull=False).exists())
+
+    def test_refused_mail_backs_off(self):
+        self.queue("nobody@example.com")
+        self.queue("jeff@example.com")
+
+        with freeze_time(timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)) as frozen_time:
+            OutgoingMail.objects.update(next_attempt_at=timezone.now())
+            with FakeSMTPServer(refused=["nobody@example.com"]) as server:
+                worker = MailWorker("127.0.0.1", server.port)
+                worker.send_due()
+                refused = OutgoingMail.objects.get(recipient="nobody@example.com")
+                self.assertEqual(refused.attempts, 1)
+                self.assertEqual(refused.next_attempt_at, timezone.now() + MAIL_RETRY_DELAY)
+                self.assertIn("no such user", refused.last_error)
+
+                # Not due yet
+                self.assertEqual(worker.send_due(), 0)
+
+                for attempt in range(2, MAIL_MAX_ATTEMPTS + 1):
+                    frozen_time.tick(MAIL_RETRY_DELAY * 2 ** (attempt - 2))
+                    self.assertEqual(worker.send_due(), 1)
+                worker.close()
+
+        refused.refresh_from_db()
+        self.assertEqual(refused.attempts, MAIL_MAX_ATTEMPTS)
+        self.assertIsNone(refused.next_attempt_at)
+        self.assertIsNone(refused.sent_at)
+        self.assertEqual([recipient for recipient, message in server.messages], ["jeff@example.com"])
+        # The refusals don't cost a new connection
+        self.assertEqual(server.connections, 1)
+
+    def test_server_down_retries_later(self):
+        self.queue("jeff@example.com")
+        with FakeSMTPServer() as server:
+            port = server.port
+
+        MailWorker("127.0.0.1", port).send_due()
+
+        mail = OutgoingMail.objects.get()
+        self.assertEqual(mail.attempts, 1)
+        self.assertIsNone(mail.sent_at)
+        self.assertGreater(mail.next_attempt_at, timezone.now())
+
+    def test_command(self):
+        self.queue("jeff@example.com")
+        with (
+            FakeSMTPServer() as server,
+            self.settings(STREGSYSTEM_MAIL_HOST="127.0.0.1", STREGSYSTEM_MAIL_PORT=server.port),
+        ):
+            call_command("sendqueuedmail", stdout=StringIO())
+
+        self.assertEqual(len(server.messages), 1)
+        self.assertIsNotNone(OutgoingMail.objects.get().sent_at)
+
+    def test_purge(self):
+        with freeze_time(timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)) as frozen_time:
+            for recipient in ["sent@example.com", "failed@example.com", "waiting@example.com"]:
+                self.queue(recipient)
+            OutgoingMail.objects.filter(recipient="sent@example.com").update(
+                next_attempt_at=None, sent_at=timezone.now()
+            )
+            OutgoingMail.objects.filter(recipient="failed@example.com").update(next_attempt_at=None)
+
+            frozen_time.tick(MAIL_KEEP_SENT + datetime.timedelta(seconds=1))
+            self.assertEqual(purge_outbox(), 1)
+
+            frozen_time.tick(MAIL_KEEP_FAILED)
+            self.assertEqual(purge_outbox(), 1)
+
+        self.assertEqual(list(OutgoingMail.objects.values_list('recipient', flat=True)), ["waiting@example.com"])
+
+
+class RateLimiterTests(TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter("test", limit=2, period=datetime.timedelta(minutes=1))
+
+    def test_limit_per_window(self):
+        with freeze_time(timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)) as frozen_time:
+            self.assertIsNone(self.limiter.hit(1))
+            self.assertIsNone(self.limiter.hit(1))
+            self.assertEqual(self.limiter.hit(1), timezone.now() + datetime.timedelta(minutes=1))
+            # Other subjects have their own count
+            self.assertIsNone(self.limiter.hit(2))
+
+            frozen_time.tick(datetime.timedelta(minutes=1))
+            self.assertIsNone(self.limiter.hit(1))
+
+    def test_expired_windows_are_deleted(self):
+        with freeze_time(timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)) as frozen_time:
+            for subject in range(10):
+                self.limiter.hit(subject)
+            frozen_time.tick(datetime.timedelta(minutes=2))
+            self.limiter.hit("new")
+
+        self.assertEqual(list(RateLimit.objects.values_list('key', flat=True)), ["test:new"])
+
+    def test_reset(self):
+        self.limiter.hit(1)
+        self.limiter.hit(1)
+        self.limiter.reset(1)
+
+        self.assertIsNone(self.limiter.hit(1))
+
+    def test_payment_qr(self):
+        url = reverse('api_payment_qr') + "?username=jokke&amount=20"
+        with freeze_time(timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)):
+            for _ in range(payment_qr_limiter.limit):
+                self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertEqual(self.client.get(url).status_code, 429)
+            self.assertEqual(self.client.get(url.replace("jokke", "JOKKE")).status_code, 429)
+            self.assertEqual(self.client.get(url.replace("jokke", "jan")).status_code, 200)
+
+
+class MemberSalesApiTests(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create(username="jon")
+        self.room = Room.objects.create(name="room", description="room")
+        self.beer = Product.objects.create(name="beer", price=100, active=True)
+        self.flan = Product.objects.create(name="flan", price=200, active=True)
+        with freeze_time(timezone.datetime(2000, 1, 1, tzinfo=pytz.UTC)) as frozen_time:
+            self.sales = []
+            for product in [self.beer, self.flan] * 3:
+                self.sales.append(Sale.objects.create(member=self.member, product=product, room=self.room, price=50))
+                frozen_time.tick()
+        self.newest_first = [sale.id for sale in reversed(self.sales)]
+
+    def get_sales(self, **params):
+        response = self.client.get(reverse('api_member_sales_v2'), {'member_id': self.member.id, **params})
+        self.assertEqual(200, response.status_code)
+        return json.loads(b"".join(response.streaming_content))
+
+    def test_sales(self):
+        sale = self.get_sales(count=1)['sales'][0]
+
+        self.assertEqual(self.sales[-1].id, sale['id'])
+        self.assertEqual("flan", sale['product'])
+        self.assertEqual(self.flan.id, sale['product_id'])
+        self.assertEqual(self.room.id, sale['room_id'])
+        # What was paid, not what the product costs now
+        self.assertEqual(50, sale['price'])
+        self.assertEqual("2000-01-01T00:00:05Z", sale['timestamp'])
+
+    def test_walk_older_and_newer(self):
+        pages = [self.get_sales(count=4)]
+        while pages[-1]['next'] is not None:
+            pages.append(self.get_sales(count=4, before=pages[-1]['next']))
+        self.assertEqual([sale['id'] for page in pages for sale in page['sales']], self.newest_first)
+
+        newer = self.get_sales(count=2, after=pages[-1]['sales'][-1]['cursor'])
+        self.assertEqual([sale.id for sale in self.sales[1:3]], [sale['id'] for sale in newer['sales']])
+        rest = self.get_sales(after=newer['next'])
+        self.assertEqual([sale.id for sale in self.sales[3:]], [sale['id'] for sale in rest['sales']])
+        self.assertIsNone(rest['next'])
+
+    def test_queries_do_not_grow_with_page(self):
+        with self.assertNumQueries(2):
+            self.get_sales(count=6)
+
+    def test_count_is_capped(self):
+        with patch('stregsystem.views.MEMBER_SALES_MAX_COUNT', 2):
+            page = self.get_sales(count=5)
+
+        self.assertEqual(self.newest_first[:2], [sale['id'] for sale in page['sales']])
+        self.assertIsNotNone(page['next'])
+
+    def test_invalid_parameters(self):
+        url = reverse('api_member_sales_v2')
+        for params, message in [
+            ({}, b"Parameter missing: member_id"),
+            ({'member_id': 9999}, b"Member not found"),
+            ({'member_id': self.member.id, 'count': 0}, b"Parameter invalid: count"),
+            ({'member_id': self.member.id, 'before': "a_b"}, b"Parameter invalid: before"),
+            ({'member_id': self.member.id, 'before': "1_1", 'after': "1_1"}, b"Parameter invalid: only one"),
+        ]:
+            response = self.client.get(url, params)
+            self.assertEqual(400, response.status_code)
+            self.assertTrue(response.content.startswith(message), response.content)
+
+    def test_v1_sales_have_price_paid(self):
+        response = self.client.get(reverse('api_member_sales'), {'member_id': self.member.id, 'count': 2})
+
+        sales = response.json()['sales']
+        self.assertEqual([("flan", 50), ("beer", 50)], [(sale['product'], sale['price']) for sale in sales])
+
+    def test_v1_invalid_count(self):
+        for count in ["a", "-1", 0]:
+            response = self.client.get(reverse('api_member_sales'), {'member_id': self.member.id, 'count': count})
+            self.assertEqual(400, response.status_code)
+            self.assertEqual(b"Parameter invalid: count", response.content)
+
+
 class DateAttributeTestCase(TestCase):
     def test_created_at_field(self):
         now = timezone.now()
@@ -2341,6 +4004,21 @@ class ApiTests(TestCase):
         member = Member.objects.create(username="martin_p", email="test@example.com", signup_due_paid=False)
         member.save()
 
+    def test_sale_echoes_item_counts(self):
+        member = Member.objects.create(username="jon", balance=10000)
+        room = Room.objects.create(name="room", description="room")
+        product = Product.objects.create(name="beer", price=100, active=True)
+
+        response = self.client.post(
+            reverse('api_sale'),
+            json.dumps({'buystring': f"jon {product.id}:3", 'room': room.id, 'member_id': member.id}),
+            content_type="application/json",
+        )
+
+        order = response.json()['values']['order']
+        self.assertEqual(order['item_counts'], [{'id': product.id, 'count': 3}])
+        self.assertEqual(order['items'], [product.id] * 3)
+
     def test_signup_duplicate_username(self):
         response = self.client.post(
             reverse('api_signup'),
@@ -26,6 +26,7 @@ urlpatterns = [
     re_path(r'^signup/$', views.signup, name="signup"),
     re_path(r'^signup/(?P<signup_id>\d+)$', views.signup_status, name="signup_status"),
     re_path(r'^(?P<room_id>\d+)/$', views.index, name="menu_index"),
+    re_path(r'^(?P<room_id>\d+)/board/$', views.room_board, name="room_board"),
     re_path(r'^(?P<room_id>\d+)/sale/$', views.sale, name="quickbuy"),
     re_path(r'^(?P<room_id>\d+)/sale/(?P<member_id>\d+)/$', views.menu_sale, name="menu"),
     re_path(r'^(?P<room_id>\d+)/sale/\d+/\d+/$', lambda request, room_id: redirect('menu_index', room_id=room_id), name="menu_sale"),
@@ -36,12 +37,14 @@ urlpatterns = [
     re_path(r'^api/member/payment/qr$', views.get_payment_qr, name="api_payment_qr"),
     re_path(r'^api/member/active$', views.get_member_active, name="api_member_active"),
     re_path(r'^api/member/sales$', views.get_member_sales, name="api_member_sales"),
+    re_path(r'^api/v2/member/sales$', views.get_member_sales_v2, name="api_member_sales_v2"),
     re_path(r'^api/member/get_id$', views.get_member_id, name="api_member_id"),
     re_path(r'^api/member/balance$', views.get_member_balance, name="api_member_balance"),
     re_path(r'^api/member$', views.get_member_info, name="api_member_info"),
     re_path(r'^api/products/named_products$', views.get_named_products, name="api_named_products"),
     re_path(r'^api/products/active_products$', views.get_active_items, name="api_active_products"),
     re_path(r'^api/products/category_mappings$', views.get_product_category_mappings, name="api_product_mappings"),
+    re_path(r'^api/room/board$', views.get_room_board_api, name="api_room_board"),
     re_path(r'^api/sale$', views.api_sale, name="api_sale"),
     re_path(r'^api/version$', views.api_version, name="api_version"),
     re_path(r'^api/signup$', views.post_signup, name="api_signup"),
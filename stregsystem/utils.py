@@ -1,6 +1,8 @@
+import csv
+import datetime
+import io
 import logging
 import re
-import csv
 
 from django.utils.dateparse import parse_datetime
 from django.conf import settings
@@ -8,9 +10,12 @@ from django.core.exceptions import ValidationError
 from django.http import HttpResponse
 from django.test.runner import DiscoverRunner
 
-from django.db.models import Count, F, Q, QuerySet
+from django.db.models import F, Q, QuerySet, Value
+from django.db.models.functions import Lower
+from django.db.models.lookups import Exact
 from django.utils import timezone
 
+import pytz
 import qrcode
 import qrcode.image.svg
 
@@ -19,41 +24,31 @@ import urllib.parse
 logger = logging.getLogger(__name__)
 
 
+def sold_out_query() -> Q:
+    # Products without sales have never been sold out, even when their quantity is 0
+    return Q(start_date__isnull=False) & Q(sold_count__gte=F("quantity")) & Q(sold_count__gt=0)
+
+
 def make_active_productlist_query(queryset) -> QuerySet:
     now = timezone.now()
-    # Create a query for the set of products that MIGHT be active. Might
-    # because they can be out of stock. Which we compute later
     active_candidates = queryset.filter(
         Q(active=True)
         & (Q(deactivate_date=None) | Q(deactivate_date__gte=now))
         & (Q(start_date__isnull=True) | Q(start_date__lte=now.date()))
     )
-    # This query selects all the candidates that are out of stock.
-    candidates_out_of_stock = (
-        active_candidates.filter(sale__timestamp__gt=F("start_date"))
-        .annotate(c=Count("sale__id"))
-        .filter(c__gte=F("quantity"))
-        .values("id")
-    )
-    # We can now create a query that selects all the candidates which are not
-    # out of stock.
-    return active_candidates.exclude(Q(start_date__isnull=False) & Q(id__in=candidates_out_of_stock))
+    # The sold counter on the product tells us which candidates are out of stock
+    return active_candidates.exclude(sold_out_query())
 
 
 def make_inactive_productlist_query(queryset) -> QuerySet:
     now = timezone.now()
-    # Create a query of things which are definitively inactive. Some of the ones
-    # filtered here might be out of stock, but we include that later.
-    inactive_candidates = queryset.exclude(
-        Q(active=True) & (Q(deactivate_date=None) | Q(deactivate_date__gte=now))
-    ).values("id")
-    inactive_out_of_stock = (
-        queryset.filter(sale__timestamp__gt=F("start_date"))
-        .annotate(c=Count("sale__id"))
-        .filter(c__gte=F("quantity"))
-        .values("id")
-    )
-    return queryset.filter(Q(id__in=inactive_candidates) | Q(id__in=inactive_out_of_stock))
+    inactive = ~(Q(active=True) & (Q(deactivate_date=None) | Q(deactivate_date__gte=now)))
+    return queryset.filter(inactive | sold_out_query())
+
+
+def make_username_query(username, field="username") -> Q:
+    # Lowercasing both sides in the database matches the index on Lower(username), which iexact can't use
+    return Q(Exact(Lower(field), Lower(Value(username))))
 
 
 def make_room_specific_query(room) -> QuerySet:
@@ -106,6 +101,21 @@ def make_unprocessed_membership_payment_query() -> QuerySet:
     )
 
 
+# date of fjuleparty (first friday of december) for the given year at
+# 10 o'clock
+def fjule_party(year):
+    first_december = timezone.datetime(year, 12, 1, 22, tzinfo=pytz.timezone("Europe/Copenhagen"))
+    days_to_add = (11 - first_december.weekday()) % 7
+    return first_december + datetime.timedelta(days=days_to_add)
+
+
+def fjule_year_of(timestamp):
+    """The fjule year a timestamp belongs to, which runs from the fjuleparty of the year before until its own."""
+    if timestamp > fjule_party(timestamp.year):
+        return timestamp.year + 1
+    return timestamp.year
+
+
 def date_to_midnight(date):
     """
     Converts a datetime.date to a datetime of the same date at midnight.
@@ -150,7 +160,7 @@ def parse_csv_and_create_mobile_payments(csv_file):
 def mobile_payment_exact_match_member(comment):
     from stregsystem.models import Member
 
-    match = Member.objects.filter(username__iexact=comment.strip(), active=True)
+    match = Member.objects.filter(make_username_query(comment.strip()), active=True)
     if match.count() == 1:
         return match.get()
     elif match.count() > 1:
@@ -201,16 +211,16 @@ class PaymentToolException(RuntimeError):
         self.inconsistent_transaction_ids = [x.transaction_id for x in self.racy_mbpayments]
 
 
-class fakefile:
-    data = ""
-
-    def write(self, data):
-        self.data += data
+# little function to make sure the csv data always has the same format
+def write_csv(file, rows):
+    """Writes the rows to the file one at a time, so the rows can be streamed from the database."""
+    writer = csv.writer(file)
+    for row in rows:
+        # Converting elements in rows to strings to ensure it can be written to the file object
+        writer.writerow([str(item) for item in row])
 
 
-# little function to make sure the csv data always has the same format
 def rows_to_csv(rows) -> str:
-    file = fakefile()
-    # Converting elements in rows to strings to ensure it can be written to the file object
-    csv.writer(file).writerows([[str(item) for item in row] for row in rows])
-    return file.data
+    file = io.StringIO()
+    write_csv(file, rows)
+    return file.getvalue()
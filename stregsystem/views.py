@@ -1,38 +1,48 @@
 import datetime
 import io
 import json
-from typing import List, Type
+import math
+from typing import NamedTuple, Optional, Type
 
 import pytz
 import qrcode
 import qrcode.image.svg
 from django import forms
 from django.conf import settings
-from collections import (
-    Counter,
-    namedtuple,
-)
+from collections import Counter
 
-from django.core.paginator import Paginator
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import permission_required
 from django.core import management
 from django.core.exceptions import ValidationError
-from django.db.models import Q, Count, Sum
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import OuterRef, Q, Subquery
 from django.forms import modelformset_factory
-from django.http import HttpResponsePermanentRedirect, HttpResponseBadRequest, JsonResponse
+from django.http import (
+    HttpResponse,
+    HttpResponsePermanentRedirect,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, render, redirect
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.views.decorators.csrf import csrf_exempt
 from django_select2 import forms as s2forms
 
-from stregreport.views import fjule_party
-
 from stregsystem import parser
+from stregsystem.catalog import (
+    CatalogResponse,
+    get_active_products_response,
+    get_alias_index,
+    get_category_mappings_response,
+    get_named_products_response,
+    get_room_catalog,
+)
 from stregsystem.models import (
     Member,
     Payment,
-    News,
     NoMoreInventoryError,
     Order,
     Product,
@@ -42,50 +52,83 @@ from stregsystem.models import (
     MobilePayment,
     PendingSignup,
     Category,
-    NamedProduct,
     ApprovalModel,
-    ProductNote,
 )
+from stregsystem.news import get_random_news
+from stregsystem.sale_writer import get_sale_writer
 from stregsystem.templatetags.stregsystem_extras import money
 from stregsystem.utils import (
-    make_active_productlist_query,
+    fjule_party,
+    fjule_year_of,
     qr_code,
     mobilepay_launch_uri,
-    make_room_specific_query,
     make_unprocessed_mobilepayment_query,
     parse_csv_and_create_mobile_payments,
     PaymentToolException,
     make_unprocessed_signups_query,
+    make_username_query,
 )
 
+from .board import get_room_board
 from .booze import ballmer_peak
 from .caffeine import caffeine_mg_to_coffee_cups
 from .forms import PaymentToolForm, QRPaymentForm, PurchaseForm, SignupForm, RankingDateForm, SignupToolForm
 from .management.commands.autopayment import submit_filled_mobilepayments
+from .pagination import InvalidCursor, keyset_page, make_cursor, seek
+from .ranking import category_ranks, leaderboard_category_ranks
+from .ratelimit import payment_qr_limiter, userdata_limiter
 from .purchase_heatmap import (
     prepare_heatmap_template_context,
 )
 
 
 def __get_news():
-    try:
-        current_time = timezone.now()
-        return News.objects.filter(stop_date__gte=current_time, pub_date__lte=current_time).order_by('?').first()
-    except News.DoesNotExist:
-        return None
+    return get_random_news()
 
 
-def __get_productlist(room_id):
-    return make_active_productlist_query(Product.objects).filter(make_room_specific_query(room_id))
+SALES_PER_PAGE = 10
 
+MEMBER_SALES_COUNT = 100
+MEMBER_SALES_MAX_COUNT = 1000
+MEMBER_SALES_CHUNK_SIZE = 200
 
-def __get_active_notes_for_product(product):
-    return ProductNote.objects.filter(
-        (Q(products=product))
-        & (Q(active=True))
-        & (Q(start_date__isnull=True) | Q(start_date__lte=timezone.now()))
-        & (Q(end_date__isnull=True) | Q(end_date__gte=timezone.now()))
-    )
+
+class MemberGate(NamedTuple):
+    member: Member
+    room: Optional[Room]
+    signup_approved: bool
+
+
+def __load_member_gate(request, room_id=None, *member_filters, **member_lookup) -> MemberGate:
+    """
+    Loads the member, the room and whether the member's signup has been approved, all in one query.
+    Remembered on the request, so views calling each other don't load it again.
+    Raises Member.DoesNotExist and Room.DoesNotExist like the lookups it replaces.
+    """
+    gates = {} if request is None else request.__dict__.setdefault('_member_gates', {})
+    key = (room_id, member_filters, tuple(sorted(member_lookup.items())))
+    if key in gates:
+        return gates[key]
+
+    # The first pending signup decides, just like Member.signup_approved
+    signup_status = PendingSignup.objects.filter(member=OuterRef('pk')).order_by('pk').values('status')[:1]
+    members = Member.objects.filter(*member_filters, **member_lookup).annotate(signup_status=Subquery(signup_status))
+    room_fields = [field.attname for field in Room._meta.concrete_fields]
+    if room_id is not None:
+        # Members have no relation to rooms to join on, but looking up the room by its key is cheap
+        room = Room.objects.filter(pk=room_id)
+        members = members.annotate(**{f'room_{field}': Subquery(room.values(field)) for field in room_fields})
+    member = members.get()
+
+    room = None
+    if room_id is not None:
+        if member.room_id is None:
+            raise Room.DoesNotExist("Room matching query does not exist.")
+        room = Room.from_db(members.db, room_fields, [getattr(member, f'room_{field}') for field in room_fields])
+
+    signup_approved = member.signup_status is None or member.signup_status == ApprovalModel.APPROVED
+    gates[key] = MemberGate(member, room, signup_approved)
+    return gates[key]
 
 
 def roomindex(request):
@@ -98,23 +141,27 @@ def roomindex(request):
 
 def index(request, room_id):
     room = get_object_or_404(Room, pk=int(room_id))
-    ProductNotePair = namedtuple('ProductNotePair', 'product note')
-    product_note_pair_list = [
-        ProductNotePair(product, __get_active_notes_for_product(product)) for product in __get_productlist(room_id)
-    ]
+    product_note_pair_list = get_room_catalog(room.id).product_note_pairs()
     news = __get_news()
     return render(request, 'stregsystem/index.html', locals())
 
 
+def room_board(request, room_id):
+    room = get_object_or_404(Room, pk=int(room_id))
+    board = get_room_board(room.id)
+    return render(request, 'stregsystem/room_board.html', locals())
+
+
 def _pre_process(buy_string):
     items = buy_string.split(' ')
     _items = [items[0]]
+    product_ids = get_alias_index().product_ids
 
     for item in items[1:]:
         if type(item) is not int:
-            _item = NamedProduct.objects.filter(name=item.split(':')[0].lower() if ':' in item else item)
-            if _item:
-                item = item.replace(item.split(':')[0], str(_item.get().product.pk))
+            product_id = product_ids.get(item.split(':')[0].lower() if ':' in item else item)
+            if product_id is not None:
+                item = item.replace(item.split(':')[0], str(product_id))
         _items.append(str(item))
 
     return ' '.join(_items)
@@ -123,11 +170,9 @@ def _pre_process(buy_string):
 def sale(request, room_id):
     room = get_object_or_404(Room, pk=room_id)
     news = __get_news()
-    product_list = __get_productlist(room_id)
-    ProductNotePair = namedtuple('ProductNotePair', 'product note')
-    product_note_pair_list = [
-        ProductNotePair(product, __get_active_notes_for_product(product)) for product in __get_productlist(room_id)
-    ]
+    catalog = get_room_catalog(room.id)
+    product_list = catalog.products
+    product_note_pair_list = catalog.product_note_pairs()
 
     buy_string = request.POST['quickbuy'].strip()
     # Handle empty line
@@ -135,7 +180,7 @@ def sale(request, room_id):
         return render(request, 'stregsystem/index.html', locals())
     # Extract username and product ids
     try:
-        username, bought_ids = parser.parse(_pre_process(buy_string))
+        username, bought_counts = parser.parse(_pre_process(buy_string))
     except parser.QuickBuyError as err:
         values = {
             'correct': err.parsed_part,
@@ -147,35 +192,37 @@ def sale(request, room_id):
         return render(request, 'stregsystem/error_invalidquickbuy.html', values)
     # Fetch member from DB
     try:
-        member = Member.objects.get(username__iexact=username, active=True)
+        gate = __load_member_gate(request, None, make_username_query(username), active=True)
     except Member.DoesNotExist:
         return render(request, 'stregsystem/error_usernotfound.html', locals())
+    member = gate.member
 
     if not member.signup_due_paid:
         return render(request, 'stregsystem/error_signupdue.html', locals())
 
-    if not member.signup_approved():
+    if not gate.signup_approved:
         return render(request, 'stregsystem/error_signup_not_approved.html', locals())
 
-    if len(bought_ids):
-        return quicksale(request, room, member, bought_ids)
+    if len(bought_counts):
+        return quicksale(request, room, member, bought_counts)
     else:
         return usermenu(request, room, member, None)
 
 
-def _multibuy_hint(now, member):
+def _multibuy_hint(now, member, activity=None):
+    if activity is None:
+        activity = member.recent_activity(now)
     # Get a timestamp to fetch sales for the member for the last 60 sec
     earliest_recent_sale = now - datetime.timedelta(seconds=60)
     # get the sales with this timestamp
-    recent_sales = Sale.objects.filter(member=member, timestamp__gt=earliest_recent_sale)
-    number_of_recent_distinct_sales = recent_sales.values('timestamp').distinct().count()
-    recent_unique_sales = recent_sales.values('product').distinct().annotate(total=Count('product'))
+    recent_sales = [sale for sale in activity.sales if sale.timestamp > earliest_recent_sale]
+    number_of_recent_distinct_sales = len({sale.timestamp for sale in recent_sales})
 
     # add hint for multibuy
     if number_of_recent_distinct_sales > 1:
         sale_dict = {}
-        for unique_sale in recent_unique_sales:
-            sale_dict[str(unique_sale['product'])] = unique_sale['total']
+        for product_id, total in sorted(Counter(sale.product_id for sale in recent_sales).items()):
+            sale_dict[str(product_id)] = total
         sale_hints = ["<span class=\"username\">{}</span>".format(member.username)]
         if all(sale_count == 1 for sale_count in sale_dict.values()):
             return (False, None)
@@ -189,22 +236,19 @@ def _multibuy_hint(now, member):
     return (False, None)
 
 
-def quicksale(request, room, member: Member, bought_ids):
+def quicksale(request, room, member: Member, bought_counts):
     news = __get_news()
-    product_list = __get_productlist(room.id)
-    ProductNotePair = namedtuple('ProductNotePair', 'product note')
-    product_note_pair_list = [
-        ProductNotePair(product, __get_active_notes_for_product(product)) for product in __get_productlist(room.id)
-    ]
+    catalog = get_room_catalog(room.id)
+    product_list = catalog.products
+    product_note_pair_list = catalog.product_note_pairs()
     now = timezone.now()
 
     # Retrieve products and construct transaction
-    products: List[Product] = []
-    msg, status, result = __append_bought_ids_to_product_list(products, bought_ids, now, room)
+    msg, status, result = __get_bought_product_counts(bought_counts, now, room)
     if status == 400:
         return render(request, 'stregsystem/error_productdoesntexist.html', {'failedProduct': result, 'room': room})
 
-    order = Order.from_products(member=member, products=products, room=room)
+    order = Order.from_product_counts(member=member, product_counts=result, room=room)
 
     msg, status, result = __execute_order(order)
     if 'Out of stock' in msg:
@@ -226,36 +270,40 @@ def quicksale(request, room, member: Member, bought_ids):
         sale_hints,
         member_has_low_balance,
         member_balance,
-    ) = __set_local_values(member, room, products, order, now)
+    ) = __set_local_values(member, room, order, now)
 
-    products = Counter([str(product.name) for product in products]).most_common()
+    products = Counter()
+    for item in order.items:
+        products[str(item.product.name)] += item.count
+    products = products.most_common()
 
     return render(request, 'stregsystem/index_sale.html', locals())
 
 
 def usermenu(request, room, member, bought, from_sale=False):
     negative_balance = member.balance < 0
-    product_list = __get_productlist(room.id)
-    ProductNotePair = namedtuple('ProductNotePair', 'product note')
-    product_note_pair_list = [
-        ProductNotePair(product, __get_active_notes_for_product(product)) for product in __get_productlist(room.id)
-    ]
+    catalog = get_room_catalog(room.id)
+    product_list = catalog.products
+    product_note_pair_list = catalog.product_note_pairs()
     news = __get_news()
-    promille = member.calculate_alcohol_promille()
+    activity = member.recent_activity()
+    promille = activity.alcohol_promille()
     (
         is_ballmer_peaking,
         bp_minutes,
         bp_seconds,
     ) = ballmer_peak(promille)
 
-    caffeine = member.calculate_caffeine_in_body()
+    caffeine = activity.caffeine_in_body()
     cups = caffeine_mg_to_coffee_cups(caffeine)
     is_coffee_master = member.is_leading_coffee_addict()
 
-    give_multibuy_hint, sale_hints = _multibuy_hint(timezone.now(), member)
+    give_multibuy_hint, sale_hints = _multibuy_hint(activity.now, member, activity)
     give_multibuy_hint = give_multibuy_hint and from_sale
 
-    heatmap_context = prepare_heatmap_template_context(member, 12, datetime.date.today())
+    heatmap_context = prepare_heatmap_template_context(
+        member, settings.STREGSYSTEM_HEATMAP_WEEKS, datetime.date.today()
+    )
 
     if member.has_stregforbud():
         return render(request, 'stregsystem/error_stregforbud.html', locals())
@@ -264,24 +312,33 @@ def usermenu(request, room, member, bought, from_sale=False):
 
 
 def menu_userinfo(request, room_id, member_id):
-    room = Room.objects.get(pk=room_id)
+    gate = __load_member_gate(request, room_id, pk=member_id, active=True)
+    room, member = gate.room, gate.member
     news = __get_news()
-    member = Member.objects.get(pk=member_id, active=True)
 
     if not member.signup_due_paid:
         return render(request, 'stregsystem/error_signupdue.html', locals())
 
-    if not member.signup_approved():
+    if not gate.signup_approved:
         return render(request, 'stregsystem/error_signup_not_approved.html', locals())
 
-    stats = Sale.objects.filter(member_id=member_id).aggregate(
-        total_amount=Sum('price'), total_purchases=Count('timestamp')
-    )
+    all_sales = member.sale_set.select_related('product')
+    try:
+        last_sale_page = keyset_page(
+            all_sales, SALES_PER_PAGE, older_than=request.GET.get('older'), newer_than=request.GET.get('newer')
+        )
+    except InvalidCursor:
+        last_sale_page = keyset_page(all_sales, SALES_PER_PAGE)
+    last_sale_list = last_sale_page.items
 
-    all_sales = member.sale_set.order_by('-timestamp')
-    paginator = Paginator(all_sales, 10)
-    list_number = request.GET.get('purchaselist', 1)
-    last_sale_list = paginator.get_page(list_number)
+    # The page number is only for show, the cursors decide which sales are on the page
+    num_pages = max(1, math.ceil(member.total_purchases / SALES_PER_PAGE))
+    try:
+        page_number = min(max(1, int(request.GET.get('side', 1))), num_pages)
+    except ValueError:
+        page_number = 1
+    if not last_sale_page.has_newer:
+        page_number = 1
 
     try:
         last_payment = member.payment_set.order_by('-timestamp')[0]
@@ -295,34 +352,35 @@ def menu_userinfo(request, room_id, member_id):
 
 
 def send_userdata(request, room_id, member_id):
-    from .mail import send_userdata_mail, data_sent
+    from .mail import send_userdata_mail
 
-    room = Room.objects.get(pk=room_id)
-    member = Member.objects.get(pk=member_id, active=True)
+    gate = __load_member_gate(request, room_id, pk=member_id, active=True)
+    room, member = gate.room, gate.member
 
     if not member.signup_due_paid:
         return render(request, 'stregsystem/error_signupdue.html', locals())
 
-    if not member.signup_approved():
+    if not gate.signup_approved:
         return render(request, 'stregsystem/error_signup_not_approved.html', locals())
 
-    mail_sent = send_userdata_mail(member)
-    sent_time = data_sent[member.id]
-    current_time = timezone.now()
-    td = current_time - sent_time
-    minutes = 5 - ((td.seconds % 3600) // 60)
+    retry_at = userdata_limiter.hit(member.id)
+    mail_sent = retry_at is None
+    if mail_sent:
+        send_userdata_mail(member)
+    else:
+        minutes = math.ceil((retry_at - timezone.now()) / datetime.timedelta(minutes=1))
 
     return render(request, "stregsystem/sent_userdata.html", locals())
 
 
 def menu_userpay(request, room_id, member_id):
-    room = Room.objects.get(pk=room_id)
-    member = Member.objects.get(pk=member_id, active=True)
+    gate = __load_member_gate(request, room_id, pk=member_id, active=True)
+    room, member = gate.room, gate.member
 
     if not member.signup_due_paid:
         return render(request, 'stregsystem/error_signupdue.html', locals())
 
-    if not member.signup_approved():
+    if not gate.signup_approved:
         return render(request, 'stregsystem/error_signup_not_approved.html', locals())
 
     amounts = {100, 200}
@@ -345,53 +403,15 @@ def menu_userpay(request, room_id, member_id):
 def menu_userrank(request, room_id, member_id):
     from_date = fjule_party(datetime.datetime.today().year - 1)
     to_date = datetime.datetime.now(tz=pytz.timezone("Europe/Copenhagen"))
-    room = Room.objects.get(pk=room_id)
-    member = Member.objects.get(pk=member_id, active=True)
+    gate = __load_member_gate(request, room_id, pk=member_id, active=True)
+    room, member = gate.room, gate.member
 
     if not member.signup_due_paid:
         return render(request, 'stregsystem/error_signupdue.html', locals())
 
-    if not member.signup_approved():
+    if not gate.signup_approved:
         return render(request, 'stregsystem/error_signup_not_approved.html', locals())
 
-    def ranking(category_ids, from_d, to_d):
-        qs = (
-            Member.objects.filter(sale__product__in=category_ids, sale__timestamp__gt=from_d, sale__timestamp__lte=to_d)
-            .annotate(Count('sale'))
-            .order_by('-sale__count', 'username')
-        )
-        if member not in qs:
-            return 0, qs.count()
-        return list(qs).index(Member.objects.get(id=member.id)) + 1, int(qs.count())
-
-    def get_product_ids_for_category(category) -> list:
-        return list(
-            Product.objects.filter(categories__exact=Category.objects.get(name__exact=category)).values_list(
-                'id', flat=True
-            )
-        )
-
-    def category_per_uni_day(category_ids, from_d, to_d):
-        qs = Member.objects.filter(
-            id=member.id,
-            sale__product__in=category_ids,
-            sale__timestamp__gt=from_d,
-            sale__timestamp__lte=to_d,
-        )
-        if member not in qs:
-            return 0
-        else:
-            return "{:.2f}".format(qs.count() / ((to_d - from_d).days * 162.14 / 365))  # university workdays in 2021
-
-    def sale_count_for_product(category_ids, from_d, to_d):
-        qs = Sale.objects.filter(
-            member=member,
-            product__in=category_ids,
-            timestamp__gt=from_d,
-            timestamp__lte=to_d,
-        )
-        return qs.count()
-
     # let user know when they first purchased a product
     member_first_purchase = "Ikke endnu, køb en limfjordsporter!"
     first_purchase = Sale.objects.filter(member=member_id).order_by('-timestamp')
@@ -408,33 +428,31 @@ def menu_userrank(request, room_id, member_id):
         # setup initial dates for form and results
         form = RankingDateForm(initial={'from_date': from_date, 'to_date': to_date})
 
-    # get prod_ids for each category as dict {cat: [key1, key2])}, then flatten list of singleton
-    # dicts into one dict, lastly calculate member_id rating and units/weekday for category_ids
-    rankings = {
-        key: (
-            ranking(category_ids, from_date, to_date),
-            category_per_uni_day(category_ids, from_date, to_date),
-            sale_count_for_product(category_ids, from_date, to_date),
-        )
-        for key, category_ids in {
-            k: v
-            for x in map(lambda x: {x: get_product_ids_for_category(x)}, list(Category.objects.all()))
-            for k, v in x.items()
-        }.items()
-    }
+    # rank/total, units per university workday and units bought for each category
+    year = fjule_year_of(to_date)
+    if not form.is_bound and from_date == fjule_party(year - 1):
+        # The ongoing fjule year, which the leaderboard already has summed up
+        category_ranks_by_id = leaderboard_category_ranks(year, member.id)
+    else:
+        category_ranks_by_id = category_ranks(member.id, from_date, to_date)
+    uni_days = (to_date - from_date).days * 162.14 / 365  # university workdays in 2021
+    rankings = {}
+    for category in Category.objects.all():
+        rank, participants, count = category_ranks_by_id.get(category.id, (0, 0, 0))
+        rankings[category] = ((rank, participants), "{:.2f}".format(count / uni_days) if count else 0, count)
 
     return render(request, 'stregsystem/menu_userrank.html', locals())
 
 
 def menu_sale(request, room_id, member_id, product_id=None):
-    room = Room.objects.get(pk=room_id)
+    gate = __load_member_gate(request, room_id, pk=member_id, active=True)
+    room, member = gate.room, gate.member
     news = __get_news()
-    member = Member.objects.get(pk=member_id, active=True)
 
     if not member.signup_due_paid:
         return render(request, 'stregsystem/error_signupdue.html', locals())
 
-    if not member.signup_approved():
+    if not gate.signup_approved:
         return render(request, 'stregsystem/error_signup_not_approved.html', locals())
 
     product = None
@@ -452,21 +470,18 @@ def menu_sale(request, room_id, member_id, product_id=None):
                 Q(rooms__id=room_id) | Q(rooms=None),
                 Q(deactivate_date__gte=timezone.now()) | Q(deactivate_date__isnull=True),
             )
-
+        except Product.DoesNotExist:
+            pass
+        else:
             order = Order.from_products(member=member, room=room, products=(product,))
 
-            order.execute()
+            msg, status, result = __execute_order(order)
+            if status != 200:
+                # @INCOMPLETE out of stock should render with a different template
+                return render(request, 'stregsystem/error_stregforbud.html', locals())
+            # The order has the member with the new balance
+            member = order.member
 
-        except Product.DoesNotExist:
-            pass
-        except StregForbudError:
-            return render(request, 'stregsystem/error_stregforbud.html', locals())
-        except NoMoreInventoryError:
-            # @INCOMPLETE this should render with a different template
-            return render(request, 'stregsystem/error_stregforbud.html', locals())
-
-    # Refresh member, to get new amount
-    member = Member.objects.get(pk=member_id, active=True)
     return usermenu(request, room, member, product, from_sale=True)
 
 
@@ -607,6 +622,9 @@ def get_payment_qr(request):
     username = form.cleaned_data.get('username')
     amount = form.cleaned_data.get('amount')
 
+    if payment_qr_limiter.hit(username.lower()) is not None:
+        return HttpResponse("Too many QR codes, try again in a minute", status=429)
+
     return qr_code(mobilepay_launch_uri(username, amount))
 
 
@@ -673,15 +691,40 @@ def get_active_items(request):
     elif not room_id.isdigit():
         return HttpResponseBadRequest("Parameter invalid: room_id")
 
-    try:
-        room = Room.objects.get(pk=room_id)
-    except Room.DoesNotExist:
+    if not Room.objects.filter(pk=room_id).exists():
         return HttpResponseBadRequest("Room not found")
 
-    # TODO: Check whether room exists
-    items = __get_productlist(room_id)
-    items_dict = {item.id: {'name': item.name, 'price': item.price} for item in items}
-    return JsonResponse(items_dict, json_dumps_params={'ensure_ascii': False})
+    return _catalog_response(request, get_active_products_response(room_id))
+
+
+def _catalog_response(request, catalog_response: CatalogResponse):
+    response = HttpResponse(catalog_response.body, content_type='application/json')
+    response['ETag'] = catalog_response.etag
+    # Clients may keep the body, but must ask whether it is still good before using it
+    patch_cache_control(response, no_cache=True)
+    return get_conditional_response(request, etag=catalog_response.etag, response=response)
+
+
+def get_room_board_api(request):
+    room_id = request.GET.get('room_id') or None
+
+    if room_id is None:
+        return HttpResponseBadRequest("Parameter missing: room_id")
+    elif not room_id.isdigit():
+        return HttpResponseBadRequest("Parameter invalid: room_id")
+
+    if not Room.objects.filter(pk=room_id).exists():
+        return HttpResponseBadRequest("Room not found")
+
+    board = get_room_board(room_id)
+    return JsonResponse(
+        {
+            'computed_at': board.computed_at,
+            'ballmer_peak': [peaker._asdict() for peaker in board.ballmer_peakers],
+            'caffeine': [level._asdict() for level in board.caffeine_levels],
+        },
+        json_dumps_params={'ensure_ascii': False},
+    )
 
 
 def get_member_active(request):
@@ -713,12 +756,7 @@ def get_member_id(request):
 
 
 def get_product_category_mappings(request):
-    return JsonResponse(
-        {
-            p.id: [{'category_id': cat.id, 'category_name': cat.name} for cat in p.categories.all()]
-            for p in Product.objects.all()
-        }
-    )
+    return _catalog_response(request, get_category_mappings_response())
 
 
 def get_member_sales(request):
@@ -733,13 +771,90 @@ def get_member_sales(request):
     except Member.DoesNotExist:
         return HttpResponseBadRequest("Member not found")
 
-    count = 10 if request.GET.get('count') is None else int(request.GET.get('count') or 10)
-    sales = Sale.objects.filter(member=member).order_by('-timestamp')[:count]
+    count = request.GET.get('count') or None
+    if count is None:
+        count = 10
+    elif not count.isdigit() or int(count) == 0:
+        return HttpResponseBadRequest("Parameter invalid: count")
+    else:
+        count = min(int(count), MEMBER_SALES_MAX_COUNT)
+
+    sales = Sale.objects.filter(member=member).select_related('product').order_by('-timestamp')[:count]
     return JsonResponse(
-        {'sales': [{'timestamp': s.timestamp, 'product': s.product.name, 'price': s.product.price} for s in sales]}
+        {'sales': [{'timestamp': s.timestamp, 'product': s.product.name, 'price': s.price} for s in sales]}
     )
 
 
+def get_member_sales_v2(request):
+    member_id = request.GET.get('member_id') or None
+    if member_id is None:
+        return HttpResponseBadRequest("Parameter missing: member_id")
+    elif not member_id.isdigit():
+        return HttpResponseBadRequest("Parameter invalid: member_id")
+
+    count = request.GET.get('count') or None
+    if count is None:
+        count = MEMBER_SALES_COUNT
+    elif not count.isdigit() or int(count) == 0:
+        return HttpResponseBadRequest("Parameter invalid: count")
+    else:
+        count = min(int(count), MEMBER_SALES_MAX_COUNT)
+
+    before = request.GET.get('before') or None
+    after = request.GET.get('after') or None
+    if before is not None and after is not None:
+        return HttpResponseBadRequest("Parameter invalid: only one of before and after can be given")
+
+    if not Member.objects.filter(pk=member_id).exists():
+        return HttpResponseBadRequest("Member not found")
+
+    try:
+        sales = seek(Sale.objects.filter(member_id=member_id), older_than=before, newer_than=after)
+    except InvalidCursor:
+        return HttpResponseBadRequest("Parameter invalid: before" if before is not None else "Parameter invalid: after")
+
+    rows = sales.values_list('id', 'timestamp', 'price', 'room_id', 'product_id', 'product__name')[: count + 1]
+    return StreamingHttpResponse(__stream_member_sales(rows, count), content_type='application/json')
+
+
+def __stream_member_sales(rows, count):
+    """
+    Writes the page as it is read, a chunk of sales at a time, so a long page is never held as one big string.
+    The query asks for one sale more than the page, which tells whether there is a next page.
+    """
+    yield '{"sales": ['
+    chunk = []
+    last = None
+    rows = rows.iterator(chunk_size=MEMBER_SALES_CHUNK_SIZE)
+    for sale_id, timestamp, price, room_id, product_id, product_name in rows:
+        if count == 0:
+            break
+        count -= 1
+        if last is not None:
+            chunk.append(',')
+        last = make_cursor(timestamp, sale_id)
+        sale = {
+            'id': sale_id,
+            'cursor': last,
+            'timestamp': timestamp,
+            'product_id': product_id,
+            'product': product_name,
+            'price': price,
+            'room_id': room_id,
+        }
+        chunk.append(json.dumps(sale, cls=DjangoJSONEncoder, ensure_ascii=False))
+        if len(chunk) >= MEMBER_SALES_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    else:
+        # The sales ran out before the page was full
+        last = None
+    chunk.append('], "next": ')
+    chunk.append(json.dumps(last))
+    chunk.append('}')
+    yield ''.join(chunk)
+
+
 def get_member_balance(request):
     member_id = request.GET.get('member_id') or None
     if member_id is None:
@@ -786,9 +901,7 @@ def find_user_from_id(user_id: int):
 
 
 def get_named_products(request):
-    items = NamedProduct.objects.all()
-    items_dict = {item.name: item.product.id for item in items}
-    return JsonResponse(items_dict, json_dumps_params={'ensure_ascii': False})
+    return _catalog_response(request, get_named_products_response())
 
 
 def get_signup_status(request):
@@ -871,19 +984,22 @@ def api_sale(request):
             return HttpResponseBadRequest("Parameter invalid: member_id")
 
         try:
-            username, bought_ids = parser.parse(_pre_process(buy_string))
+            username, bought_counts = parser.parse(_pre_process(buy_string))
         except parser.ParseError as e:
             return HttpResponseBadRequest("Parse error: {}".format(e))
 
         try:
-            member = Member.objects.get(pk=member_id)
+            gate = __load_member_gate(request, room, pk=member_id)
         except Member.DoesNotExist:
             return HttpResponseBadRequest("Member not found")
+        except Room.DoesNotExist:
+            return HttpResponseBadRequest("Parameter invalid: room")
+        member = gate.member
 
         if not member.signup_due_paid:
             return HttpResponseBadRequest("Signup due not paid")
 
-        if not member.signup_approved():
+        if not gate.signup_approved:
             return HttpResponseBadRequest("Signup not manually approved")
 
         if username != member.username:
@@ -892,27 +1008,21 @@ def api_sale(request):
         if not buy_string.startswith(member.username):
             buy_string = f'{member.username} {buy_string}'
 
-        try:
-            room = Room.objects.get(pk=room)
-        except Room.DoesNotExist:
-            return HttpResponseBadRequest("Parameter invalid: room")
-        msg, status, ret_obj = api_quicksale(request, room, member, bought_ids)
+        msg, status, ret_obj = api_quicksale(request, gate.room, member, bought_counts)
         return JsonResponse(
             {'status': status, 'msg': msg, 'values': ret_obj}, json_dumps_params={'ensure_ascii': False}
         )
 
 
-def api_quicksale(request, room, member: Member, bought_ids):
+def api_quicksale(request, room, member: Member, bought_counts):
     now = timezone.now()
 
     # Retrieve products and construct transaction
-    products: List[Product] = []
-
-    msg, status, result = __append_bought_ids_to_product_list(products, bought_ids, now, room)
+    msg, status, result = __get_bought_product_counts(bought_counts, now, room)
     if status == 400:
         return msg, status, result
 
-    order = Order.from_products(member=member, products=products, room=room)
+    order = Order.from_product_counts(member=member, product_counts=result, room=room)
 
     msg, status, result = __execute_order(order)
     if status != 200:
@@ -932,17 +1042,19 @@ def api_quicksale(request, room, member: Member, bought_ids):
         sale_hints,
         member_has_low_balance,
         member_balance,
-    ) = __set_local_values(member, room, products, order, now)
+    ) = __set_local_values(member, room, order, now)
 
     return (
         "OK",
-        200 if len(bought_ids) > 0 else 201,
+        200 if len(bought_counts) > 0 else 201,
         {
             'order': {
                 'room': order.room.id,
                 'member': order.member.id,
                 'created_on': order.created_on,
-                'items': bought_ids,
+                # Kept for older clients, item_counts says the same without repeating ids
+                'items': [product_id for product_id, count in bought_counts for _ in range(count)],
+                'item_counts': [{'id': product_id, 'count': count} for product_id, count in bought_counts],
             },
             'promille': promille,
             'is_ballmer_peaking': is_ballmer_peaking,
@@ -961,33 +1073,29 @@ def api_quicksale(request, room, member: Member, bought_ids):
     )
 
 
-def __append_bought_ids_to_product_list(products, bought_ids, time_now, room):
-    try:
-        # Get the amount of unique items bought
-        unique_product_dict = {}
-        for unique_id in bought_ids:
-            if unique_id not in unique_product_dict:
-                unique_product_dict[unique_id] = 1
-            else:
-                unique_product_dict[unique_id] += 1
+def __get_bought_product_counts(bought_counts, time_now, room):
+    # Fetch all the different products at once
+    found_products = Product.objects.filter(
+        Q(active=True),
+        Q(deactivate_date__gte=time_now) | Q(deactivate_date__isnull=True),
+        Q(rooms__id=room.id) | Q(rooms=None),
+    ).in_bulk([product_id for product_id, count in bought_counts])
 
-        # Add the given amount of different products
-        for key, value in unique_product_dict.items():
-            product = Product.objects.get(
-                Q(pk=key),
-                Q(active=True),
-                Q(deactivate_date__gte=time_now) | Q(deactivate_date__isnull=True),
-                Q(rooms__id=room.id) | Q(rooms=None),
-            )
-            products.extend([product for _ in range(value)])
-    except Product.DoesNotExist:
-        return "Invalid product id", 400, key
-    return "OK", 200, None
+    # Pair the products up with their counts, reporting the first one we couldn't find
+    product_counts = []
+    for product_id, count in bought_counts:
+        if product_id not in found_products:
+            return "Invalid product id", 400, product_id
+        product_counts.append((found_products[product_id], count))
+    return "OK", 200, product_counts
 
 
 def __execute_order(order):
     try:
-        order.execute()
+        if settings.STREGSYSTEM_GROUP_COMMIT:
+            get_sale_writer().execute(order)
+        else:
+            order.execute()
     except StregForbudError:
         return "Stregforbud", 403, None
     except NoMoreInventoryError:
@@ -996,20 +1104,24 @@ def __execute_order(order):
     return "OK", 200, None
 
 
-def __set_local_values(member, room, products, order, now):
-    promille = member.calculate_alcohol_promille()
+def __set_local_values(member, room, order, now):
+    # Everything but the coffee addict check is worked out from this one fetch
+    activity = member.recent_activity()
+
+    promille = activity.alcohol_promille()
     is_ballmer_peaking, bp_minutes, bp_seconds = ballmer_peak(promille)
 
-    caffeine = member.calculate_caffeine_in_body()
+    caffeine = activity.caffeine_in_body()
     cups = caffeine_mg_to_coffee_cups(caffeine)
-    product_contains_caffeine = any(product.caffeine_content_mg > 0 for product in products)
+    product_contains_caffeine = any(item.product.caffeine_content_mg > 0 for item in order.items)
     is_coffee_master = member.is_leading_coffee_addict()
 
     cost = order.total
 
-    give_multibuy_hint, sale_hints = _multibuy_hint(now, member)
+    give_multibuy_hint, sale_hints = _multibuy_hint(now, member, activity)
 
-    new_balance = Member.objects.get(pk=member.id).balance
+    # The order locked and saved the member, so it holds the new balance
+    new_balance = order.member.balance
     member_has_low_balance = new_balance <= 5000
     member_balance = money(new_balance)
 
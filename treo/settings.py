@@ -52,6 +52,17 @@ PASSWORD =
 2=127.0.0.1
 3=localhost
 
+[sales]
+CONDITIONAL_DEBIT = False
+GROUP_COMMIT = False
+
+[menu]
+HEATMAP_WEEKS = 12
+
+[mail]
+HOST = localhost
+PORT = 25
+
 [logging]
 HANDLERS = [
     "console",
@@ -221,6 +232,16 @@ SELECT2_CSS = (
 
 TEST_RUNNER = 'stregsystem.utils.stregsystemTestRunner'
 
+# Debit balances with a conditional UPDATE instead of locking the member row, see Order.execute
+STREGSYSTEM_CONDITIONAL_DEBIT = cfg.getboolean("sales", "CONDITIONAL_DEBIT")
+# Commit the orders of concurrent requests together from a single writer thread, see stregsystem.sale_writer
+STREGSYSTEM_GROUP_COMMIT = cfg.getboolean("sales", "GROUP_COMMIT")
+# How many weeks back the purchase heatmap on the menu goes, up to a year costs about the same as the default
+STREGSYSTEM_HEATMAP_WEEKS = cfg.getint("menu", "HEATMAP_WEEKS")
+# The SMTP server the sendqueuedmail command delivers the outbox to
+STREGSYSTEM_MAIL_HOST = cfg.get("mail", "HOST")
+STREGSYSTEM_MAIL_PORT = cfg.getint("mail", "PORT")
+
 LOGIN_REDIRECT_URL = '/admin/login'
 LOGIN_URL = '/admin/login'
 